@@ -0,0 +1,287 @@
+#!/usr/bin/env python2
+from __future__ import division, absolute_import
+"""Benchmark filter wheel moves, homes and diffuser sequences
+
+Runs device.py against a simulated wheel (fakeFilterWheel.FakeDevice):
+homes from random start angles, moves between every (from, to) filter
+pair, and runs diffuser in/spin up/spin down/out sequences.  For each
+kind of action it reports p50/p95/p99 wall time, the number of motor
+moves started and stopped, and the stop position error relative to the
+true hall center.  A heartbeat measures how long the reactor was blocked.
+Results are written as json so runs can be compared.
+
+Faults may be injected (see faultInjector.FaultInjector) to see how the
+results degrade.
+
+usage: benchmarkArcticFW.py [--repeat N] [--homes N] [--diffuser N] [--seed S] [--out FILE]
+    [--usbLatency SEC] [--dropCmd P] [--dropReply P] [--hallBounce P] [--hallDelay SEC] [--wedge P] [--timeoutExecutes P]
+"""
+import argparse
+import json
+import random
+import time
+
+import numpy
+from twisted.internet import reactor, defer, task
+from twisted.python.failure import Failure
+
+from arcticFilterWheel import device
+from arcticFilterWheel.fakeFilterWheel import FakeDevice
+from arcticFilterWheel.faultInjector import FaultInjector
+
+HEARTBEAT = 0.005 # seconds between reactor heartbeats
+PERCENTILES = [50, 95, 99]
+MAX_HOMES = 3 # failed homes in a row before giving up
+
+class ReactorMonitor(object):
+    """Measure how late a periodic call runs, ie how long the reactor is blocked
+    """
+    def __init__(self, period=HEARTBEAT):
+        self.period = period
+        self.lags = []
+        self.lastTime = None
+        self.loop = task.LoopingCall(self.beat)
+
+    def start(self):
+        self.lastTime = time.time()
+        self.loop.start(self.period, now=False)
+
+    def stop(self):
+        self.loop.stop()
+
+    def beat(self):
+        now = time.time()
+        self.lags.append(max(now - self.lastTime - self.period, 0))
+        self.lastTime = now
+
+    def summary(self):
+        lags = numpy.array(self.lags or [0])
+        return {
+            "beats": len(self.lags),
+            "blockedTime": float(lags.sum()),
+            "maxLag": float(lags.max()),
+            "lagPercentiles": percentiles(lags),
+        }
+
+def percentiles(values):
+    return dict(("p%i"%pp, float(numpy.percentile(values, pp))) for pp in PERCENTILES)
+
+class Benchmark(object):
+    def __init__(self, fake, repeat=1, nHomes=5, nDiffuser=2, seed=None, injector=None):
+        self.fake = fake
+        self.injector = injector
+        self.repeat = repeat
+        self.nHomes = nHomes
+        self.nDiffuser = nDiffuser
+        self.rand = random.Random(seed)
+        self.monitor = ReactorMonitor()
+        self.trials = []
+
+    def waitFor(self, start, callbackName):
+        # call start() and return a deferred fired by the
+        # device status move or home callback
+        d = defer.Deferred()
+        getattr(device.status, callbackName)(lambda: d.callback(None))
+        start()
+        return d
+
+    def stopError(self):
+        # (hall index, signed steps) of the wheel from the nearest hall center
+        return self.fake.hallOffset()
+
+    @defer.inlineCallbacks
+    def timed(self, kind, start, callbackName, **info):
+        nMoves, nStops = self.fake.nMoves, self.fake.nStops
+        tStart = time.time()
+        yield self.waitFor(start, callbackName)
+        trial = dict(info)
+        trial.update(
+            kind=kind,
+            wallTime=time.time() - tStart,
+            moves=self.fake.nMoves - nMoves,
+            stops=self.fake.nStops - nStops,
+            ok=device.status.isHomed,
+            filterID=device.status.filterID,
+        )
+        hallInd, offset = self.stopError()
+        trial.update(hall=hallInd + 1, stopError=offset)
+        if info.get("toFilter") is not None:
+            trial["ok"] = trial["ok"] and device.status.filterID == info["toFilter"] == hallInd + 1
+        self.trials.append(trial)
+        defer.returnValue(trial)
+
+    @defer.inlineCallbacks
+    def home(self):
+        # put the wheel at a random angle, then home
+        self.fake.angleOffset = self.rand.uniform(0, self.fake.stepsPerRev)
+        startAngle = self.fake.wheelAngle()
+        yield self.timed("home", device.home, "addHomeCallback", startAngle=startAngle)
+
+    @defer.inlineCallbacks
+    def moveTo(self, filterID):
+        fromFilter = device.status.filterID
+        yield self.timed("move", lambda: device.moveToFilter(filterID), "addMoveCallback", fromFilter=fromFilter, toFilter=filterID)
+
+    @defer.inlineCallbacks
+    def ensureHomed(self):
+        for ii in range(MAX_HOMES):
+            if device.status.isHomed:
+                return
+            yield self.home()
+        if not device.status.isHomed:
+            raise RuntimeError("filter wheel failed to home %i times"%(MAX_HOMES,))
+
+    @defer.inlineCallbacks
+    def diffuserTrial(self, kind, setFunc):
+        tStart = time.time()
+        trial = {"kind": kind}
+        try:
+            yield setFunc()
+            trial["ok"] = True
+        except RuntimeError as e:
+            trial["ok"] = False
+            trial["error"] = str(e)
+        trial["wallTime"] = time.time() - tStart
+        self.trials.append(trial)
+
+    @defer.inlineCallbacks
+    def run(self):
+        yield device.init()
+        self.monitor.start()
+        for ii in range(self.nHomes):
+            yield self.home()
+        for ii in range(self.repeat):
+            for fromFilter in range(1, 7):
+                for toFilter in range(1, 7):
+                    if fromFilter == toFilter:
+                        continue
+                    yield self.ensureHomed()
+                    if device.status.filterID != fromFilter:
+                        # untimed move to the starting filter
+                        yield self.waitFor(lambda: device.moveToFilter(fromFilter), "addMoveCallback")
+                        yield self.ensureHomed()
+                        if device.status.filterID != fromFilter:
+                            continue
+                    yield self.moveTo(toFilter)
+        for ii in range(self.nDiffuser):
+            yield self.diffuserTrial("diffuIn", device.setDiffuserIn)
+            yield self.diffuserTrial("diffuSpinUp", device.setRotationStart)
+            yield self.diffuserTrial("diffuSpinDown", device.setRotationStop)
+            yield self.diffuserTrial("diffuOut", device.setDiffuserOut)
+        self.monitor.stop()
+
+    def faultSummary(self):
+        if self.injector is None:
+            return None
+        injector = self.injector
+        return {
+            "usbCmds": injector.nCmds,
+            "usbTimeouts": injector.nTimeouts,
+            "droppedCmds": injector.nDroppedCmds,
+            "droppedReplies": injector.nDroppedReplies,
+            "bounces": injector.nBounces,
+            "wedges": injector.nWedges,
+            "reconnects": device.status.usbReconnects,
+        }
+
+    def summary(self):
+        kinds = []
+        for trial in self.trials:
+            if trial["kind"] not in kinds:
+                kinds.append(trial["kind"])
+        results = {}
+        for kind in kinds:
+            trials = [trial for trial in self.trials if trial["kind"] == kind]
+            result = {
+                "n": len(trials),
+                "failures": sum(1 for trial in trials if not trial["ok"]),
+                "wallTime": percentiles([trial["wallTime"] for trial in trials]),
+            }
+            if "moves" in trials[0]:
+                result["moves"] = float(numpy.mean([trial["moves"] for trial in trials]))
+                result["stops"] = float(numpy.mean([trial["stops"] for trial in trials]))
+                absError = [abs(trial["stopError"]) for trial in trials]
+                result["stopError"] = percentiles(absError)
+                result["stopError"]["max"] = float(numpy.max(absError))
+            results[kind] = result
+        return {
+            "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "settings": {
+                "DIRECT_MOVE": device.DIRECT_MOVE,
+                "PASS_THROUGH_MOVE": device.PASS_THROUGH_MOVE,
+                "CONTINUOUS_HOME": device.CONTINUOUS_HOME,
+                "NATIVE_HALL_WATCH": device.NATIVE_HALL_WATCH,
+                "SAMPLER": device.SAMPLER,
+            },
+            "results": results,
+            "faults": self.faultSummary(),
+            "reactor": self.monitor.summary(),
+            "trials": self.trials,
+        }
+
+def printSummary(summary):
+    for kind, result in summary["results"].items():
+        wallTime = result["wallTime"]
+        line = "%-14s n=%-4i fail=%-3i wall p50/p95/p99 %.2f/%.2f/%.2f s"%(
+            kind, result["n"], result["failures"], wallTime["p50"], wallTime["p95"], wallTime["p99"])
+        if "moves" in result:
+            line += "  moves %.1f stops %.1f  |stop error| p95 %.1f max %.1f steps"%(
+                result["moves"], result["stops"], result["stopError"]["p95"], result["stopError"]["max"])
+        print(line)
+    react = summary["reactor"]
+    print("reactor blocked %.3f s total, max lag %.4f s, p99 lag %.4f s"%(
+        react["blockedTime"], react["maxLag"], react["lagPercentiles"]["p99"]))
+    if summary["faults"] is not None:
+        print("faults: %s"%(", ".join("%s=%s"%item for item in sorted(summary["faults"].items())),))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark filter wheel moves, homes and diffuser sequences")
+    parser.add_argument("--repeat", type=int, default=1, help="times to run through all filter pairs")
+    parser.add_argument("--homes", type=int, default=5, help="number of homes from random angles")
+    parser.add_argument("--diffuser", type=int, default=2, help="number of diffuser sequences")
+    parser.add_argument("--seed", type=int, default=None, help="random seed for the wheel and start angles")
+    parser.add_argument("--out", default="benchmarkArcticFW.json", help="json results file")
+    parser.add_argument("--usbLatency", type=float, default=0, help="mean usb latency, exponentially distributed (sec)")
+    parser.add_argument("--dropCmd", type=float, default=0, help="probability a usb command is lost")
+    parser.add_argument("--dropReply", type=float, default=0, help="probability a usb reply is lost")
+    parser.add_argument("--hallBounce", type=float, default=0, help="probability a hall reading is inverted")
+    parser.add_argument("--hallDelay", type=float, default=0, help="seconds the hall sensor lags the wheel")
+    parser.add_argument("--wedge", type=float, default=0, help="probability a usb command wedges the link until reconnected")
+    parser.add_argument("--timeoutExecutes", type=float, default=0.5, help="probability a usb command that times out still reaches the controller")
+    args = parser.parse_args()
+
+    fake = FakeDevice(seed=args.seed)
+    injector = None
+    if args.usbLatency or args.dropCmd or args.dropReply or args.hallBounce or args.hallDelay or args.wedge:
+        usbLatency = None
+        if args.usbLatency:
+            usbLatency = lambda rand: rand.expovariate(1/args.usbLatency)
+        injector = FaultInjector(fake,
+            seed = args.seed,
+            usbLatency = usbLatency,
+            dropCmd = args.dropCmd,
+            dropReply = args.dropReply,
+            bounceBits = {device.HALL_POS: args.hallBounce} if args.hallBounce else None,
+            hallDelay = args.hallDelay,
+            wedge = args.wedge,
+            timeoutExecutes = args.timeoutExecutes,
+        )
+    device.setDevice(fake if injector is None else injector)
+    benchmark = Benchmark(fake, repeat=args.repeat, nHomes=args.homes, nDiffuser=args.diffuser, seed=args.seed, injector=injector)
+
+    def done(result):
+        if isinstance(result, Failure):
+            print("benchmark stopped early: %s"%(result.getErrorMessage(),))
+        summary = benchmark.summary()
+        with open(args.out, "w") as f:
+            json.dump(summary, f, indent=1)
+        printSummary(summary)
+        print("results written to %s"%args.out)
+        reactor.stop()
+
+    def run():
+        benchmark.run().addBoth(done)
+
+    reactor.callWhenRunning(run)
+    reactor.run()
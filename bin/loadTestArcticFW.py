@@ -0,0 +1,224 @@
+#!/usr/bin/env python2
+from __future__ import division, absolute_import
+"""Load test the filter wheel actor with many clients issuing status
+
+Runs the actor against a simulated wheel (fakeFilterWheel.FakeDevice)
+and connects N clients to it over tcp, each sending status commands at
+the given rate for a while.  Clients may subscribe to a subset of status
+keywords and a maximum output rate first (see the actor's subscribe
+command).  For each number of clients it reports the status commands
+completed per second, the command latency p50/p95/p99, the lines each
+client received per second and the hardware status reads made.  Results
+are written as json so runs can be compared.
+
+usage: loadTestArcticFW.py [--clients N,N,...] [--rate R] [--duration SEC] [--keywords KW,KW,...]
+    [--interval SEC] [--port PORT] [--out FILE]
+"""
+import argparse
+import json
+import time
+
+import numpy
+from twisted.internet import reactor, defer, protocol, task
+from twisted.protocols.basic import LineReceiver
+
+from arcticFilterWheel import ArcticFWActor, device
+from arcticFilterWheel.fakeFilterWheel import FakeDevice
+
+PERCENTILES = [50, 95, 99]
+SETTLE_TIME = 1 # seconds to wait for clients to connect and subscribe
+INIT_TIMEOUT = 60 # seconds to wait for the actor to initialize
+
+def percentiles(values):
+    return dict(("p%i"%pp, float(numpy.percentile(values or [0], pp))) for pp in PERCENTILES)
+
+class CountingFakeDevice(FakeDevice):
+    """A FakeDevice counting hardware status reads
+    """
+    def __init__(self, *args, **kwargs):
+        FakeDevice.__init__(self, *args, **kwargs)
+        self.nStatusReads = 0
+
+    def queryMotorState(self, *args):
+        self.nStatusReads += 1
+        return FakeDevice.queryMotorState(self, *args)
+
+class StatusClient(LineReceiver):
+    """Send status commands at a fixed rate and time the replies
+    """
+    delimiter = "\n"
+
+    def __init__(self, rate, subscribeStr=None):
+        self.rate = rate
+        self.subscribeStr = subscribeStr
+        self.nextCmdID = 1
+        self.sendTimes = {} # cmdID: time sent, for commands not yet done
+        self.latencies = []
+        self.nFailed = 0
+        self.nLines = 0
+        self.ready = defer.Deferred() # fired once connected
+        self.loop = task.LoopingCall(self.sendStatus)
+
+    def connectionMade(self):
+        if self.subscribeStr:
+            self.sendCommand(self.subscribeStr)
+        self.ready.callback(self)
+
+    def sendCommand(self, cmdStr):
+        cmdID = self.nextCmdID
+        self.nextCmdID += 1
+        self.sendTimes[cmdID] = time.time()
+        self.sendLine("%i %s"%(cmdID, cmdStr))
+
+    def sendStatus(self):
+        self.sendCommand("status")
+
+    def start(self):
+        self.nLines = 0
+        self.loop.start(1/self.rate)
+
+    def stop(self):
+        if self.loop.running:
+            self.loop.stop()
+
+    def lineReceived(self, line):
+        # cmdID userID msgCode msgStr
+        self.nLines += 1
+        words = line.split(None, 3)
+        if len(words) < 3:
+            return
+        try:
+            cmdID = int(words[0])
+        except ValueError:
+            return
+        msgCode = words[2]
+        if msgCode not in (":", "f") or cmdID not in self.sendTimes:
+            return
+        sendTime = self.sendTimes.pop(cmdID)
+        if msgCode == "f":
+            self.nFailed += 1
+        elif cmdID > 1 or not self.subscribeStr:
+            self.latencies.append(time.time() - sendTime)
+
+class LoadTest(object):
+    def __init__(self, fake, port, rate=10, duration=10, subscribeStr=None):
+        self.fake = fake
+        self.port = port
+        self.rate = rate
+        self.duration = duration
+        self.subscribeStr = subscribeStr
+        self.rounds = []
+
+    def connect(self):
+        client = StatusClient(self.rate, self.subscribeStr)
+        factory = protocol.ClientFactory()
+        factory.buildProtocol = lambda addr: client
+        reactor.connectTCP("localhost", self.port, factory)
+        return client.ready
+
+    def wait(self, duration):
+        d = defer.Deferred()
+        reactor.callLater(duration, d.callback, None)
+        return d
+
+    @defer.inlineCallbacks
+    def waitForInit(self):
+        tEnd = time.time() + INIT_TIMEOUT
+        while device.status.initState == device.status.Initializing:
+            if time.time() > tEnd:
+                raise RuntimeError("actor failed to initialize within %s seconds"%(INIT_TIMEOUT,))
+            yield self.wait(0.1)
+
+    @defer.inlineCallbacks
+    def runRound(self, nClients):
+        clients = yield defer.gatherResults([self.connect() for ii in range(nClients)])
+        yield self.wait(SETTLE_TIME)
+        nStatusReads = self.fake.nStatusReads
+        tStart = time.time()
+        for client in clients:
+            client.start()
+        yield self.wait(self.duration)
+        for client in clients:
+            client.stop()
+        # let the last replies arrive
+        yield self.wait(SETTLE_TIME)
+        elapsed = time.time() - tStart - SETTLE_TIME
+        latencies = sum([client.latencies for client in clients], [])
+        nLines = [client.nLines for client in clients]
+        self.rounds.append({
+            "clients": nClients,
+            "done": len(latencies),
+            "failed": sum(client.nFailed for client in clients),
+            "unanswered": sum(len(client.sendTimes) for client in clients),
+            "cmdsPerSec": len(latencies)/elapsed,
+            "latency": percentiles(latencies),
+            "linesPerSecPerClient": float(numpy.mean(nLines))/elapsed,
+            "statusReads": self.fake.nStatusReads - nStatusReads,
+        })
+        for client in clients:
+            client.transport.loseConnection()
+
+    @defer.inlineCallbacks
+    def run(self, clientCounts):
+        yield self.waitForInit()
+        for nClients in clientCounts:
+            yield self.runRound(nClients)
+
+    def summary(self):
+        return {
+            "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "settings": {
+                "rate": self.rate,
+                "duration": self.duration,
+                "subscribe": self.subscribeStr,
+            },
+            "rounds": self.rounds,
+        }
+
+def printSummary(summary):
+    for result in summary["rounds"]:
+        latency = result["latency"]
+        print("%3i clients: %7.1f status/s  fail=%-3i unanswered=%-3i latency p50/p95/p99 %.4f/%.4f/%.4f s  %.1f lines/s/client  %i status reads"%(
+            result["clients"], result["cmdsPerSec"], result["failed"], result["unanswered"],
+            latency["p50"], latency["p95"], latency["p99"], result["linesPerSecPerClient"], result["statusReads"]))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Load test the filter wheel actor with many clients issuing status")
+    parser.add_argument("--clients", default="1,2,4,8,16,32", help="comma separated numbers of clients, one round each")
+    parser.add_argument("--rate", type=float, default=20, help="status commands per second sent by each client")
+    parser.add_argument("--duration", type=float, default=10, help="seconds each round sends status commands")
+    parser.add_argument("--keywords", default=None, help="comma separated status keywords each client subscribes to")
+    parser.add_argument("--interval", type=float, default=None, help="minimum seconds between status outputs each client subscribes to")
+    parser.add_argument("--port", type=int, default=37001, help="port for the actor")
+    parser.add_argument("--out", default="loadTestArcticFW.json", help="json results file")
+    args = parser.parse_args()
+
+    subscribeStr = None
+    if args.keywords is not None or args.interval is not None:
+        subscribeStr = "subscribe"
+        if args.keywords is not None:
+            subscribeStr += " keywords=%s"%(args.keywords,)
+        if args.interval is not None:
+            subscribeStr += " interval=%s"%(args.interval,)
+
+    fake = CountingFakeDevice()
+    device.setDevice(fake)
+    actor = ArcticFWActor(name="arcticFilterWheel", userPort=args.port)
+    loadTest = LoadTest(fake, args.port, rate=args.rate, duration=args.duration, subscribeStr=subscribeStr)
+
+    def done(result):
+        if result is not None:
+            print("load test stopped early: %s"%(result.getErrorMessage(),))
+        summary = loadTest.summary()
+        with open(args.out, "w") as f:
+            json.dump(summary, f, indent=1)
+        printSummary(summary)
+        print("results written to %s"%args.out)
+        reactor.stop()
+
+    def run():
+        loadTest.run([int(nClients) for nClients in args.clients.split(",")]).addBoth(done)
+
+    reactor.callWhenRunning(run)
+    reactor.run()
@@ -2,33 +2,138 @@ from __future__ import division, absolute_import
 
 import syslog
 import collections
-import time
+from twisted.internet import defer
+from twisted.python.failure import Failure
 from twistedActor import Actor, expandUserCmd, log, UserCmd
 
+from . import device
 from .commandSet import arcticFWCommandSet
+from .sequence import SequenceStep, parseSequence, planSequence
 from .version import __version__
 
 # from filter import FilterWheel
-from .device import moveToFilter, home, status, stop, init, setDiffuserIn, setDiffuserOut, setRotationStart, setRotationStop
+from .device import moveToFilter, retargetMove, home, status, stop, init, setDiffuserIn, setDiffuserOut, setRotationStart, setRotationStop, setDevice, refreshStatus, pollSoon, statusAge
+from .fakeFilterWheel import FakeDevice
 
 UserPort = 37000
+MaxUsers = 0 # maximum number of clients connected at once, 0 for no limit
 
 IN_BEAM = 1
 OUT_OF_BEAM = 0
-DIFFU_TIMEOUT = 5 # 5 second timeout to move in and out of beam?
+STATUS_MAX_AGE = 0.5 # seconds old a status may be and still be output without reading the hardware
 
 
 
+def _nanStr(value):
+    return "NaN" if value is None else str(value)
+
+def _bitStr(value):
+    return "?" if value is None else str(int(value))
+
+def _timeStr(value):
+    return "NaN" if value is None else "%.2f"%value
+
 class ArcticFWStatus(object):
     Homing = "Homing"
     NotHomed = "NotHomed"
     Moving = "Moving"
     Done = "Done"
-    def __init__(self):
+    # (keyword, function of this ArcticFWStatus returning its value,
+    # function formatting the value for output) in output order
+    Keywords = (
+        ("state", lambda self: self.state, str),
+        ("wheelID", lambda self: self.status.wheelID, _nanStr),
+        ("filterID", lambda self: self.status.filterID, _nanStr),
+        ("cmdFilterID", lambda self: self.status.cmdFilterID, _nanStr),
+        ("encoderPos", lambda self: self.status.encPos, str),
+        ("inPosition", lambda self: self.status.inPosition, str),
+        ("atHome", lambda self: self.status.atHome, str),
+        ("diffuInBeam", lambda self: self.status.diffuserIn, _bitStr),
+        ("diffuCover", lambda self: self.status.diffuserCover, _bitStr),
+        ("diffuserAtSpeed", lambda self: self.status.diffuserRPM, _bitStr),
+        ("diffuserRot", lambda self: self.status.diffuserRot, _bitStr),
+        ("diffuInTime", lambda self: self.status.diffuTimes.get("in"), _timeStr),
+        ("diffuOutTime", lambda self: self.status.diffuTimes.get("out"), _timeStr),
+        ("diffuSpinUpTime", lambda self: self.status.diffuTimes.get("spinUp"), _timeStr),
+        ("diffuSpinDownTime", lambda self: self.status.diffuTimes.get("spinDown"), _timeStr),
+        ("initState", lambda self: self.status.initState, _nanStr),
+        ("initTime", lambda self: self.status.initTime, _timeStr),
+        ("usbReconnects", lambda self: self.status.usbReconnects, str),
+    )
+    def __init__(self, maxAge=STATUS_MAX_AGE):
+        """!Construct an ArcticFWStatus
+
+        @param[in] maxAge  default seconds old the status may be before update() reads the hardware
+        """
         self.status = status
+        self.maxAge = maxAge
+        self._updating = None # deferreds waiting on the hardware read in progress
+        self._followUp = None # deferreds waiting on the read to follow it
+        self.published = {} # keyword: "keyword=value" last output
+        # the last snapshot: value, formatted value and
+        # "keyword=value" of each keyword
+        self._values = {}
+        self._valStrs = collections.OrderedDict()
+        self._kwStrs = collections.OrderedDict()
+
+    def update(self, maxAge=None):
+        """Refresh the status if it is older than maxAge, speeding up status polling
+
+        A hardware read already in progress is shared rather than starting another.
+        With maxAge=0 the read may have begun too early, so one more read follows it,
+        shared by every maxAge=0 caller until it begins.
+
+        @param[in] maxAge  seconds old the status may be, None for self.maxAge, 0 to always read the hardware
+        @return a deferred fired once updated
+        """
+        if maxAge is None:
+            maxAge = self.maxAge
+        if maxAge > 0:
+            age = statusAge()
+            if age is not None and age <= maxAge:
+                pollSoon()
+                return defer.succeed(self.status)
+        d = defer.Deferred()
+        if self._updating is None:
+            self._updating = [d]
+            self._read()
+        elif maxAge > 0:
+            self._updating.append(d)
+        else:
+            if self._followUp is None:
+                self._followUp = []
+            self._followUp.append(d)
+        return d
 
-    def update(self):
-        self.status.update()
+    def _read(self):
+        """Read the hardware for the deferreds in self._updating, then begin any follow-up read
+        """
+        waiting = self._updating
+        def updated(result):
+            self._updating = None
+            for d in waiting:
+                if isinstance(result, Failure):
+                    d.errback(result)
+                else:
+                    d.callback(result)
+            if self._followUp is not None:
+                followUp = self._followUp
+                self._followUp = None
+                if self._updating is None:
+                    self._updating = followUp
+                    self._read()
+                else:
+                    # begun by a caller above
+                    self._updating.extend(followUp)
+        refreshStatus().addBoth(updated)
+
+    @property
+    def isReady(self):
+        return self.status.initState == self.status.Ready
+
+    @property
+    def initSteps(self):
+        return self.status.initSteps
 
     def addMoveCallback(self, callback):
         self.status.addMoveCallback(callback)
@@ -38,19 +143,24 @@ class ArcticFWStatus(object):
 
     @property
     def kwMap(self):
-        return collections.OrderedDict((
-            ("state", self.state),
-            ("wheelID", "NaN" if self.status.wheelID is None else self.status.wheelID),
-            ("filterID", "NaN" if self.status.filterID is None else self.status.filterID),
-            ("cmdFilterID", "NaN" if self.status.cmdFilterID is None else self.status.cmdFilterID),
-            ("encoderPos", self.status.encPos),
-            ("inPosition", self.status.inPosition),
-            ("atHome", self.status.atHome),
-            ("diffuInBeam", "?" if self.status.diffuserIn is None else int(self.status.diffuserIn)),
-	    ("diffuCover", "?" if self.status.diffuserCover is None else int(self.status.diffuserCover)),
-	    ("diffuserAtSpeed", "?" if self.status.diffuserRPM is None else int(self.status.diffuserRPM)),
-	    ("diffuserRot", "?" if self.status.diffuserRot is None else int(self.status.diffuserRot)),
-        ))
+        """OrderedDict of keyword: formatted value, see snapshot
+        """
+        return self.snapshot()
+
+    def snapshot(self):
+        """Read every keyword's value, formatting only those that changed
+
+        @return OrderedDict of keyword: formatted value, in output order.
+            It is reused by the next snapshot, so copy it to keep it
+        """
+        for kw, getValue, formatValue in self.Keywords:
+            value = getValue(self)
+            if kw not in self._values or value != self._values[kw]:
+                self._values[kw] = value
+                valStr = formatValue(value)
+                self._valStrs[kw] = valStr
+                self._kwStrs[kw] = "%s=%s"%(kw, valStr)
+        return self._valStrs
 
     @property
     def currentPos(self):
@@ -90,10 +200,8 @@ class ArcticFWStatus(object):
     def _subStatusStr(self, kwList):
         """Return status of only kw in kwList
         """
-        statusList = []
-        for kw in list(kwList):
-            statusList.append("%s=%s"%(kw, str(self.kwMap[kw])))
-        return "; ".join(statusList)
+        self.snapshot()
+        return "; ".join([self._kwStrs[kw] for kw in kwList])
 
     @property
     def moveStr(self):
@@ -101,12 +209,62 @@ class ArcticFWStatus(object):
 
     @property
     def diffuStr(self):
-       return self._subStatusStr(["diffuInBeam", "diffuCover","diffuserRot", "diffuserAtSpeed"])
+       return self._subStatusStr(["diffuInBeam", "diffuCover","diffuserRot", "diffuserAtSpeed",
+            "diffuInTime", "diffuOutTime", "diffuSpinUpTime", "diffuSpinDownTime"])
 
     @property
     def statusStr(self):
-        # todo: only output a changed status value?
-        return "; ".join(["%s=%s"%(kw, str(val)) for kw, val in self.kwMap.iteritems()])
+        self.snapshot()
+        return "; ".join(self._kwStrs.itervalues())
+
+    def publishStr(self, kwList=None, changedOnly=True, published=None):
+        """Return status to output, remembering what was output
+
+        @param[in] kwList  keywords to output, all if None
+        @param[in] changedOnly  if True only output keywords whose value differs from when last output
+        @param[in] published  dict of keyword: "keyword=value" last output, updated;
+            if None self.published, ie what was last output to every client
+        @return the status string, "" if nothing changed
+        """
+        self.snapshot()
+        if kwList is None:
+            kwList = self._kwStrs.keys()
+        if published is None:
+            published = self.published
+        statusList = []
+        for kw in kwList:
+            kwStr = self._kwStrs[kw]
+            if changedOnly and published.get(kw) == kwStr:
+                continue
+            published[kw] = kwStr
+            statusList.append(kwStr)
+        return "; ".join(statusList)
+
+class StatusSubscription(object):
+    def __init__(self, kwList=None, interval=0, published=None, changedOnly=True):
+        """!Construct a StatusSubscription: the status keywords one client gets and how often
+
+        @param[in] kwList  keywords the client gets, all if None
+        @param[in] interval  minimum seconds between status outputs to the client
+        @param[in] published  dict of keyword: "keyword=value" the client already has
+        @param[in] changedOnly  if True the client only gets the keywords that changed since it last got them
+        """
+        self.kwList = kwList
+        self.interval = interval
+        self.changedOnly = changedOnly
+        self.published = {} if published is None else published
+        self.lastTime = None # time of the last output
+        self.pending = None # delayed call of the output held back by interval
+
+    def isDue(self, now):
+        """Return True if the client may be sent status at time now
+        """
+        return self.lastTime is None or now - self.lastTime >= self.interval
+
+    def cancel(self):
+        if self.pending is not None and self.pending.active():
+            self.pending.cancel()
+        self.pending = None
 
 class ArcticFWActor(Actor):
     Facility = syslog.LOG_LOCAL1
@@ -117,6 +275,10 @@ class ArcticFWActor(Actor):
         name,
         userPort = UserPort,
         commandSet = arcticFWCommandSet,
+        fakeFilterWheel = False,
+        changedOnly = False,
+        maxUsers = MaxUsers,
+        queueMoves = False,
     ):
         """!Construct an ArcticFWActor
 
@@ -124,39 +286,88 @@ class ArcticFWActor(Actor):
         @param[in] userPort  int, a port on which this thing runs
         @param[in] commandSet  a twistedActor.parse.CommandSet used for command def, and parsing
         @param[in] fakeFilterWheel  bool.  If true use a fake filter wheel device, for safe testing.
+        @param[in] changedOnly  bool.  If true status output by move, home and diffuser callbacks
+            holds only the keywords that changed; the status command always outputs all of them
+        @param[in] maxUsers  int, maximum number of clients connected at once, 0 for no limit
+        @param[in] queueMoves  bool.  If true a move commanded while the wheel moves is not rejected:
+            the move under way is retargeted if it has yet to pass the new filter, else the new
+            move waits for it to finish, superseding any move already waiting
         """
+        if fakeFilterWheel:
+            setDevice(FakeDevice())
+        self.changedOnly = changedOnly
         self.status = ArcticFWStatus()
+        self.subscriptions = {} # userID: StatusSubscription, see cmd_subscribe
         self.fwHomeCmd = UserCmd()
         self.fwHomeCmd.setState(self.fwHomeCmd.Done)
         self.fwMoveCmd = UserCmd()
         self.fwMoveCmd.setState(self.fwMoveCmd.Done)
+        self.queueMoves = queueMoves
+        self.queuedMoveCmd = None # move waiting for the one under way, if queueMoves
+        self.seqCmd = UserCmd()
+        self.seqCmd.setState(self.seqCmd.Done)
+        self.seqWait = None # delayed call ending the sequence's wait step
+        self.seqTrigger = None # deferred fired by the trigger command
+        self.diffuCmd = UserCmd()
+        self.diffuCmd.setState(self.diffuCmd.Done)
+        self.diffuWait = None # deferred of the sensor wait for diffuCmd
         self.status.addHomeCallback(self.homeCallback)
         self.status.addMoveCallback(self.moveCallback)
         # init the filterWheel
         # this sets self.filterWheel
         Actor.__init__(self,
             userPort = userPort,
-            maxUsers = 1,
+            maxUsers = maxUsers,
             name = name,
             version = __version__,
             commandSet = commandSet,
             )
-        init()
+        init().addBoth(self.initCallback)
 
+    def initCallback(self, result):
+        """Report the outcome and step timing of the motor initialization
+        """
+        for cmdStr, stepTime in self.status.initSteps:
+            log.info("%s motor init %s took %.3f seconds"%(self, cmdStr, stepTime))
+        if isinstance(result, Failure):
+            log.error("%s motor init failed: %s"%(self, result.value))
+        self.writeToUsers("i", "initStepCmds=%s; initStepTimes=%s"%(
+            ",".join(['"%s"'%cmdStr for cmdStr, stepTime in self.status.initSteps]),
+            ",".join(["%.3f"%stepTime for cmdStr, stepTime in self.status.initSteps]),
+        ))
+        self.cmd_status()
 
     @property
     def filterWheelMoving(self):
         return self.status.isMoving
 
-    def init(self, userCmd=None, getStatus=True, timeLim=DefaultTimeLim):
+    def init(self, userCmd=None, getStatus=True, timeLim=DefaultTimeLim, force=False):
         """! Initialize all devices, and get status if wanted
+
+        The motor controller is initialized again if its initialization
+        failed, or if force; userCmd finishes when that is done.
         @param[in]  userCmd  a UserCmd or None
         @param[in]  getStatus if true, query all devices for status
         @param[in]  timeLim
+        @param[in]  force  if true initialize the motor controller even if it is ready
         """
         userCmd = expandUserCmd(userCmd)
-        log.info("%s.init(userCmd=%s, timeLim=%s, getStatus=%s)" % (self, userCmd, timeLim, getStatus))
-        if getStatus:
+        log.info("%s.init(userCmd=%s, timeLim=%s, getStatus=%s, force=%s)" % (self, userCmd, timeLim, getStatus, force))
+        if status.initState == status.Initializing:
+            userCmd.setState(userCmd.Failed, "filter wheel is already initializing")
+        elif status.isMoving or status.isHoming:
+            userCmd.setState(userCmd.Failed, "filter wheel is moving")
+        elif force or status.initState == status.InitFailed:
+            def initDone(result):
+                self.initCallback(result)
+                if isinstance(result, Failure):
+                    userCmd.setState(userCmd.Failed, "motor init failed: %s"%(result.getErrorMessage(),))
+                elif getStatus:
+                    self.cmd_status(userCmd) # sets done
+                else:
+                    userCmd.setState(userCmd.Done)
+            init().addBoth(initDone)
+        elif getStatus:
             self.cmd_status(userCmd) # sets done
         else:
             userCmd.setState(userCmd.Done)
@@ -168,7 +379,8 @@ class ArcticFWActor(Actor):
         """
         log.info("%s.cmd_init(userCmd=%s)"%(self, str(userCmd)))
         # print("%s.cmd_init(userCmd=%s)"%(self, str(userCmd)))
-        self.init(userCmd, getStatus=True)
+        force = "force" in [parsedKeyword.keyword for parsedKeyword in userCmd.parsedCommand.parsedKeywords]
+        self.init(userCmd, getStatus=True, force=force)
         # userCmd.setState(userCmd.Done)
         return True
 
@@ -186,6 +398,8 @@ class ArcticFWActor(Actor):
         # print("%s.cmd_stop(userCmd=%s)"%(self, str(userCmd)))
         if not self.fwMoveCmd.isDone:
             self.fwMoveCmd.setState(self.fwMoveCmd.Failed, "stop commanded")
+        self.supersedeQueuedMove("stop commanded")
+        self.stopSequence("stop commanded")
         if not self.fwHomeCmd.isDone:
             self.fwHomeCmd.setState(self.fwHomeCmd.Failed, "stop commanded")
         stop()
@@ -193,19 +407,48 @@ class ArcticFWActor(Actor):
         return True
 
     def moveCallback(self):
-        self.getStatus()
-        self.writeToUsers("i", self.status.statusStr, cmd=self.fwMoveCmd)
+        self.getStatus().addCallback(self._moveDone)
+
+    def _moveDone(self, dummy):
+        """Finish the move command once the status is updated, then start any queued move
+        """
+        self.writeStatus(self.fwMoveCmd)
         if self.fwMoveCmd.isDone:
             # probably cancelled by stop
-            return
-        if self.status.inPosition:
-            self.fwMoveCmd.setState(self.fwMoveCmd.Done)
-        else:
+            pass
+        elif not self.status.inPosition:
             self.fwMoveCmd.setState(self.fwMoveCmd.Failed, "Failed to stop at filter sensor")
+        elif self.status.currentPos != self.status.status.cmdFilterID:
+            self.fwMoveCmd.setState(self.fwMoveCmd.Failed, "Failed to start move")
+        else:
+            self.fwMoveCmd.setState(self.fwMoveCmd.Done)
+        self.startQueuedMove()
+
+    def startQueuedMove(self):
+        """Start the queued move, if any, now the move before it is done
+        """
+        if self.queuedMoveCmd is not None:
+            userCmd = self.queuedMoveCmd
+            self.queuedMoveCmd = None
+            self.cmd_move(userCmd, queued=True)
+
+    def supersedeQueuedMove(self, textMsg):
+        """Fail the queued move, if any
+
+        @param[in] textMsg  the reason
+        """
+        if self.queuedMoveCmd is not None:
+            if not self.queuedMoveCmd.isDone:
+                self.queuedMoveCmd.setState(self.queuedMoveCmd.Failed, textMsg)
+            self.queuedMoveCmd = None
 
     def homeCallback(self):
-        self.getStatus()
-        self.writeToUsers("i", self.status.statusStr, cmd=self.fwHomeCmd)
+        self.getStatus().addCallback(self._homeDone)
+
+    def _homeDone(self, dummy):
+        """Finish the home command once the status is updated
+        """
+        self.writeStatus(self.fwHomeCmd)
         if self.fwHomeCmd.isDone:
             # don't do anything (probably cancelled by a stop?)
             return
@@ -214,80 +457,159 @@ class ArcticFWActor(Actor):
         else:
             self.fwHomeCmd.setState(self.fwHomeCmd.Failed, "Failed to stop at home sensor")
 
-    def cmd_move(self, userCmd):
+    def cmd_move(self, userCmd, queued=False):
+        """Move to a filter
+
+        @param[in] userCmd  the move command
+        @param[in] queued  the move waited for the one before it, see startQueuedMove
+        """
+        def fail(textMsg):
+            if queued:
+                textMsg = "queued move cancelled: %s"%(textMsg,)
+            userCmd.setState(userCmd.Failed, textMsg)
         desPos = int(userCmd.parsedCommand.parsedPositionalArgs[0])
         log.info("%s.cmd_move(userCmd=%s) desPos: %i"%(self, userCmd, desPos))
         # print("%s.cmd_move(userCmd=%s) desPos: %i"%(self, userCmd, desPos))
         if desPos not in self.MoveRange:
             # raise ParseError("desPos must be one of %s for move command"%(str(self.MoveRange),))
-            userCmd.setState(userCmd.Failed, "desPos must be one of %s for move command"%(str(self.MoveRange),))
+            fail("desPos must be one of %s for move command"%(str(self.MoveRange),))
+        elif not self.status.isReady:
+            fail("filter wheel is not initialized")
+        elif not self.fwHomeCmd.isDone:
+            fail("filter wheel is homing")
         elif not self.status.isHomed:
-            userCmd.setState(userCmd.Failed, "cannot command move, home filter wheel first.")
+            fail("cannot command move, home filter wheel first.")
+        elif not self.fwMoveCmd.isDone and not self.queueMoves:
+            fail("filter wheel is moving")
         elif not self.fwMoveCmd.isDone:
-            userCmd.setState(userCmd.Failed, "filter wheel is moving")
+            # latest wins
+            supersededStr = "superseded by a move to filter %i"%(desPos,)
+            self.supersedeQueuedMove(supersededStr)
+            if retargetMove(desPos):
+                self.fwMoveCmd.setState(self.fwMoveCmd.Failed, supersededStr)
+                self.fwMoveCmd = userCmd
+                if not self.fwMoveCmd.isActive:
+                    self.fwMoveCmd.setState(self.fwMoveCmd.Running)
+                self.writeStatus(userCmd, changedOnly=False, kwList=["state", "cmdFilterID"])
+            else:
+                self.queuedMoveCmd = userCmd
+                if not userCmd.isActive:
+                    userCmd.setState(userCmd.Running)
         elif desPos == self.status.currentPos:
             userCmd.setState(userCmd.Done, "Filter currently in position")
         else:
-            # get a fresh status
-            self.getStatus()
             self.fwMoveCmd = userCmd
             if not self.fwMoveCmd.isActive:
                 self.fwMoveCmd.setState(self.fwMoveCmd.Running)
-            moveToFilter(desPos)
-            self.getStatus()
-            self.writeToUsers("i", self.status.moveStr, cmd=userCmd)
+            # the move starts from a fresh status
+            def started(refusal):
+                if refusal is None:
+                    self.writeStatus(userCmd, changedOnly=False, kwList=["state", "cmdFilterID"])
+                else:
+                    if not userCmd.isDone:
+                        fail(refusal)
+                    self.startQueuedMove()
+            def failed(failure):
+                if not userCmd.isDone:
+                    fail(failure.getErrorMessage())
+                self.startQueuedMove()
+            moveToFilter(desPos).addCallbacks(started, failed)
         return True
 
+    def diffuCallback(self, result, userCmd):
+        """Called when a diffuser command's sensor confirms or times out
+
+        @param[in] result  measured transition time, or a Failure holding the reason
+        @param[in] userCmd  the diffuser command
+        """
+        if isinstance(result, Failure) and result.check(defer.CancelledError):
+            # superseded, see cmd_stopDiffuRot
+            return
+        def finish(dummy):
+            self.writeStatus(userCmd)
+            if userCmd.isDone:
+                # superseded by another diffuser command
+                return
+            if isinstance(result, Failure):
+                userCmd.setState(userCmd.Failed, str(result.value))
+            else:
+                userCmd.setState(userCmd.Done)
+        # the sensor has just changed, so read it
+        self.getStatus(maxAge=0).addCallback(finish)
+
+    def startDiffuCmd(self, userCmd, setFunc):
+        """Begin a diffuser command, completed by diffuCallback
+        """
+        self.diffuCmd = userCmd
+        if not self.diffuCmd.isActive:
+            self.diffuCmd.setState(self.diffuCmd.Running)
+        self.diffuWait = setFunc()
+        self.diffuWait.addBoth(self.diffuCallback, userCmd)
+
+    def diffuStatusFailed(self, failure, userCmd):
+        """Fail a diffuser command whose status check could not be read
+        """
+        userCmd.setState(userCmd.Failed, "status update failed: %s"%(failure.value,))
+
     def cmd_diffuIn(self, userCmd):
         """Move the diffuser into the beam
         """
-	log.info("%s.cmd_diffuIn(userCmd=%s)"%(self,userCmd))
-	if self.status.diffuCover == 0:
-	        setDiffuserIn()
-		time.sleep(3)
-        	self.getStatus()
-	        self.writeToUsers("i", self.status.statusStr, cmd=userCmd)
-        	userCmd.setState(userCmd.Done)
-	
+        log.info("%s.cmd_diffuIn(userCmd=%s)"%(self,userCmd))
+        def check(dummy):
+            # the cover may have been put on since the last status
+            if self.status.diffuCover != 0:
+                userCmd.setState(userCmd.Failed, "Diffuser cover is on")
+            elif not self.diffuCmd.isDone:
+                userCmd.setState(userCmd.Failed, "diffuser is moving")
+            else:
+                self.startDiffuCmd(userCmd, setDiffuserIn)
+        self.getStatus(maxAge=0).addCallbacks(check, self.diffuStatusFailed, errbackArgs=(userCmd,))
         return True
 
     def cmd_diffuOut(self, userCmd):
         """Move the diffuser out of the beam
         """
-        setDiffuserOut()
-        self.getStatus()
-        self.writeToUsers("i", self.status.statusStr, cmd=userCmd)
-        userCmd.setState(userCmd.Done)
+        log.info("%s.cmd_diffuOut(userCmd=%s)"%(self,userCmd))
+        if not self.diffuCmd.isDone:
+            userCmd.setState(userCmd.Failed, "diffuser is moving")
+        else:
+            self.startDiffuCmd(userCmd, setDiffuserOut)
         return True
 
     def cmd_startDiffuRot(self, userCmd):
-        """Move the diffuser into the beam
+        """Begin rotating the diffuser
         """
-	if self.status.diffuserIn == 1:
-		setRotationStart()
-		self.getStatus()
-		self.writeToUsers("i", self.status.statusStr, cmd=userCmd)
-		userCmd.setState(userCmd.Done)
-	else:#functionaly this works but the status below never makes it back to the users in the hub or on the gui.
-		self.writeToUsers("f", "Diffuser is not in Beam", cmd=userCmd)
-		self.getStatus()
-		userCmd.setState(userCmd.Failed)
-
+        log.info("%s.cmd_startDiffuRot(userCmd=%s)"%(self,userCmd))
+        def check(dummy):
+            # the diffuser may have left the beam since the last status
+            if self.status.diffuserIn != 1:
+                self.writeToUsers("f", "Diffuser is not in Beam", cmd=userCmd)
+                userCmd.setState(userCmd.Failed)
+            elif not self.diffuCmd.isDone:
+                userCmd.setState(userCmd.Failed, "diffuser is moving")
+            else:
+                self.startDiffuCmd(userCmd, setRotationStart)
+        self.getStatus(maxAge=0).addCallbacks(check, self.diffuStatusFailed, errbackArgs=(userCmd,))
         return True
 
     def cmd_stopDiffuRot(self, userCmd):
-	#always allow diffuser to stop
-	setRotationStop()
-	self.getStatus()
-	self.writeToUsers("i", self.status.statusStr, cmd=userCmd)
-	userCmd.setState(userCmd.Done)
+        """Stop rotating the diffuser
+        """
+        log.info("%s.cmd_stopDiffuRot(userCmd=%s)"%(self,userCmd))
+        #always allow diffuser to stop
+        if not self.diffuCmd.isDone:
+            self.diffuCmd.setState(self.diffuCmd.Failed, "diffuser rotation stop commanded")
+            self.diffuWait.cancel()
+        self.startDiffuCmd(userCmd, setRotationStop)
         return True
 
 
     def cmd_home(self, userCmd):
         log.info("%s.cmd_home(userCmd=%s)"%(self, str(userCmd)))
         # print("%s.cmd_home(userCmd=%s)"%(self, str(userCmd)))
-        if False in [self.fwMoveCmd.isDone, self.fwHomeCmd]:
+        if not self.status.isReady:
+            userCmd.setState(userCmd.Failed, "filter wheel is not initialized")
+        elif False in [self.fwMoveCmd.isDone, self.fwHomeCmd.isDone]:
             userCmd.setState(userCmd.Failed, "filter wheel is moving")
         else:
             self.fwHomeCmd = userCmd
@@ -295,7 +617,121 @@ class ArcticFWActor(Actor):
                 self.fwHomeCmd.setState(self.fwHomeCmd.Running)
             home()
             self.cmd_status(userCmd, setDone=False)
+        return True
+
+    def cmd_sequence(self, userCmd):
+        """! Run a sequence of filter moves, diffuser changes, waits and trigger points
+
+        The steps (see sequence.py) are planned into stages run one after another.
+        seqStep is output as each step begins and seqStepDone as it ends,
+        then seqStepTimes gives the seconds taken by every step, NaN if skipped.
+        @param[in]  userCmd  a twistedActor command with a parsedCommand attribute
+        """
+        log.info("%s.cmd_sequence(userCmd=%s)"%(self, str(userCmd)))
+        args = userCmd.parsedCommand.parsedPositionalArgs
+        try:
+            steps = parseSequence(args[0] if args else "")
+        except ValueError as e:
+            userCmd.setState(userCmd.Failed, "bad sequence: %s"%(e,))
             return True
+        if not self.seqCmd.isDone:
+            userCmd.setState(userCmd.Failed, "a sequence is running")
+            return True
+        self.seqCmd = userCmd
+        if not self.seqCmd.isActive:
+            self.seqCmd.setState(self.seqCmd.Running)
+        stages = planSequence(steps)
+        skipped = [str(step.index) for step in steps if step.skipped]
+        if skipped:
+            self.writeToUsers("i", "seqSkippedSteps=%s"%(",".join(skipped),), cmd=userCmd)
+        self.runSequence(userCmd, steps, stages, device.clock.seconds())
+        return True
+
+    def runSequence(self, userCmd, steps, stages, tStart):
+        """! Run the remaining stages of a sequence, one after another
+
+        @param[in] userCmd  the sequence command
+        @param[in] steps  all the sequence's SequenceSteps
+        @param[in] stages  the stages to run, each a list of SequenceSteps run together
+        @param[in] tStart  clock time the sequence began
+        """
+        if userCmd.isDone:
+            # stopped
+            return
+        if not stages:
+            self.writeToUsers("i", "seqStepTimes=%s; seqTime=%.2f"%(
+                ",".join("NaN" if step.time is None else "%.2f"%step.time for step in steps),
+                device.clock.seconds() - tStart,
+            ), cmd=userCmd)
+            userCmd.setState(userCmd.Done)
+            return
+        def stageDone(dummy):
+            self.runSequence(userCmd, steps, stages[1:], tStart)
+        def stageFailed(failure):
+            failure.trap(defer.FirstError)
+            if not userCmd.isDone:
+                userCmd.setState(userCmd.Failed, str(failure.value.subFailure.value))
+        stepDs = [self.runSequenceStep(userCmd, step, len(steps)) for step in stages[0]]
+        defer.gatherResults(stepDs, consumeErrors=True).addCallbacks(stageDone, stageFailed)
+
+    def runSequenceStep(self, userCmd, step, nSteps):
+        """! Begin a step of a sequence
+
+        Moves and diffuser changes are dispatched as the actor's own commands.
+        @param[in] userCmd  the sequence command
+        @param[in] step  the SequenceStep
+        @param[in] nSteps  number of steps in the sequence
+        @return a deferred fired when the step is done, or errs back with the reason it failed
+        """
+        self.writeToUsers("i", 'seqStep=%i,%i,"%s"'%(step.index, nSteps, step.cmdStr), cmd=userCmd)
+        tStep = device.clock.seconds()
+        d = defer.Deferred()
+        def stepDone(dummy):
+            step.time = device.clock.seconds() - tStep
+            self.writeToUsers("i", "seqStepDone=%i,%.2f"%(step.index, step.time), cmd=userCmd)
+        d.addCallback(stepDone)
+        if step.kind == SequenceStep.Wait:
+            self.seqWait = device.clock.callLater(step.value, d.callback, None)
+        elif step.kind == SequenceStep.Trigger:
+            self.seqTrigger = d
+        else:
+            stepCmd = UserCmd(userID=userCmd.userID, cmdStr=step.cmdStr)
+            def stepCmdCallback(stepCmd):
+                if not stepCmd.isDone or d.called:
+                    return
+                if stepCmd.didFail:
+                    d.errback(RuntimeError("step %i %r failed: %s"%(step.index, step.cmdStr, stepCmd.textMsg)))
+                else:
+                    d.callback(None)
+            stepCmd.addCallback(stepCmdCallback)
+            self.parseAndDispatchCmd(stepCmd)
+        return d
+
+    def stopSequence(self, textMsg):
+        """! Fail the sequence running, if any
+
+        @param[in] textMsg  the reason
+        """
+        if self.seqWait is not None and self.seqWait.active():
+            self.seqWait.cancel()
+        self.seqWait = None
+        self.seqTrigger = None
+        if not self.seqCmd.isDone:
+            self.seqCmd.setState(self.seqCmd.Failed, textMsg)
+
+    def cmd_trigger(self, userCmd):
+        """! Continue the sequence waiting at a trigger step
+        @param[in]  userCmd  a twistedActor command with a parsedCommand attribute
+        """
+        log.info("%s.cmd_trigger(userCmd=%s)"%(self, str(userCmd)))
+        if self.seqTrigger is None:
+            userCmd.setState(userCmd.Failed, "no sequence is waiting for a trigger")
+        else:
+            d = self.seqTrigger
+            self.seqTrigger = None
+            userCmd.setState(userCmd.Done)
+            d.callback(None)
+        return True
 
     def cmd_status(self, userCmd=None, setDone=True):
         """! Implement the status command
@@ -303,17 +739,126 @@ class ArcticFWActor(Actor):
         """
         log.info("%s.cmd_status(userCmd=%s)"%(self, str(userCmd)))
         userCmd = expandUserCmd(userCmd)
-        self.getStatus()
-        self.writeToUsers("i", self.status.statusStr, cmd=userCmd)
-        if setDone:
+        def write(dummy):
+            self.writeStatus(userCmd, changedOnly=False)
+            if setDone:
+                userCmd.setState(userCmd.Done)
+        def failed(failure):
+            if setDone and not userCmd.isDone:
+                userCmd.setState(userCmd.Failed, "status update failed: %s"%(failure.value,))
+        self.getStatus().addCallbacks(write, failed)
+        return True
+
+    def cmd_subscribe(self, userCmd):
+        """! Choose the status keywords output to this client and how often
+
+        Without keywords the client gets them all, without interval as soon as they change.
+        @param[in]  userCmd  a twistedActor command with a parsedCommand attribute
+        """
+        log.info("%s.cmd_subscribe(userCmd=%s)"%(self, str(userCmd)))
+        kwList = None
+        interval = 0
+        for parsedKeyword in userCmd.parsedCommand.parsedKeywords:
+            if parsedKeyword.keyword == "keywords":
+                kwList = [kw for kw in ",".join(parsedKeyword.valueList).split(",") if kw]
+            elif parsedKeyword.keyword == "interval":
+                interval = float(parsedKeyword.valueList[0])
+        knownKws = [kw for kw, getValue, formatValue in self.status.Keywords]
+        unknownKws = [kw for kw in kwList or [] if kw not in knownKws]
+        if unknownKws:
+            userCmd.setState(userCmd.Failed, "unknown status keywords: %s"%(", ".join(unknownKws),))
+        elif interval < 0:
+            userCmd.setState(userCmd.Failed, "interval must not be negative")
+        else:
+            oldSub = self.subscriptions.get(userCmd.userID)
+            if oldSub is not None:
+                oldSub.cancel()
+            sub = StatusSubscription(kwList, interval)
+            self.subscriptions[userCmd.userID] = sub
+            # start the client off with all its keywords
+            self.writeSubscription(userCmd.userID, sub, userCmd, changedOnly=False)
             userCmd.setState(userCmd.Done)
         return True
 
-    def getStatus(self):
+    def writeStatus(self, userCmd, changedOnly=None, kwList=None):
+        """! Output the status
+
+        Until a client subscribes (see cmd_subscribe) the status is formatted
+        once and written to every client.  After that each client gets the
+        changed keywords it subscribed to, no more often than it asked, and
+        changedOnly applies only to the client that sent userCmd; clients
+        that haven't subscribed get the changedOnly given to the constructor.
+
+        @param[in] userCmd  the command the output is for
+        @param[in] changedOnly  only output the keywords changed since they were last output,
+            if None use the changedOnly given to the constructor
+        @param[in] kwList  keywords to output, all if None
+        """
+        if changedOnly is None:
+            changedOnly = self.changedOnly
+        if not self.subscriptions:
+            statusStr = self.status.publishStr(kwList, changedOnly=changedOnly)
+            if statusStr:
+                self.writeToUsers("i", statusStr, cmd=userCmd)
+            return
+        for userID in self.subscriptions.keys():
+            if userID not in self.userDict:
+                # client disconnected
+                self.subscriptions.pop(userID).cancel()
+        now = device.clock.seconds()
+        for userID in self.userDict.keys():
+            sub = self.subscriptions.get(userID)
+            if sub is None:
+                # not subscribed, it has had what every client has had
+                sub = StatusSubscription(published=dict(self.status.published), changedOnly=self.changedOnly)
+                self.subscriptions[userID] = sub
+            if userID == userCmd.userID and not changedOnly:
+                # asked for it
+                self.writeSubscription(userID, sub, userCmd, changedOnly=False, kwList=kwList)
+            elif sub.isDue(now):
+                self.writeSubscription(userID, sub, userCmd)
+            elif sub.pending is None:
+                sub.pending = device.clock.callLater(sub.lastTime + sub.interval - now, self.writeSubscription, userID, sub)
+
+    def writeSubscription(self, userID, sub, userCmd=None, changedOnly=None, kwList=None):
+        """! Output the status a client subscribed to
+
+        @param[in] userID  the client's user ID
+        @param[in] sub  the client's StatusSubscription
+        @param[in] userCmd  the command the output is for, or None
+        @param[in] changedOnly  only output the keywords changed since the client last got them,
+            if None use the subscription's changedOnly
+        @param[in] kwList  keywords to output, of those subscribed to; all if None
+        """
+        if changedOnly is None:
+            changedOnly = sub.changedOnly
+        if kwList is None:
+            kwList = sub.kwList
+        elif sub.kwList is not None:
+            kwList = [kw for kw in sub.kwList if kw in kwList]
+        if kwList is None or kwList == sub.kwList:
+            sub.cancel()
+        if userID not in self.userDict:
+            return
+        statusStr = self.status.publishStr(kwList, changedOnly=changedOnly, published=sub.published)
+        if not statusStr:
+            return
+        sub.lastTime = device.clock.seconds()
+        if userCmd is not None and userCmd.userID == userID:
+            self.writeToOneUser("i", statusStr, cmd=userCmd)
+        else:
+            self.writeToOneUser("i", statusStr, userID=userID, cmdID=0)
+
+    def getStatus(self, maxAge=None):
         """! A generic status command
-        @param[in] userCmd a twistedActor UserCmd or none
+
+        Device moves confirm the hall with their own live reads, so a
+        status up to maxAge old is good enough here.
+
+        @param[in] maxAge  seconds old the status may be, None for the default, 0 to read the hardware
+        @return a deferred fired once the status is updated
         """
-        self.status.update()
+        return self.status.update(maxAge)
 
 
 
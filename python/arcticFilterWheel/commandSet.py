@@ -2,7 +2,7 @@
 """
 from __future__ import division, absolute_import
 
-from twistedActor.parse import Command, CommandSet, Int
+from twistedActor.parse import Command, CommandSet, Int, Float, String, Keyword, KeywordValue, RestOfLineString
 
 __all__ = ["arcticFWCommandSet"]
 
@@ -27,12 +27,48 @@ arcticFWCommandSet = CommandSet(
         ),
         Command(
             commandName = "initialize",
-            helpStr = "Initialize the filter wheel."
+            keywordArguments = [
+                Keyword(
+                    keyword = "force",
+                    isMandatory = False,
+                    helpStr = "Initialize the motor controller even if it is ready.",
+                ),
+            ],
+            helpStr = "Initialize the filter wheel, and the motor controller if its initialization failed."
         ),
         Command(
             commandName = "status",
             helpStr = "Query filter wheel for status."
         ),
+        Command(
+            commandName = "subscribe",
+            keywordArguments = [
+                KeywordValue(
+                    keyword = "keywords",
+                    value = String(helpStr="comma separated status keywords"),
+                    isMandatory = False,
+                    helpStr = "Status keywords to output to this client, all of them if omitted.",
+                ),
+                KeywordValue(
+                    keyword = "interval",
+                    value = Float(helpStr="seconds"),
+                    isMandatory = False,
+                    helpStr = "Minimum time between status outputs to this client, no minimum if omitted.",
+                ),
+            ],
+            helpStr = "Choose the status keywords output to this client and how often."
+        ),
+        Command(
+            commandName = "sequence",
+            positionalArguments = [
+                RestOfLineString(helpStr="steps separated by ;, each one of: move N, diffuIn, diffuOut, startDiffuRot, stopDiffuRot, wait SEC, trigger")
+            ],
+            helpStr = "Run a sequence of filter moves, diffuser changes, waits and trigger points."
+        ),
+        Command(
+            commandName = "trigger",
+            helpStr = "Continue a sequence waiting at a trigger step."
+        ),
         Command(
             commandName = "ping",
             helpStr = "Show alive."
@@ -10,25 +10,85 @@ import socket #hack here
 
 HOST=socket.gethostname()
 if HOST != "arctic-icc.apo.nmsu.edu":
-	os.nice(-15)
+	try:
+		os.nice(-15)
+	except OSError:
+		pass # not privileged, eg running against a fake device
 
 import sys
 import time
+import json
 import functools
+import collections
 import numpy
-from ctypes import CDLL, c_char_p
+from ctypes import CDLL, Structure, POINTER, c_char_p, c_int, c_uint
 
 from twisted.internet import reactor, defer
-from twisted.internet import task
+from twisted.internet import task, threads
+from twisted.internet.interfaces import IReadDescriptor
+from twisted.python.failure import Failure
+from twisted.python.threadpool import ThreadPool
+from zope.interface import implementer
+
+from .sampler import HallSampler
 
 # hall effects were measured to have a typical width of 30-35 steps
 # spacing between hall effects were in the range [1290,1370] steps
 
 FILT_MAX_DIST = 1500 # amonut of steps to drive to find next filter
-STATUS_POLL = 1 #seconds
+# the status is polled every STATUS_POLL_ACTIVE seconds while the wheel
+# or diffuser moves.  At rest the time between polls grows by
+# STATUS_POLL_BACKOFF each poll, up to STATUS_POLL_IDLE
+STATUS_POLL_ACTIVE = 0.2 # seconds
+STATUS_POLL_IDLE = 5 # seconds
+STATUS_POLL_BACKOFF = 2
+STATUS_POLL = STATUS_POLL_ACTIVE # seconds to the next status poll
+STATUS_CALL = None # delayed call of the next status poll
+DIFFU_WAITS = 0 # diffuser transitions in progress
 MOVE_DIR = None
 MOVE_COUNTER = 0
 MOVE_COUNTER_TARGET = None
+# when the hall positions have been learned during a home,
+# move straight to the target hall center in a single move
+DIRECT_MOVE = True
+# when hall positions are not known, drive past intermediate
+# halls (counting them) rather than stopping at each one
+PASS_THROUGH_MOVE = True
+# home by sweeping the wheel continuously through a bit more than
+# one revolution recording every hall edge, then return to home
+CONTINUOUS_HOME = True
+HOME_SWEEP_DIST = 7*FILT_MAX_DIST # enough to see 7 complete halls
+# run the stop at hall loop in a native thread (device.c) rather
+# than polling from the reactor
+NATIVE_HALL_WATCH = True
+HALL_WATCH_POLL = 500 # microseconds between native hall samples
+HALL_WATCH_STOP_FAILED = -2 # hallWatchResult() when the motor wasn't seen to stop after the STOP
+# when a move ends off a hall and the hall positions are known,
+# search for the commanded hall near where it should be before
+# giving up and requiring a home
+HALL_SEARCH = True
+HALL_SEARCH_DIST = 300 # steps either side of the expected hall center, under half the hall spacing
+HALL_SEARCH_SLOP = 35 # steps the wheel may stop past the search range, about a hall width
+# a direct move may be retargeted to a filter it has yet to reach by
+# stopping and carrying on to the new filter, as the controller won't
+# take a new target while moving
+RETARGET_MARGIN = 100 # steps the wheel must be short of the new filter's hall
+DIRECT_MOVING = False # a direct move is under way
+RETARGET_POS = None # position to carry on to once a retargeted move has stopped
+# sample the gpio from a separate high priority process (see sampler.py)
+# the native hall watch is not used while the sampler runs
+SAMPLER = False
+SAMPLER_MAX_AGE = 0.1 # seconds, age of the latest sample past which the sampler is taken as hung
+# diffuser commands complete when the sensor confirms
+DIFFU_POLL = 0.01 # seconds between diffuser sensor checks
+DIFFU_IN_TIMEOUT = 5 # seconds to move into the beam
+DIFFU_OUT_TIMEOUT = 5 # seconds to move out of the beam
+DIFFU_SPINUP_TIMEOUT = 10 # seconds to reach speed
+DIFFU_SPINDOWN_TIMEOUT = 10 # seconds to spin down
+# the last known wheel state is saved here, and restored on startup
+# if the wheel hasn't moved, so a restart doesn't require a home
+STATE_FILE = os.path.join(os.path.expanduser("~"), ".arcticFilterWheelState.json")
+RESTORE_ENC_TOL = 10 # encoder counts the wheel may differ from the saved position
 
 ### GPIO MAP
 # ev* code in evgpio.h
@@ -45,43 +105,205 @@ DIFFUPOS_IN = 81 # is the diffuser actually in position HED sensor = 0 = true
 DIFFUPOS_OUT = 82 #IS the diffuser out of position HED sensor  0 = true
 DIFFU_COVERSTATE = 79 #cover is off or on 1= off
 
+# dios read together in a single gpio snapshot
+# bit n of a snapshot holds the value of SNAPSHOT_DIOS[n]
+SNAPSHOT_DIOS = [
+    HALL_POS,
+    ID_1,
+    ID_2,
+    ID_4,
+    DIFFRPM_ISRUN,
+    DIFFU_COVERSTATE,
+    DIFFUPOS_IN,
+    DIFFUPOS_OUT,
+    DIFFUROT,
+]
+_snapshotDios = (c_int*len(SNAPSHOT_DIOS))(*SNAPSHOT_DIOS)
+
+class MotorState(Structure):
+    """Motor status, motor and encoder positions filled by
+    queryMotorState() in device.c.  An ok flag is 0 if its value
+    couldn't be read
+    """
+    _fields_ = [
+        ("mst", c_int),
+        ("px", c_int),
+        ("ex", c_int),
+        ("mstOk", c_int),
+        ("pxOk", c_int),
+        ("exOk", c_int),
+    ]
+_motorState = MotorState() # reused by every readMotorState()
 
 # initialization send to the stepper motor controller
-# 2nd (float) value indicates the time delay imposed after
-# sending the command
+# 2nd (float) value is the most time (seconds) allowed for the
+# controller to acknowledge the command, it is resent until it does
 motorInitList = [
-    ("ID", 0.1),
-    ("DN", 0.1),
-    ("ABS", 0.1),
-    ("DOBOOT=0", 0.1),
-    ("EDIO=0", 0.1),
-    ("POL=4", 0.1), # are POL required? we dont use
-    ("POL=6", 0.1),
-    ("POL=1", 0.1),
-    ("SCV=0", 0.1),
-    ("IERR=1", 0.1), # changed from 1
-    ("MST", 0.1),
-    ("RR", 2.5),
-    ("DRVRC=1500", 0.1),
-    ("RW", 2),
-    ("SL=1", 1), # disable sn loop
-    ("SLR=25", 2.5),
-    ("CLR", 0.1),
-    ("LSPD=10", 0.1),
-    ("HSPD=250", 0.1),
-    ("ACC=70", 0.1),
-    ("DEC=70", 0.1),
-    ("EO=1", 0.1), #power up the motor
+    ("ID", 1),
+    ("DN", 1),
+    ("ABS", 1),
+    ("DOBOOT=0", 1),
+    ("EDIO=0", 1),
+    ("POL=4", 1), # are POL required? we dont use
+    ("POL=6", 1),
+    ("POL=1", 1),
+    ("SCV=0", 1),
+    ("IERR=1", 1), # changed from 1
+    ("MST", 1),
+    ("RR", 5),
+    ("DRVRC=1500", 1),
+    ("RW", 5),
+    ("SL=1", 2), # disable sn loop
+    ("SLR=25", 5),
+    ("CLR", 1),
+    ("LSPD=10", 1),
+    ("HSPD=250", 1),
+    ("ACC=70", 1),
+    ("DEC=70", 1),
+    ("EO=1", 1), #power up the motor
 ]
+# init commands that only read, not needed to restore the settings
+QUERY_CMDS = ("ID", "DN", "MST")
+COMM_FLUSH_TIMEOUT = 10 # seconds to wait for the usb comms to flush
+# RR and RW read and write the settings in the controller's non
+# volatile memory.  The controller doesn't answer for a while after
+# either, then the variable given reads 1 if it succeeded
+NVM_COMMS_GAP = 2 # seconds
+NVM_RESULTS = {"RR": "R2", "RW": "R4"}
+INIT_RETRY = 0.05 # seconds between attempts at an init command
+USB_RETRIES = 2 # times a failed usb command is resent before giving up
+STOP_TIMEOUT = 2 # seconds to wait for the motor to stop
+# run the blocking usb calls in a single worker thread, so a slow
+# reply doesn't hold up the reactor.  One worker serializes usb access
+USB_THREAD = True
+USB_POOL = None # ThreadPool of the usb worker, when running
+USB_PENDING = collections.deque() # (deferred, func, args, kwargs) waiting for the usb worker
+USB_BUSY = False # a call is running in the usb worker
+# reopen the usb link when it stops answering, or is slow while
+# the wheel is idle.  The controller keeps running meanwhile
+USB_WATCHDOG = True
+WATCHDOG_POLL = 1 # seconds between watchdog checks
+USB_FAIL_LIMIT = 5 # consecutive failed usb commands before reconnecting
+USB_LATENCY_LIMIT = 0.1 # seconds, mean reply time above which an idle link is reconnected
+USB_LATENCY_WEIGHT = 0.1 # weight of each reply in the mean reply time
+WATCHDOG_MAX_WAIT = 60 # seconds, longest wait between reconnects of a link that stays bad
+WATCHDOG_LOOP = None # task.LoopingCall running the watchdog
+RECONNECTING = False
+LAST_RECONNECT = None # time of the last reconnect
+RECONNECT_WAIT = 0 # seconds to wait before reconnecting again
+HALL_WATCH_READER = None # HallWatchReader of a running native hall watch
+HOME_EDGES = [] # hall edges (encPos, rising, wheelID) seen while step homing
 
-if HOST != "arctic-icc.apo.nmsu.edu":
-	fwDIR = os.environ["ARCTICFILTERWHEEL_DIR"]
-	soPath = os.path.join(fwDIR,"src/device.so")
-	device = CDLL(soPath)
-	device.getUSBReply.restype = c_char_p
+# src/device.so, loaded by init() unless replaced with setDevice()
+device = None
+
+# schedules all polling and timing, the reactor unless
+# replaced with setClock(), eg by a task.Clock for virtual time
+clock = reactor
+
+def loadDevice():
+    global device
+    fwDIR = os.environ["ARCTICFILTERWHEEL_DIR"]
+    soPath = os.path.join(fwDIR,"src/device.so")
+    # a CDLL (unlike a PyDLL) releases the GIL for the length of
+    # each call, so the reactor runs while the usb thread waits
+    device = CDLL(soPath)
+    device.getUSBReply.restype = c_char_p
+    device.getGPIO.restype = c_uint
+    device.queryMotorState.argtypes = [POINTER(MotorState), c_int]
+
+def setDevice(dev, stateFile=None):
+    # use dev in place of src/device.so, eg a fakeFilterWheel.FakeDevice.
+    # The wheel state is only saved and restored if a stateFile
+    # is given, so a fake never touches the real wheel's state
+    global device
+    global STATE_FILE
+    device = dev
+    STATE_FILE = stateFile
+
+def setClock(newClock):
+    # use newClock (eg a twisted.internet.task.Clock)
+    # in place of the reactor for all polling and timing
+    global clock
+    clock = newClock
+
+def loopingCall(func):
+    # a task.LoopingCall scheduled by clock
+    loop = task.LoopingCall(func)
+    loop.clock = clock
+    return loop
+
+def startUSBThread():
+    # start the usb worker thread.  It is not used in
+    # virtual time, where calls must finish as time is advanced
+    global USB_POOL
+    if not USB_THREAD or USB_POOL is not None or clock is not reactor:
+        return
+    USB_POOL = ThreadPool(minthreads=1, maxthreads=1, name="arcticFilterWheelUSB")
+    USB_POOL.start()
+    reactor.addSystemEventTrigger("during", "shutdown", stopUSBThread)
+
+def stopUSBThread():
+    global USB_POOL
+    global USB_BUSY
+    if USB_POOL is not None:
+        USB_POOL.stop()
+        USB_POOL = None
+    USB_PENDING.clear()
+    USB_BUSY = False
+
+def deferToUSB(func, *args, **kwargs):
+    # call func, which blocks on the usb link, in the usb thread.
+    # Calls are made one at a time in the order given, apart from
+    # those put first by deferToUSBFirst.  Returns a deferred fired
+    # with func's result.  Without the usb thread func is called
+    # right away
+    if USB_POOL is None or clock is not reactor:
+        return defer.maybeDeferred(func, *args, **kwargs)
+    d = defer.Deferred()
+    USB_PENDING.append((d, func, args, kwargs))
+    runNextUSB()
+    return d
+
+def deferToUSBFirst(func, *args, **kwargs):
+    # as deferToUSB, but func goes ahead of every call still
+    # waiting for the usb thread, eg to stop at a hall
+    if USB_POOL is None or clock is not reactor:
+        return defer.maybeDeferred(func, *args, **kwargs)
+    d = defer.Deferred()
+    USB_PENDING.appendleft((d, func, args, kwargs))
+    runNextUSB()
+    return d
+
+def runNextUSB():
+    # hand the next waiting call to the usb thread, once
+    # the one running there (if any) is done
+    global USB_BUSY
+    if USB_BUSY or not USB_PENDING or USB_POOL is None:
+        return
+    d, func, args, kwargs = USB_PENDING.popleft()
+    USB_BUSY = True
+    def ran(result):
+        global USB_BUSY
+        USB_BUSY = False
+        runNextUSB()
+        return result
+    dd = threads.deferToThreadPool(reactor, USB_POOL, func, *args, **kwargs)
+    dd.addBoth(ran)
+    dd.chainDeferred(d)
 
 class Status(object):
+    Initializing = "Initializing"
+    Ready = "Ready"
+    InitFailed = "Failed"
     def __init__(self):
+        self.reset()
+
+    def reset(self):
+        # back to the state before init, eg for a new simulated wheel
+        self.initState = None
+        self.initTime = None
+        self.initSteps = [] # (cmdStr, seconds) for each motor init command
         self.motorMoving = None
         self.motorPos = None
         self.encPos = None
@@ -89,10 +311,11 @@ class Status(object):
         self.wheelID = None
         self.inPosition = None
         self.diffuserIn = None
-	self.diffuserOut = None
-	self.diffuserRot = None
-	self.diffuserRPM = None
-	self.diffuserCover = None
+        self.diffuserOut = None
+        self.diffuserRot = None
+        self.diffuserRPM = None
+        self.diffuserCover = None
+        self.gpio = None
          
         self.isHomed = False
         self.targetPos = None
@@ -102,6 +325,23 @@ class Status(object):
         self.filterID = None
         self.cmdFilterID = None
         self.isMoving = False
+        # encoder position of each hall center (keyed by filterID)
+        # relative to home, learned while homing
+        self.hallPositions = {}
+        self.stepsPerRev = None
+        # measured seconds for the last diffuser transitions
+        # keyed by "in", "out", "spinUp", "spinDown"
+        self.diffuTimes = {}
+        # usb link health, for the watchdog
+        self.usbFailures = 0 # consecutive failed commands
+        self.usbLatency = None # mean reply time (sec)
+        self.usbReconnects = 0
+        self.lastEncPos = None # last encoder position read successfully
+        self.updateTime = None # clock time of the last update
+
+    @property
+    def hallPositionsKnown(self):
+        return len(self.hallPositions) == 6 and bool(self.stepsPerRev)
 
     @property
     def atHome(self):
@@ -118,16 +358,29 @@ class Status(object):
         self.moveCallback = moveCB
 
     def update(self):
-        self.motorMoving = motorStatus()!=0
-        self.motorPos = motorPos()
-        self.encPos = encPos()
-        self._wheelID = readWheelID()
-        self.inPosition = positionTriggered()
-        self.diffuserIn = diffuserInPos()
-	self.diffuserOut = diffuserOutPos()	
-        self.diffuserRot = diffuserRot()
-	self.diffuserRPM = getRotationStatus()
-	self.diffuserCover = diffuserCoverOn()
+        # read the controller in the usb thread, then the gpio.
+        # Returns a deferred fired with this status once updated
+        d = deferToUSB(readMotorState)
+        d.addCallback(self.setMotorState)
+        return d
+
+    def setMotorState(self, motorState):
+        mst, self.motorPos, self.encPos = motorState
+        self.updateTime = clock.seconds()
+        self.motorMoving = mst!=0
+        if self.encPos is not None:
+            self.lastEncPos = self.encPos
+        # read all gpio bits at once so they are consistent
+        gpio = readGPIO()
+        self.gpio = gpio
+        self._wheelID = readWheelID(gpio)
+        self.inPosition = positionTriggered(gpio)
+        self.diffuserIn = diffuserInPos(gpio)
+        self.diffuserOut = diffuserOutPos(gpio)
+        self.diffuserRot = diffuserRot(gpio)
+        self.diffuserRPM = getRotationStatus(gpio)
+        self.diffuserCover = diffuserCoverOn(gpio)
+        return self
 
     def __repr__(self):
         """blah
@@ -150,21 +403,71 @@ class Status(object):
 
 status = Status()
 
-def positionTriggered():
+sampler = None # HallSampler, when running
+SAMPLE_SEQ = 0 # next sampler sample to be checked for a hall
+
+def startSampler():
+    global sampler
+    sampler = HallSampler(_readGPIO, device.setGPIO)
+    sampler.start()
+    # don't read the gpio here once the sampler owns it
+    while sampler.latest() is None and sampler.isRunning:
+        time.sleep(0.001)
+
+def _readGPIO():
+    # read every dio in SNAPSHOT_DIOS with one native call
+    return device.getGPIO(_snapshotDios, len(SNAPSHOT_DIOS))
+
+def checkSampler():
+    # returns True if the sampler is in use.  A sampler whose
+    # process has died or whose latest sample is stale is
+    # stopped, and the gpio is read and set directly from then on
+    global sampler
+    if sampler is None:
+        return False
+    sample = sampler.latest()
+    if sampler.isRunning and sample is not None and time.time() - sample.time < SAMPLER_MAX_AGE:
+        return True
+    sampler.stop()
+    sampler = None
+    return False
+
+def readGPIO():
+    # returns the packed bitmask of every dio in SNAPSHOT_DIOS
+    # taken from the sampler process if it is running
+    if checkSampler():
+        return sampler.latest().gpio
+    return _readGPIO()
+
+def setGPIO(dio, value):
+    if checkSampler():
+        sampler.write(dio, value)
+    else:
+        device.setGPIO(dio, value)
+
+def gpioBit(snapshot, dio):
+    # extract the value of a dio from a gpio snapshot
+    return (snapshot >> SNAPSHOT_DIOS.index(dio)) & 1
+
+# the decoders below accept a snapshot from readGPIO(),
+# if none is supplied a fresh one is read
+
+def positionTriggered(snapshot=None):
     # goes low when hall is sensed
-    posBit = device.evgetin(HALL_POS)
-    # print("motor state", motorStatus())
-    # print("motor pos", motorPos())
-    # print("enc pos", encPos())
+    if snapshot is None:
+        snapshot = readGPIO()
+    posBit = gpioBit(snapshot, HALL_POS)
     return posBit==0
 
-def readWheelID():
+def readWheelID(snapshot=None):
     # return integer of filterwheel
     # return none, if sensors not triggered
     # 0 indicates bit in place so invert it
-    oneBit = 1 - device.evgetin(ID_1)
-    twoBit = 1 - device.evgetin(ID_2)
-    fourBit = 1 - device.evgetin(ID_4)
+    if snapshot is None:
+        snapshot = readGPIO()
+    oneBit = 1 - gpioBit(snapshot, ID_1)
+    twoBit = 1 - gpioBit(snapshot, ID_2)
+    fourBit = 1 - gpioBit(snapshot, ID_4)
     fwID = int("%i%i%i"%(fourBit,twoBit,oneBit),2)
     if fwID in [0,1]:
         # not in place
@@ -172,168 +475,695 @@ def readWheelID():
     return fwID
 
 #status of the rotation bit
-def diffuserRot():
-    rotBit = device.evgetin(DIFFUROT)
+def diffuserRot(snapshot=None):
+    if snapshot is None:
+        snapshot = readGPIO()
+    rotBit = gpioBit(snapshot, DIFFUROT)
     return rotBit == 1
 
-def diffuserCoverOn():
-    coverBit = device.evgetin(DIFFU_COVERSTATE)
+def diffuserCoverOn(snapshot=None):
+    if snapshot is None:
+        snapshot = readGPIO()
+    coverBit = gpioBit(snapshot, DIFFU_COVERSTATE)
     return coverBit == 0
 
-def diffuserInPos():
+def diffuserInPos(snapshot=None):
     # return true if diffuser is in position
     # actually check sensor here to determine if it is in or out.
 
     #posBit = device.evgetin(DIFFU)  
-    inPosBit = device.evgetin(DIFFUPOS_IN)
+    if snapshot is None:
+        snapshot = readGPIO()
+    inPosBit = gpioBit(snapshot, DIFFUPOS_IN)
 
     return inPosBit==0 # 0 bit means true
 
-def diffuserOutPos(): 
-    outPosBit = device.evgetin(DIFFUPOS_OUT)
+def diffuserOutPos(snapshot=None): 
+    if snapshot is None:
+        snapshot = readGPIO()
+    outPosBit = gpioBit(snapshot, DIFFUPOS_OUT)
     return outPosBit==0 # 0 bit means true
 
 #there is lgoic to these sets, and that is determined in the arcticFWActor.py
 
-#delays put in to give it time to update the states...
-def setDiffuserIn():
-    device.evsetdata(DIFFU, 1)  
+def diffuserSensorStr(snapshot=None):
+    # summary of the diffuser sensors for failure messages
+    if snapshot is None:
+        snapshot = readGPIO()
+    return "inSensor=%i outSensor=%i atSpeed=%i"%(
+        diffuserInPos(snapshot),
+        diffuserOutPos(snapshot),
+        getRotationStatus(snapshot),
+    )
+
+def waitFor(condition, timeout, name, failStr):
+    # poll condition (a function of a gpio snapshot) every
+    # DIFFU_POLL seconds without blocking
+    # the returned deferred fires with the measured time once it is
+    # met, which is also saved in status.diffuTimes[name].  If it
+    # isn't met within timeout seconds the deferred errs back with
+    # failStr and the state of the sensors.  Cancelling the deferred,
+    # eg when the command is superseded, ends the wait
+    global DIFFU_WAITS
+    def cancel(d):
+        global DIFFU_WAITS
+        if loop.running:
+            loop.stop()
+            DIFFU_WAITS -= 1
+    d = defer.Deferred(cancel)
+    tStart = clock.seconds()
+    status.diffuTimes[name] = None
+    DIFFU_WAITS += 1
+    pollSoon()
+    def check():
+        global DIFFU_WAITS
+        gpio = readGPIO()
+        elapsed = clock.seconds() - tStart
+        if condition(gpio):
+            loop.stop()
+            DIFFU_WAITS -= 1
+            status.diffuTimes[name] = elapsed
+            d.callback(elapsed)
+        elif elapsed > timeout:
+            loop.stop()
+            DIFFU_WAITS -= 1
+            d.errback(RuntimeError("%s within %.1f seconds (%s)"%(failStr, timeout, diffuserSensorStr(gpio))))
+    loop = loopingCall(check)
+    loop.start(DIFFU_POLL)
+    return d
+
+# each of these returns a deferred fired when the sensor confirms
+# or errs back with the failure reason on timeout
+def setDiffuserIn(timeout=DIFFU_IN_TIMEOUT):
+    setGPIO(DIFFU, 1)  
+    return waitFor(diffuserInPos, timeout, "in", "Diffuser failed to reach in beam sensor")
 
-def setDiffuserOut():
-    device.evsetdata(DIFFU, 0)
-    time.sleep(.5) 
+def setDiffuserOut(timeout=DIFFU_OUT_TIMEOUT):
+    setGPIO(DIFFU, 0)
+    return waitFor(diffuserOutPos, timeout, "out", "Diffuser failed to reach out of beam sensor")
 
-def setRotationStart():
-    device.evsetdata(DIFFUROT, 1)  
-    time.sleep(4.5)
+def setRotationStart(timeout=DIFFU_SPINUP_TIMEOUT):
+    setGPIO(DIFFUROT, 1)  
+    return waitFor(getRotationStatus, timeout, "spinUp", "Diffuser failed to reach speed")
 
-def setRotationStop():
-    device.evsetdata(DIFFUROT, 0)
-    time.sleep(3)
+def setRotationStop(timeout=DIFFU_SPINDOWN_TIMEOUT):
+    setGPIO(DIFFUROT, 0)
+    return waitFor(lambda gpio: not getRotationStatus(gpio), timeout, "spinDown", "Diffuser failed to spin down")
 
-def getRotationStatus(): #this should return what the rotation is set to and if it is to RPM or not at a higher level.
-    rpmBit = device.evgetin(DIFFRPM_ISRUN)
+def getRotationStatus(snapshot=None): #this should return what the rotation is set to and if it is to RPM or not at a higher level.
+    if snapshot is None:
+        snapshot = readGPIO()
+    rpmBit = gpioBit(snapshot, DIFFRPM_ISRUN)
     return rpmBit==1 # 1 bit means true
 
-def motorPos():
-    success = device.sendCmd("PX")
+def sendCmd(cmdStr):
+    # send a usb command
+    tStart = clock.seconds()
+    success = device.sendCmd(cmdStr)
+    recordUSB(success, clock.seconds() - tStart)
+    return success
+
+def recordUSB(success, latency):
+    # keep track of consecutive failures and the
+    # mean reply time (sec) for the watchdog
     if success == -1:
+        status.usbFailures += 1
+        return
+    status.usbFailures = 0
+    if status.usbLatency is None:
+        status.usbLatency = latency
+    else:
+        status.usbLatency += USB_LATENCY_WEIGHT*(latency - status.usbLatency)
+
+def query(cmdStr):
+    # send a command that is safe to repeat, resending it up to
+    # USB_RETRIES times on usb failure.  Returns the reply, or None
+    for ii in range(USB_RETRIES + 1):
+        if sendCmd(cmdStr) != -1:
+            return device.getUSBReply()
+    return None
+
+def motorPos():
+    reply = query("PX")
+    if reply is None:
         return None
-    return float(device.getUSBReply())
+    return float(reply)
 
 def encPos():
-    success = device.sendCmd("EX")
-    if success == -1:
+    reply = query("EX")
+    if reply is None:
         return None
-    return float(device.getUSBReply())
+    return float(reply)
 
-def setPos(pos):
-    # set motor and encoder pos
-    success = device.sendCmd("PX=%i"%pos)
-    if success == -1:
+def sendPos(pos):
+    # set motor and encoder pos, blocks on usb
+    if query("PX=%i"%pos) is None:
         return None
-    success = device.sendCmd("EX=%i"%pos)
-    if success == -1:
+    if query("EX=%i"%pos) is None:
         return None
     return True
 
+def setPos(pos):
+    # returns a deferred fired with True if set
+    def isSet(success):
+        if success:
+            # so the encoder isn't seen to jump, eg by reconnect()
+            status.motorPos = status.encPos = status.lastEncPos = float(pos)
+        return success
+    return deferToUSB(sendPos, pos).addCallback(isSet)
+
 def motorStatus():
-    success = device.sendCmd("MST")
-    if success == -1:
+    reply = query("MST")
+    if reply is None:
         return None
-    return int(device.getUSBReply())
+    return int(reply)
+
+def readMotorState():
+    # (motor status, motor pos, encoder pos) read with a single
+    # native call, None for any that couldn't be read.  Blocks on usb
+    state = _motorState
+    tStart = clock.seconds()
+    success = device.queryMotorState(state, USB_RETRIES)
+    # three replies
+    recordUSB(success, (clock.seconds() - tStart)/3.)
+    return (
+        state.mst if state.mstOk else None,
+        float(state.px) if state.pxOk else None,
+        float(state.ex) if state.exOk else None,
+    )
 
 def motorOn():
     cmdStr = "EO=1"
-    success = device.sendCmd(cmdStr)
+    success = sendCmd(cmdStr)
     return success == 1
 
 def motorOff():
     cmdStr="EO=0"
-    success = device.sendCmd(cmdStr)
+    success = sendCmd(cmdStr)
     return success == 1
 
-def stop():
-    cmdStr = "STOP"
-    success = device.sendCmd(cmdStr)
-    ### blocks but who cares, its very short
+def sendStop():
+    success = query("STOP") is not None
+    ### blocks the usb thread until stopped, its very short
+    tStart = clock.seconds()
     while motorStatus() != 0:
-        pass
-    return success == 1
+        if clock.seconds() - tStart > STOP_TIMEOUT:
+            return False
+    return success
 
-def connect():
-    device.connect()
-    while True:
-        out=device.commFlush()
-        if out==-1:
-            time.sleep(1)
+def stop(first=False):
+    # returns a deferred fired with True once the motor has stopped.
+    # A stop cancels any retarget of the move.  If first the stop
+    # goes ahead of the usb calls waiting, only for a move known
+    # to be under way, as a move waiting would start after it
+    global RETARGET_POS
+    RETARGET_POS = None
+    if first:
+        return deferToUSBFirst(sendStop)
+    return deferToUSB(sendStop)
+
+def retryUntil(func, timeout, failStr):
+    # call func every INIT_RETRY seconds without blocking until it
+    # returns True.  The returned deferred fires with the elapsed
+    # time, or errs back with failStr after timeout seconds
+    d = defer.Deferred()
+    tStart = clock.seconds()
+    def attempt():
+        deferToUSB(func).addCallbacks(check, failed)
+    def failed(failure):
+        # func raised, which counts as a failed attempt
+        check(False)
+    def check(success):
+        if success:
+            d.callback(clock.seconds() - tStart)
+        elif clock.seconds() - tStart > timeout:
+            d.errback(RuntimeError("%s within %.1f seconds"%(failStr, timeout)))
         else:
-            break
-    for cmdStr, delay in motorInitList:
-        device.sendCmd(cmdStr)
-        time.sleep(delay)
+            clock.callLater(INIT_RETRY, attempt)
+    clock.callLater(0, attempt)
+    return d
+
+def sendVerified(cmdStr):
+    # send a command, true if the controller
+    # replied without an error (which begins with ?)
+    if sendCmd(cmdStr) == -1:
+        return False
+    return not device.getUSBReply().startswith("?")
+
+def nvmSucceeded(resultName):
+    # true if the RR or RW result variable reads 1
+    reply = query(resultName)
+    return reply is not None and reply.strip() == "1"
+
+def sendInitCmd(cmdStr, timeout):
+    # send an init command, resending it until acknowledged
+    # within timeout seconds.  After RR or RW wait out the comms
+    # gap, then for the result variable to read 1.  Returns a
+    # deferred fired with the elapsed time
+    tStart = clock.seconds()
+    failStr = "Motor controller did not acknowledge %s"%cmdStr
+    d = retryUntil(functools.partial(sendVerified, cmdStr), timeout, failStr)
+    if cmdStr in NVM_RESULTS:
+        resultName = NVM_RESULTS[cmdStr]
+        failStr = "Motor controller %s failed, %s did not read 1"%(cmdStr, resultName)
+        d.addCallback(lambda dummy: task.deferLater(clock, NVM_COMMS_GAP, lambda: None))
+        d.addCallback(lambda dummy: retryUntil(functools.partial(nvmSucceeded, resultName), timeout, failStr))
+    d.addCallback(lambda dummy: clock.seconds() - tStart)
+    return d
+
+def connect(reopenLink=False):
+    # open the usb link (close and reopen it if reopenLink), then
+    # flush and send motorInitList without blocking, verifying
+    # every reply.  The step timing is kept in status.initSteps.
+    # Returns a deferred fired when all commands were
+    # acknowledged, or errs back with the first that wasn't
+    status.initSteps = []
+    d = deferToUSB(reopen if reopenLink else device.connect)
+    d.addCallback(lambda dummy: retryUntil(lambda: device.commFlush() != -1, COMM_FLUSH_TIMEOUT, "Motor controller comms did not flush"))
+    def recordStep(elapsed, cmdStr):
+        status.initSteps.append((cmdStr, elapsed))
+    def sendStep(dummy, cmdStr, timeout):
+        return sendInitCmd(cmdStr, timeout)
+    d.addCallback(recordStep, "flush")
+    for cmdStr, timeout in motorInitList:
+        d.addCallback(sendStep, cmdStr, timeout)
+        d.addCallback(recordStep, cmdStr)
+    return d
 
 def disconnect():
+    return deferToUSB(device.disconnect)
+
+def restoreSettings():
+    # resend the motorInitList settings the controller no longer
+    # has, eg after a power cycle, in the order init sends them.
+    # Every setting is compared first, at its last place in the
+    # list as the last value set is the one that counts.  If none
+    # were lost only ABS and CLR are resent, sparing the non
+    # volatile memory a write.  Otherwise the mode commands are all
+    # resent, RR and RW verified as by init, so settings after RR
+    # are compared with the ones it read and DRVRC is written by the
+    # RW after it.  Returns a deferred fired when done, or erring
+    # back with the first not acknowledged
+    lastInd = dict((cmdStr.split("=", 1)[0], ind) for ind, (cmdStr, timeout) in enumerate(motorInitList) if "=" in cmdStr)
+    settings = [motorInitList[ind][0].split("=", 1) for ind in sorted(lastInd.values())]
+    def restore(lost):
+        d = defer.succeed(None)
+        for ind, (cmdStr, timeout) in enumerate(motorInitList):
+            if cmdStr in QUERY_CMDS:
+                continue
+            if "=" not in cmdStr:
+                if lost or cmdStr not in NVM_RESULTS:
+                    d.addCallback(restoreMode, cmdStr, timeout)
+                continue
+            name, value = cmdStr.split("=", 1)
+            if lost and lastInd[name] == ind:
+                d.addCallback(restoreSetting, name, value, timeout)
+        return d
+    return deferToUSB(settingsLost, settings).addCallback(restore)
+
+def settingsLost(settings):
+    # true if any of the (name, value) settings doesn't read back
+    # as value, or couldn't be read.  Blocks on usb
+    for name, value in settings:
+        reply = query(name)
+        if reply is None or reply.strip() != value:
+            return True
+    return False
+
+def restoreMode(dummy, cmdStr, timeout):
+    return sendInitCmd(cmdStr, timeout)
+
+def restoreSetting(dummy, name, value, timeout):
+    def check(reply):
+        if reply is not None and reply.strip() == value:
+            return None
+        return sendInitCmd("%s=%s"%(name, value), timeout)
+    return deferToUSB(query, name).addCallback(check)
+
+def reopen():
+    # close and reopen the usb link, blocks on usb
     device.disconnect()
+    device.connect()
 
+def reconnect():
+    # close and reopen the usb link and restore lost settings.
+    # The homed state is kept if the encoder hasn't moved.  A
+    # native hall watch is ended by the disconnect, so its move is
+    # stopped and finished from wherever the wheel is.
+    # Returns a deferred fired when done
+    global RECONNECTING
+    global HALL_WATCH_READER
+    RECONNECTING = True
+    status.usbReconnects += 1
+    lastEncPos = status.lastEncPos
+    wasMoving = status.isMoving or status.isHoming
+    reader = HALL_WATCH_READER
+    if reader is not None:
+        reactor.removeReader(reader)
+        HALL_WATCH_READER = None
+    d = deferToUSB(reopen)
+    d.addCallback(lambda dummy: retryUntil(lambda: device.commFlush() != -1, COMM_FLUSH_TIMEOUT, "Motor controller comms did not flush"))
+    d.addCallback(lambda dummy: restoreSettings())
+    def checkMoved(pos):
+        if pos is None or lastEncPos is None or abs(pos - lastEncPos) > RESTORE_ENC_TOL:
+            status.isHomed = False
+            status.filterID = None
+    def done(result):
+        global RECONNECTING
+        RECONNECTING = False
+        status.usbFailures = 0
+        status.usbLatency = None
+        dd = defer.succeed(None)
+        if not wasMoving and status.isHomed and not isinstance(result, Failure):
+            dd = deferToUSB(encPos).addCallback(checkMoved)
+        if reader is not None:
+            dd.addCallback(lambda dummy: stop())
+            dd.addCallback(lambda dummy: reader.d.callback(0))
+        # a failed reconnect is tried again by the watchdog
+        return dd
+    d.addBoth(done)
+    return d
 
-def move(absPos):
+def checkWatchdog():
+    # reconnect a bad link, waiting twice as long
+    # each time it is still bad after reconnecting
+    global RECONNECT_WAIT
+    global LAST_RECONNECT
+    if RECONNECTING or status.initState == status.Initializing:
+        return
+    idle = not status.isMoving and not status.isHoming
+    slow = status.usbLatency is not None and status.usbLatency > USB_LATENCY_LIMIT
+    if status.usbFailures < USB_FAIL_LIMIT and not (slow and idle):
+        RECONNECT_WAIT = 0
+        return
+    if LAST_RECONNECT is not None and clock.seconds() - LAST_RECONNECT < RECONNECT_WAIT:
+        return
+    RECONNECT_WAIT = min(max(2*RECONNECT_WAIT, WATCHDOG_POLL), WATCHDOG_MAX_WAIT)
+    LAST_RECONNECT = clock.seconds()
+    reconnect()
+
+def beginWatchdog():
+    # (re)start the usb watchdog, forgetting past reconnects
+    global WATCHDOG_LOOP
+    global LAST_RECONNECT
+    global RECONNECT_WAIT
+    if WATCHDOG_LOOP is not None and WATCHDOG_LOOP.running:
+        WATCHDOG_LOOP.stop()
+    LAST_RECONNECT = None
+    RECONNECT_WAIT = 0
+    WATCHDOG_LOOP = loopingCall(checkWatchdog)
+    WATCHDOG_LOOP.start(WATCHDOG_POLL)
+
+
+def sendMove(absPos):
     # success = motorOn()
     # if not success:
     #     return
     # joe put a CLR command here...I'm not
+    # returns True if the move was started, blocks on usb
+    if absPos is None:
+        return False
     cmdStr = "X%i"%absPos
-    success = device.sendCmd(cmdStr)
+    for ii in range(USB_RETRIES + 1):
+        success = sendCmd(cmdStr)
+        if success != -1:
+            break
+        # the command or its reply was lost.  If the motor is
+        # moving it got through, else it is safe to resend,
+        # as the position is absolute
+        if motorStatus():
+            success = 1
+            break
     status.targetPos = absPos
     targetDir = 1
-    if absPos < status.encPos:
+    if status.encPos is not None and absPos < status.encPos:
         targetDir = -1
     status.targetDir = targetDir
     return success == 1
 
-def stopNext(d):
-    # stop at next sensed hall
+def move(absPos):
+    # returns a deferred fired with True if the move was started
+    return deferToUSB(sendMove, absPos)
+
+def startMove(absPos, follow, failed=None):
+    # start a move to absPos, then call follow() to see it
+    # through, or failed() (default moveFailed) if it wasn't started
+    def started(success):
+        if success:
+            follow()
+        elif failed is None:
+            moveFailed()
+        else:
+            failed()
+    return move(absPos).addCallback(started)
+
+@implementer(IReadDescriptor)
+class HallWatchReader(object):
+    """Fire a deferred with the number of halls seen
+    when the native hall watch thread is done
+    """
+    def __init__(self, d):
+        self.d = d
+
+    def fileno(self):
+        return device.hallWatchFd()
+
+    def doRead(self):
+        global HALL_WATCH_READER
+        reactor.removeReader(self)
+        HALL_WATCH_READER = None
+        result = device.hallWatchResult()
+        if result == HALL_WATCH_STOP_FAILED:
+            # the thread's usb calls don't go through sendCmd,
+            # so let the watchdog know
+            recordUSB(-1, 0)
+            self.d.errback(RuntimeError("motor was not seen to stop at the hall"))
+        else:
+            self.d.callback(result)
+
+    def connectionLost(self, reason):
+        reactor.removeReader(self)
+
+    def logPrefix(self):
+        return "HallWatchReader"
+
+def stopNext(d, nHalls=1):
+    global HALL_WATCH_READER
+    if NATIVE_HALL_WATCH and sampler is None and device.hallWatchStart(HALL_POS, nHalls, HALL_WATCH_POLL) == 1:
+        HALL_WATCH_READER = HallWatchReader(d)
+        reactor.addReader(HALL_WATCH_READER)
+    else:
+        pollStopNext(d, nHalls)
+
+def hallSamples():
+    # hall readings since the last call, every sample taken by
+    # the sampler if it is running, else a single fresh reading
+    global SAMPLE_SEQ
+    if not checkSampler():
+        return [positionTriggered()]
+    samples, SAMPLE_SEQ = sampler.samplesSince(SAMPLE_SEQ)
+    return [positionTriggered(sample.gpio) for sample in samples]
+
+def pollStopNext(d, nHalls=1):
+    # stop at the nHalls'th sensed hall
     # must go from low to high
     # incase we start on a hall
+    # intermediate halls must be seen going low to high
+    # and back to low to be counted
+    # d is called back with the number of halls seen
     global GOT_LOW
+    global HALL_COUNT
     global LOOP_CALL
+    global SAMPLE_SEQ
     GOT_LOW = False
+    HALL_COUNT = 0
+    if sampler is not None:
+        SAMPLE_SEQ = sampler.count.value
     def checkBit():
         global GOT_LOW
-        inPos = positionTriggered()
-        if not GOT_LOW and not inPos:
-            GOT_LOW = True
-        elif GOT_LOW and inPos:
-            LOOP_CALL.stop()
-            stop()
-            d.callback(None)
-        elif motorStatus() == 0:
+        global HALL_COUNT
+        for inPos in hallSamples():
+            if not GOT_LOW and not inPos:
+                GOT_LOW = True
+            elif GOT_LOW and inPos:
+                HALL_COUNT += 1
+                if HALL_COUNT < nHalls:
+                    # passing an intermediate hall, keep going
+                    GOT_LOW = False
+                else:
+                    LOOP_CALL.stop()
+                    hallCount = HALL_COUNT
+                    stop(first=True).addCallback(stopped, hallCount)
+                    return
+        return deferToUSB(motorStatus).addCallback(checkStopped)
+    def stopped(success, hallCount):
+        if success:
+            d.callback(hallCount)
+        else:
+            d.errback(RuntimeError("motor was not seen to stop at the hall"))
+    def checkStopped(mst):
+        if mst == 0:
             try:
                 LOOP_CALL.stop()
-                d.callback(None) # should be error back?
+                d.callback(HALL_COUNT) # should be error back?
             except:
                 pass # may have been called if user commanded a stop
-    LOOP_CALL = task.LoopingCall(checkBit)
+    LOOP_CALL = loopingCall(checkBit)
     LOOP_CALL.start(0.02)
 
 
-def checkPosition(dummy):
-    global MOVE_COUNTER
-    global MOVE_COUNTER_TARGET
-    status.update()
-    MOVE_COUNTER += 1
-    if not status.inPosition:
-        status.isHomed = False
+def waitStop(d):
+    # fire deferred when the motor reports it has stopped
+    global LOOP_CALL
+    def checkStopped(mst):
+        if mst == 0:
+            try:
+                LOOP_CALL.stop()
+                d.callback(None)
+            except:
+                pass # may have been called if user commanded a stop
+    LOOP_CALL = loopingCall(lambda: deferToUSB(motorStatus).addCallback(checkStopped))
+    LOOP_CALL.start(0.02)
+
+def saveState():
+    # atomically save the wheel state to STATE_FILE
+    # filterID is saved as None unless the wheel is homed and at rest
+    # returns a deferred fired when saved
+    if STATE_FILE is None:
+        return defer.succeed(None)
+    atRest = status.isHomed and not status.isMoving and not status.isHoming
+    state = {
+        "filterID": status.filterID if atRest else None,
+        "wheelID": status.wheelID,
+        "encPos": None, # read below, position may have just been reset
+        "hallPositions": status.hallPositions,
+        "stepsPerRev": status.stepsPerRev,
+        "time": time.time(),
+    }
+    def write(pos):
+        state["encPos"] = pos
+        tmpFile = STATE_FILE + ".tmp"
+        try:
+            with open(tmpFile, "w") as f:
+                json.dump(state, f)
+                f.flush()
+                os.fsync(f.fileno())
+            os.rename(tmpFile, STATE_FILE)
+        except (IOError, OSError):
+            pass # can't save, a home will be needed after restart
+    return deferToUSB(encPos).addCallback(write)
+
+def restoreState():
+    # restore the homed state from STATE_FILE if the hall and wheel id
+    # sensors and the encoder agree with it.  Returns a deferred
+    # fired with True if restored
+    if STATE_FILE is None:
+        return defer.succeed(False)
+    try:
+        with open(STATE_FILE, "r") as f:
+            state = json.load(f)
+    except (IOError, OSError, ValueError):
+        return defer.succeed(False)
+    if state.get("filterID") is None:
+        return defer.succeed(False)
+    def check(dummy):
+        if not status.inPosition or status.encPos is None:
+            return False
+        # the wheel id bits are only seen at home (filter 1)
+        if status.atHome != (state["filterID"] == 1):
+            return False
+        if status.atHome and status._wheelID != state["wheelID"]:
+            return False
+        if state["encPos"] is None or abs(status.encPos - state["encPos"]) > RESTORE_ENC_TOL:
+            return False
+        status.isHomed = True
+        status.filterID = state["filterID"]
+        status.cmdFilterID = state["filterID"]
+        status.wheelID = state["wheelID"]
+        status.hallPositions = dict((int(filterID), pos) for filterID, pos in state["hallPositions"].items())
+        status.stepsPerRev = state["stepsPerRev"]
+        return True
+    return status.update().addCallback(check)
+
+def afterUpdate(result):
+    # refresh the status, then pass result on
+    return status.update().addCallback(lambda dummy: result)
+
+def moveDone():
+    saveState()
+    status.moveCallback()
+
+def moveFailed():
+    # a move could not be started, so the wheel is where it was.
+    # A move leaves the filter as it was, a home is left unfinished
+    status.isMoving = False
+    if status.isHoming:
         status.isHoming = False
-        status.isMoving = False
+        status.isHomed = False
         status.filterID = None
-        if status.isHoming:
-            status.homeCallback()
-        else:
-            status.moveCallback()
+        homeDone()
+    else:
+        moveDone()
+
+def positionLost(failure=None):
+    # the wheel stopped off a hall, or wasn't seen to stop
+    # (failure), so its position is lost and a home is needed
+    wasHoming = status.isHoming
+    status.isHomed = False
+    status.isHoming = False
+    status.isMoving = False
+    status.filterID = None
+    if wasHoming:
+        homeDone()
+    else:
+        moveDone()
+
+def homeDone():
+    saveState()
+    status.homeCallback()
+
+def keepHomeEdges(edges):
+    # add the hall edges seen by a step of a step home, which
+    # stops at the first hall, to those seen by the earlier steps
+    HOME_EDGES.extend(edges)
+    return 1
+
+def learnHallCenters():
+    # the hall centers from the edges seen while stepping once around
+    # from home (see keepHomeEdges): home's rising edge, both edges of
+    # each hall and home's rising edge again.  Returns the home hall
+    # center, the hall centers relative to it keyed by filterID and
+    # the steps per revolution, or None if the edges don't make sense
+    halls = hallsFromEdges(HOME_EDGES)
+    rises = [pos for pos, rising, wheelID in HOME_EDGES if rising]
+    if len(halls) < 6 or len(rises) < 7:
+        return None
+    homeCenter = halls[0][0]
+    stepsPerRev = rises[6] - rises[0]
+    hallPositions = dict((filterID, halls[filterID - 1][0] - homeCenter) for filterID in range(1, 7))
+    spacings = numpy.diff([hallPositions[filterID] for filterID in range(1, 7)] + [stepsPerRev])
+    if min(spacings) <= 0:
+        return None
+    return homeCenter, hallPositions, stepsPerRev
+
+def checkPosition(nHalls):
+    # called with a fresh status (see afterUpdate)
+    global MOVE_COUNTER
+    global MOVE_COUNTER_TARGET
+    # count at least this stop, as the wheel may
+    # have started the move on a hall
+    MOVE_COUNTER += nHalls or 1
+    if not status.inPosition and canSearch():
+        searchHall()
+    elif not status.inPosition:
+        positionLost()
     elif MOVE_COUNTER < MOVE_COUNTER_TARGET:
         #another move wanted
-        if status.atHome:
+        if status.atHome and not status.hallPositionsKnown:
+            if status.isHoming and status.encPos is not None:
+                # keep the home hall's rising edge, in the new encoder frame
+                rises = [(pos - status.encPos, rising, wheelID) for pos, rising, wheelID in HOME_EDGES if rising]
+                HOME_EDGES[:] = rises[-1:]
             setPos(0)
             if status.isHoming and status.filterID is None:
                 status.setWheelID()
@@ -356,7 +1186,16 @@ def checkPosition(dummy):
                 status.isHomed = True
                 status.filterID = 1
                 status.setWheelID()
-            status.homeCallback()
+                learned = learnHallCenters() if status.encPos is not None else None
+                if learned is None:
+                    # moves will count halls
+                    setPos(0)
+                else:
+                    # zero the encoder at the home hall's center,
+                    # as the hall positions are relative to it
+                    homeCenter, status.hallPositions, status.stepsPerRev = learned
+                    setPos(int(round(status.encPos - homeCenter)))
+            homeDone()
         else:
             # this is a move command, set filter id and callback
             filterID = status.filterID + MOVE_DIR*MOVE_COUNTER
@@ -365,20 +1204,202 @@ def checkPosition(dummy):
             elif filterID <= 0:
                 filterID += 6
             status.filterID = filterID
-            status.moveCallback()
+            moveDone()
 
 def beginStatusLoop():
-    l = task.LoopingCall(status.update)
-    l.start(STATUS_POLL)
+    # (re)start the periodic status update
+    global STATUS_CALL
+    global STATUS_POLL
+    if STATUS_CALL is not None and STATUS_CALL.active():
+        STATUS_CALL.cancel()
+    STATUS_POLL = STATUS_POLL_ACTIVE
+    pollStatus()
 
-def offsetFilter():
-    status.update()
-    currPos = status.encPos
-    nextPos = currPos + MOVE_DIR*FILT_MAX_DIST
+def pollStatus():
+    global STATUS_CALL
+    STATUS_CALL = None
+    status.update().addBoth(scheduleStatusPoll)
+
+def statusActive():
+    # true while the status is changing
+    return status.isMoving or status.isHoming or bool(status.motorMoving) or DIFFU_WAITS > 0
+
+def scheduleStatusPoll(result):
+    # poll again quickly while anything moves, else back off
+    global STATUS_CALL
+    global STATUS_POLL
+    if statusActive():
+        STATUS_POLL = STATUS_POLL_ACTIVE
+    else:
+        STATUS_POLL = min(STATUS_POLL*STATUS_POLL_BACKOFF, STATUS_POLL_IDLE)
+    # a restart may have raced a poll, keep only one scheduled
+    if STATUS_CALL is not None and STATUS_CALL.active():
+        STATUS_CALL.cancel()
+    STATUS_CALL = None
+    if status.initState == status.Initializing:
+        return result # init restarts the loop when done
+    STATUS_CALL = clock.callLater(STATUS_POLL, pollStatus)
+    return result
+
+def pollSoon():
+    # poll quickly from now on, something is about to move
+    global STATUS_POLL
+    STATUS_POLL = STATUS_POLL_ACTIVE
+    if STATUS_CALL is not None and STATUS_CALL.active() \
+        and STATUS_CALL.getTime() - clock.seconds() > STATUS_POLL_ACTIVE:
+        STATUS_CALL.reset(STATUS_POLL_ACTIVE)
+
+def statusAge():
+    # seconds since the status was updated, None if never
+    if status.updateTime is None:
+        return None
+    return clock.seconds() - status.updateTime
+
+def refreshStatus():
+    # a one-off status update, eg when a command arrives,
+    # which speeds up polling.  Returns a deferred fired
+    # with the status once updated
+    pollSoon()
+    return status.update()
+
+def checkDirectMove(dummy):
+    # confirm the hall at the end of a direct move
+    global DIRECT_MOVING
+    global RETARGET_POS
+    if RETARGET_POS is not None:
+        # stopped to be retargeted, carry on to the new filter
+        absPos = RETARGET_POS
+        RETARGET_POS = None
+        startDirectMove(absPos)
+        return
+    DIRECT_MOVING = False
+    if not status.inPosition and canSearch():
+        searchHall()
+        return
+    status.isMoving = False
+    if not status.inPosition:
+        status.isHomed = False
+        status.filterID = None
+    else:
+        status.filterID = status.cmdFilterID
+    moveDone()
+
+def canSearch():
+    # a move (not a home) from a known filter, with the
+    # hall positions known, may search for a missed hall
+    return HALL_SEARCH and status.isHomed and not status.isHoming \
+        and status.hallPositionsKnown and status.encPos is not None
+
+def expectedHallPos(filterID):
+    # encoder position of the center of filterID's
+    # hall nearest to the wheel, from the learned positions
+    center = status.hallPositions[filterID]
+    return center + numpy.round((status.encPos - center)/status.stepsPerRev)*status.stepsPerRev
+
+def searchHall():
+    # the wheel stopped off a hall during a move.  Look for the
+    # commanded filter's hall within HALL_SEARCH_DIST of where
+    # it should be: back up, then drive forward through the
+    # search range stopping at the first hall
+    expected = expectedHallPos(status.cmdFilterID)
     d = defer.Deferred()
-    d.addCallback(checkPosition)
-    move(nextPos)
-    stopNext(d)
+    d.addCallback(afterUpdate)
+    d.addCallback(searchSweep, expected)
+    startMove(expected - MOVE_DIR*HALL_SEARCH_DIST, functools.partial(waitStop, d), hallNotFound)
+
+def searchSweep(dummy, expected):
+    if status.inPosition:
+        # backed up onto it
+        checkSearch(0, expected)
+        return
+    d = defer.Deferred()
+    d.addCallback(afterUpdate)
+    d.addCallbacks(checkSearch, lambda failure: hallNotFound(), callbackArgs=(expected,))
+    startMove(expected + MOVE_DIR*HALL_SEARCH_DIST, functools.partial(stopNext, d, 1), hallNotFound)
+
+def checkSearch(nHalls, expected):
+    # home is the only hall showing the wheel id
+    atHome = status.cmdFilterID == 1
+    if status.inPosition and status.atHome == atHome and abs(status.encPos - expected) <= HALL_SEARCH_DIST + HALL_SEARCH_SLOP:
+        # found it
+        status.isMoving = False
+        status.filterID = status.cmdFilterID
+        moveDone()
+    else:
+        hallNotFound()
+
+def hallNotFound():
+    # the wheel position is lost, a home is needed
+    status.isMoving = False
+    status.isHomed = False
+    status.filterID = None
+    moveDone()
+
+def directMove():
+    # move to the learned hall center of the commanded filter
+    # with a single move, going in MOVE_DIR, from a fresh status
+    if status.encPos is None:
+        moveFailed()
+        return
+    absPos = expectedHallPos(status.cmdFilterID)
+    if MOVE_DIR*(absPos - status.encPos) < 0:
+        absPos += MOVE_DIR*status.stepsPerRev
+    startDirectMove(absPos)
+
+def startDirectMove(absPos):
+    global DIRECT_MOVING
+    DIRECT_MOVING = True
+    d = defer.Deferred()
+    d.addCallback(afterUpdate)
+    d.addCallback(checkDirectMove)
+    startMove(absPos, functools.partial(waitStop, d))
+
+def retargetMove(filterID):
+    # end the direct move under way at filterID instead, if the
+    # wheel has yet to reach filterID's hall on its way to the
+    # commanded one.  Returns True if retargeted
+    global RETARGET_POS
+    if not (DIRECT_MOVING and status.isMoving and status.isHomed) or status.isHoming:
+        return False
+    if filterID not in status.hallPositions or status.targetPos is None or status.encPos is None:
+        return False
+    # steps short of the commanded hall the new one is, going in MOVE_DIR
+    shortBy = (MOVE_DIR*(status.hallPositions[status.cmdFilterID] - status.hallPositions[filterID])) % status.stepsPerRev
+    absPos = status.targetPos - MOVE_DIR*shortBy
+    if shortBy == 0 or MOVE_DIR*(absPos - status.encPos) < RETARGET_MARGIN:
+        return False
+    status.cmdFilterID = filterID
+    stop()
+    RETARGET_POS = absPos
+    return True
+
+def hallsToNextStop():
+    # number of halls to drive through before stopping
+    # homing always stops at each hall to read the wheel id
+    if PASS_THROUGH_MOVE and not status.isHoming:
+        return max(MOVE_COUNTER_TARGET - MOVE_COUNTER, 1)
+    return 1
+
+def offsetFilter():
+    # move on from a fresh encoder position, it may have just been reset
+    nHalls = hallsToNextStop()
+    def updated(dummy):
+        currPos = status.encPos
+        if currPos is None:
+            moveFailed()
+            return
+        nextPos = currPos + MOVE_DIR*FILT_MAX_DIST*nHalls
+        d = defer.Deferred()
+        if status.isHoming:
+            # record the hall edges, to learn the hall centers
+            d.addCallback(keepHomeEdges)
+            follow = functools.partial(recordEdges, d, True)
+        else:
+            follow = functools.partial(stopNext, d, nHalls)
+        d.addCallback(afterUpdate)
+        d.addCallbacks(checkPosition, positionLost)
+        startMove(nextPos, follow)
+    status.update().addCallback(updated)
 
 def home():
     global MOVE_DIR
@@ -387,38 +1408,173 @@ def home():
     MOVE_DIR = 1
     MOVE_COUNTER_TARGET = 7 # be sure to detect all filters
     MOVE_COUNTER = 0
+    pollSoon()
+    # usb calls are made in order, so this is done before the move
     setPos(0)
     status.isHoming = True
     status.isMoving = True
     status.filterID = None
-    offsetFilter()
+    status.hallPositions = {}
+    status.stepsPerRev = None
+    HOME_EDGES[:] = []
+    if CONTINUOUS_HOME:
+        sweepHome()
+    else:
+        offsetFilter()
+
+def recordEdges(d, stopAtHall=False):
+    # sample the hall and wheel id bits along with the encoder
+    # until the motor stops, recording every hall edge as
+    # (encPos, rising, wheelID).  The edge position is taken
+    # midway between the samples either side of it, the wheel
+    # id is the one read on the hall.  If stopAtHall the motor
+    # is stopped at the first rising edge.
+    # d is called back with the list of edges
+    global EDGES
+    global LAST_SAMPLE
+    global LOOP_CALL
+    EDGES = []
+    LAST_SAMPLE = None
+    def readSample():
+        # the hall read alongside the encoder in the usb thread
+        return readGPIO(), encPos(), motorStatus()
+    def sample(reading):
+        global LAST_SAMPLE
+        gpio, pos, mst = reading
+        inPos = positionTriggered(gpio)
+        wheelID = readWheelID(gpio)
+        # a sample without the encoder is skipped, an
+        # edge in it is found at the next good sample
+        if pos is not None:
+            if LAST_SAMPLE is not None:
+                lastInPos, lastWheelID, lastPos = LAST_SAMPLE
+                if inPos and not lastInPos:
+                    EDGES.append(((pos + lastPos)/2., True, wheelID))
+                    if stopAtHall and len([edge for edge in EDGES if edge[1]]) == 1:
+                        stop(first=True)
+                elif lastInPos and not inPos:
+                    EDGES.append(((pos + lastPos)/2., False, lastWheelID))
+            LAST_SAMPLE = (inPos, wheelID, pos)
+        if mst == 0:
+            try:
+                LOOP_CALL.stop()
+                d.callback(EDGES)
+            except:
+                pass # may have been called if user commanded a stop
+    LOOP_CALL = loopingCall(lambda: deferToUSB(readSample).addCallback(sample))
+    LOOP_CALL.start(0.02)
+
+def hallsFromEdges(edges):
+    # pair rising and falling edges into complete halls
+    # returns a list of (center, wheelID) in sweep order
+    halls = []
+    rise = None
+    for pos, rising, wheelID in edges:
+        if rising:
+            rise = (pos, wheelID)
+        elif rise is not None:
+            if wheelID is None:
+                wheelID = rise[1]
+            halls.append(((rise[0] + pos)/2., wheelID))
+            rise = None
+    return halls
+
+def sweepHome():
+    # drive through a bit more than one revolution without stopping
+    def updated(dummy):
+        if status.encPos is None:
+            moveFailed()
+            return
+        d = defer.Deferred()
+        d.addCallback(checkSweep)
+        startMove(status.encPos + HOME_SWEEP_DIST, functools.partial(recordEdges, d))
+    status.update().addCallback(updated)
+
+def checkSweep(edges):
+    # work out the hall positions from a sweep and
+    # return to the center of the home hall
+    halls = hallsFromEdges(edges)
+    homes = [ii for ii, (center, wheelID) in enumerate(halls[:6]) if wheelID is not None]
+    if len(halls) < 7 or len(homes) != 1:
+        # couldn't make sense of the sweep, home one hall at a time
+        offsetFilter()
+        return
+    homeInd = homes[0]
+    homeCenter = halls[homeInd][0]
+    stepsPerRev = halls[6][0] - halls[0][0]
+    hallPositions = {}
+    for filterID in range(1, 7):
+        ind = homeInd + filterID - 1
+        if ind < len(halls):
+            center = halls[ind][0]
+        else:
+            center = halls[ind - 6][0] + stepsPerRev
+        hallPositions[filterID] = center - homeCenter
+    # return to the home hall nearest to the current position
+    def updated(dummy):
+        if status.encPos is None:
+            moveFailed()
+            return
+        nRevs = numpy.round((status.encPos - homeCenter)/stepsPerRev)
+        d = defer.Deferred()
+        d.addCallback(afterUpdate)
+        d.addCallback(checkSweepReturn, hallPositions, stepsPerRev)
+        startMove(homeCenter + nRevs*stepsPerRev, functools.partial(waitStop, d))
+    status.update().addCallback(updated)
+
+def checkSweepReturn(dummy, hallPositions, stepsPerRev):
+    status.isMoving = False
+    status.isHoming = False
+    if status.inPosition and status.atHome:
+        setPos(0)
+        status.isHomed = True
+        status.filterID = 1
+        status.setWheelID()
+        status.hallPositions = hallPositions
+        status.stepsPerRev = stepsPerRev
+    else:
+        # homing failed
+        status.isHomed = False
+        status.filterID = None
+    homeDone()
 
 def moveToFilter(filterID):
-    global MOVE_DIR
+    # returns a deferred fired once the move has been begun from a
+    # fresh status, with None, or with the reason it was refused.
+    # A refused move doesn't call the move callback
     global MOVE_COUNTER
-    global MOVE_COUNTER_TARGET
     MOVE_COUNTER = 0
-    status.update()
-    if filterID not in [1,2,3,4,5,6]:
-        return
-    if not status.isHomed:
-        return
-    if not status.inPosition:
-        return
-    if status.isMoving:
-        return
-    status.isMoving = True
-    status.cmdFilterID = filterID
-    currFilter = status.filterID
-    filtCounts = filterID - currFilter
-    MOVE_COUNTER_TARGET = numpy.abs(filtCounts)
-    MOVE_DIR = 1
-    if filtCounts < 0:
-        MOVE_DIR = -1
-    if MOVE_COUNTER_TARGET > 2:
-        MOVE_DIR = -1*MOVE_DIR
-        MOVE_COUNTER_TARGET = 6 - MOVE_COUNTER_TARGET
-    offsetFilter()
+    pollSoon()
+    def updated(dummy):
+        global MOVE_DIR
+        global MOVE_COUNTER_TARGET
+        global DIRECT_MOVING
+        if filterID not in [1,2,3,4,5,6]:
+            return "no filter %s"%(filterID,)
+        if not status.isHomed:
+            return "filter wheel is not homed"
+        if not status.inPosition:
+            return "filter wheel is not at a filter"
+        if status.isMoving:
+            return "filter wheel is moving"
+        DIRECT_MOVING = False
+        status.isMoving = True
+        status.cmdFilterID = filterID
+        currFilter = status.filterID
+        filtCounts = filterID - currFilter
+        MOVE_COUNTER_TARGET = numpy.abs(filtCounts)
+        MOVE_DIR = 1
+        if filtCounts < 0:
+            MOVE_DIR = -1
+        if MOVE_COUNTER_TARGET > 2:
+            MOVE_DIR = -1*MOVE_DIR
+            MOVE_COUNTER_TARGET = 6 - MOVE_COUNTER_TARGET
+        if DIRECT_MOVE and status.hallPositionsKnown:
+            directMove()
+        else:
+            offsetFilter()
+        return None
+    return status.update().addCallback(updated)
 
 def setupGPIO():
     # begin masking all
@@ -432,35 +1588,82 @@ def setupGPIO():
     device.evclrwatch()
 
 def init():
-    connect()
+    # returns a deferred fired when the motor controller is ready.
+    # gpio setup, and the sampler, go ahead of the motor controller
+    # handshake.  May be called again, eg after a failed init, when
+    # the usb link is reopened and the status polling and watchdog
+    # are paused until done
+    if device is None:
+        loadDevice()
+    reinit = status.initState is not None
+    status.initState = status.Initializing
+    status.initTime = None
+    tStart = clock.seconds()
+    if STATUS_CALL is not None and STATUS_CALL.active():
+        STATUS_CALL.cancel()
     setupGPIO()
-    stop()
-    status.isHomed = False
-    setPos(0)
-    status.update()
-    beginStatusLoop()
+    if SAMPLER and not reinit:
+        # fork the sampler before the usb thread starts, a child
+        # forked from a threaded process may inherit locked mutexes
+        startSampler()
+    startUSBThread()
+    d = connect(reopenLink=reinit)
+    def ready(dummy):
+        dd = stop()
+        dd.addCallback(lambda dummy: restoreState())
+        dd.addCallback(restored)
+        dd.addCallback(started)
+        return dd
+    def restored(wasRestored):
+        if not wasRestored:
+            status.isHomed = False
+            setPos(0)
+        return status.update()
+    def started(dummy):
+        status.initTime = clock.seconds() - tStart
+        status.initState = status.Ready
+        beginStatusLoop()
+        if USB_WATCHDOG:
+            beginWatchdog()
+        if not reinit:
+            reactor.addSystemEventTrigger("before", "shutdown", saveState)
+    def failed(failure):
+        status.initTime = clock.seconds() - tStart
+        status.initState = status.InitFailed
+        return failure
+    d.addCallbacks(ready, failed)
+    return d
 
 
 if __name__ == "__main__":
-    connect()
-    setupGPIO()
-    setPos(0)
-    status.update()
-    beginStatusLoop()
-    if len(sys.argv)==2:
+    # usage: device.py home | device.py POS
+    # home, then visit several filters, or move toward motor
+    # position POS stopping at the first hall sensed
+    def done(result=None):
+        def show(dummy):
+            print(status)
+            reactor.stop()
+        status.update().addBoth(show)
+    def visitFilters(filterIDs):
+        def nextMove():
+            if filterIDs:
+                moveToFilter(filterIDs.pop(0))
+            else:
+                done()
+        status.addMoveCallback(nextMove)
+        status.addHomeCallback(nextMove)
+        home()
+    def moveToHall(movePos):
+        d = defer.Deferred()
+        d.addBoth(done)
+        startMove(movePos, functools.partial(stopNext, d), failed=done)
+    def ready(dummy):
         if sys.argv[1].lower() == "home":
-            m6 = functools.partial(moveToFilter, 6)
-            m6 = functools.partial(moveToFilter, 1, m6)
-            m5 = functools.partial(moveToFilter, 6,m6)
-            m4 = functools.partial(moveToFilter, 1,m5)
-            m3 = functools.partial(moveToFilter, 2,m4)
-            m2 = functools.partial(moveToFilter, 6, m3)
-            m = functools.partial(moveToFilter, 3, m2)
-            home(m)
+            visitFilters([3, 6, 2, 1, 6, 1, 6])
         else:
-            movePos = int(sys.argv[1])
-            move(movePos)
-            stopNext()
+            moveToHall(int(sys.argv[1]))
+    if len(sys.argv)==2:
+        init().addCallbacks(ready, done)
         reactor.run()
 
 
@@ -1,89 +1,502 @@
+"""Simulated stand in for src/device.so
+
+FakeDevice implements the part of the device.so interface used by
+device.py: Arcus motor controller commands through sendCmd/getUSBReply,
+and the PC104 gpio through evgetin/getGPIO/setGPIO.  The motor follows
+the controller's trapezoidal LSPD/HSPD/ACC/DEC move profile, and the
+wheel carries six hall sensors with the measured widths and spacings and
+the wheel id bits at home, so moves and homes can be run without the
+PC104 attached.  Use it with device.setDevice(FakeDevice()).
+"""
 from __future__ import division, absolute_import
 
+import os
 import time
+import math
+import random
+import threading
 
-from RO.Comm.TwistedTimer import Timer
+from .device import STOP_TIMEOUT, HALL_WATCH_STOP_FAILED, HALL_POS, ID_1, ID_2, ID_4, DIFFRPM_ISRUN, DIFFU_COVERSTATE, DIFFU, DIFFUROT, DIFFUPOS_IN, DIFFUPOS_OUT
 
-MoveTime = 3 # seconds for all moves
+__all__ = ["FakeDevice"]
 
-StatusDict = {
-    "id": 7,
-    "currentEncoder": "NaN",
-    "motor": 0,
-    "hall": "0000",
-    "position": 0,
-    "power": None,
-    "desiredStep": 100,#"NaN",
-    "currentStep": 501,#"NaN"
-    "diffuRotating": 0,
-    "diffuInBeam": 0,
-}
+# hall effects were measured to have a typical width of 30-35 steps
+# spacing between hall effects were in the range [1290,1370] steps
+HALL_WIDTH = (30, 35)
+HALL_SPACING = (1290, 1370)
 
+DIFFU_MOVE_TIME = 1.5 # seconds for the diffuser to move in or out of the beam
+DIFFU_SPINUP_TIME = 3 # seconds for the diffuser to reach speed
+DIFFU_SPINDOWN_TIME = 2 # seconds for the diffuser to spin down
+NVM_COMMS_GAP = 2 # seconds the controller doesn't answer after RR or RW
 
-class FilterWheel(object):
-    def __init__(self):
-        self.moveTimer = Timer()
+MOVE_HISTORY = 20 # past move profiles kept, for positions at past times
 
-    def stopMove(self):
-        self.moveTimer.cancel()
-        StatusDict["motor"]=0
-        # StatusDict["motor"]=8
+# motor status (MST) bits
+MST_ACCEL = 1
+MST_DECEL = 2
+MST_CONST = 4
 
-    def connect(self):
-        """
-        initiate filter wheel communication
-        """
-        pass
+class MoveProfile(object):
+    """A motor move starting at tStart from posStart
 
-    def home(self):
-        """
-        home filter wheel and set the filter wheel id
+    phases is a list of (duration, startSpeed, accel), in seconds and steps
+    """
+    def __init__(self, tStart, posStart, direction, phases):
+        self.tStart = tStart
+        self.posStart = posStart
+        self.direction = direction
+        self.phases = phases
+        self.tEnd = tStart + sum(phase[0] for phase in phases)
+
+    def _phaseAt(self, t):
+        # return the phase running at time t (None if done),
+        # time into that phase and distance covered before it
+        dt = max(t - self.tStart, 0)
+        dist = 0
+        for ind, (duration, speed, accel) in enumerate(self.phases):
+            if dt < duration:
+                return ind, dt, dist
+            dist += speed*duration + 0.5*accel*duration**2
+            dt -= duration
+        return None, 0, dist
+
+    def position(self, t):
+        ind, dt, dist = self._phaseAt(t)
+        if ind is not None:
+            duration, speed, accel = self.phases[ind]
+            dist += speed*dt + 0.5*accel*dt**2
+        return self.posStart + self.direction*dist
+
+    def speed(self, t):
+        ind, dt, dist = self._phaseAt(t)
+        if ind is None:
+            return 0
+        duration, speed, accel = self.phases[ind]
+        return speed + accel*dt
+
+    def motorStatus(self, t):
+        ind, dt, dist = self._phaseAt(t)
+        if ind is None:
+            return 0
+        accel = self.phases[ind][2]
+        if accel > 0:
+            return MST_ACCEL
+        if accel < 0:
+            return MST_DECEL
+        return MST_CONST
+
+def sendMotorStateQueries(dev, state, retries):
+    """What device.c queryMotorState does, made of dev's sendCmd calls
+
+    Fills state (a device.MotorState) from the MST, PX and EX replies,
+    so usb faults injected into dev apply to each query.
+    Returns -1 if the usb link failed, else 1
+    """
+    success = 1
+    for name, cmdStr in (("mst", "MST"), ("px", "PX"), ("ex", "EX")):
+        ok = 0
+        for ii in range(retries + 1):
+            if dev.sendCmd(cmdStr) == 1:
+                try:
+                    setattr(state, name, int(dev.getUSBReply()))
+                    ok = 1
+                except ValueError:
+                    pass # an error reply
+                break
+        else:
+            success = -1
+        setattr(state, name + "Ok", ok)
+    return success
+
+class FakeDevice(object):
+    def __init__(self, wheelID=5, seed=None, clock=time.time, nativeHallWatch=True):
+        """!Construct a FakeDevice
+
+        @param[in] wheelID  id reported by the wheel id bits at home (2-7)
+        @param[in] seed  random seed for the hall layout and starting angle
+        @param[in] clock  function returning the current time in seconds
+        @param[in] nativeHallWatch  if True emulate hallWatchStart with a thread, else report it unavailable
         """
-        # emulate the block
-        time.sleep(3)
-        # StatusDict["id"] = 1
-        return StatusDict["id"]
+        rand = random.Random(seed)
+        self.wheelID = wheelID
+        self.clock = clock
+        self.nativeHallWatch = nativeHallWatch
+        # hall centers in steps from home, home is hall 0
+        spacings = [rand.uniform(*HALL_SPACING) for ii in range(6)]
+        self.stepsPerRev = sum(spacings)
+        self.hallCenters = [sum(spacings[:ii]) for ii in range(6)]
+        self.hallWidths = [rand.uniform(*HALL_WIDTH) for ii in range(6)]
+        # wheel angle (steps from home) at motor position 0
+        self.angleOffset = rand.uniform(0, self.stepsPerRev)
+        self.params = {
+            "LSPD": 10,
+            "HSPD": 250,
+            "ACC": 70,
+            "DEC": 70,
+            "EO": 0,
+            "SL": 0,
+            "R2": 0, # RR result
+            "R4": 0, # RW result
+        }
+        self.nvmResult = 1 # R2 or R4 after RR or RW, 1 for success
+        self._commsBackAt = None # time the controller answers again after RR or RW
+        self.coverOff = True
+        self.reply = ""
+        self._lock = threading.RLock()
+        self._pos = 0. # motor position in steps, when not moving
+        self._profile = None
+        self._pastProfiles = []
+        self._pxOffset = 0
+        self._exOffset = 0
+        # output dio: (value, time set)
+        self._outputs = {DIFFU: (0, -1e9), DIFFUROT: (0, -1e9)}
+        self._atSpeed = False # diffuser at speed when rotation was last changed
+        self._watchThread = None
+        self._watchPipe = None
+        self._watchCount = 0
+        self._watchAbort = False
+        # motor activity, for benchmarks
+        self.nMoves = 0 # moves started
+        self.nStops = 0 # STOP and ABORT commands
+
+    # motor model
+
+    def position(self, t=None):
+        """Motor position in steps at time t (now by default)
 
-    def stop(self):
+        Recent past times give the position along the moves made then
         """
-        stop filter wheel motion
+        with self._lock:
+            now = self.clock()
+            if self._profile is not None and now >= self._profile.tEnd:
+                # the move is done
+                self._pos = self._profile.position(self._profile.tEnd)
+                self._setProfile(None)
+            if t is None:
+                t = now
+            if t >= now:
+                return self._pos if self._profile is None else self._profile.position(t)
+            profiles = self._pastProfiles if self._profile is None else self._pastProfiles + [self._profile]
+            for profile in reversed(profiles):
+                if t >= profile.tStart:
+                    return profile.position(t)
+            return profiles[0].posStart if profiles else self._pos
+
+    def _setProfile(self, profile):
+        # replace the current move profile, keeping the old one
+        if self._profile is not None:
+            self._pastProfiles = self._pastProfiles[-MOVE_HISTORY + 1:] + [self._profile]
+        self._profile = profile
+
+    def _speeds(self):
+        lspd = float(self.params["LSPD"])
+        hspd = float(max(self.params["HSPD"], lspd))
+        acc = (hspd - lspd)/max(self.params["ACC"]/1000., 1e-6)
+        dec = (hspd - lspd)/max(self.params["DEC"]/1000., 1e-6)
+        return lspd, hspd, acc, dec
+
+    def _startMove(self, target):
+        # trapezoidal move from rest, starting and ending at LSPD
+        t = self.clock()
+        pos = self.position(t)
+        dist = abs(target - pos)
+        direction = 1 if target >= pos else -1
+        lspd, hspd, acc, dec = self._speeds()
+        if acc == 0 or dec == 0:
+            # no ramp, run at HSPD
+            top = hspd
+            phases = [(dist/top, top, 0)]
+        else:
+            dAcc = (hspd**2 - lspd**2)/(2*acc)
+            dDec = (hspd**2 - lspd**2)/(2*dec)
+            if dAcc + dDec <= dist:
+                top = hspd
+                cruise = (dist - dAcc - dDec)/hspd
+            else:
+                # never reaches HSPD
+                top = math.sqrt(lspd**2 + 2*dist*acc*dec/(acc + dec))
+                cruise = 0
+            phases = [
+                ((top - lspd)/acc, lspd, acc),
+                (cruise, top, 0),
+                ((top - lspd)/dec, top, -dec),
+            ]
+        self._pos = pos
+        self._setProfile(MoveProfile(t, pos, direction, phases))
+
+    def _stopMove(self):
+        # decelerate from the current speed to LSPD and stop
+        t = self.clock()
+        pos = self.position(t)
+        if self._profile is None:
+            return
+        speed = self._profile.speed(t)
+        direction = self._profile.direction
+        lspd, hspd, acc, dec = self._speeds()
+        phases = []
+        if speed > lspd and dec > 0:
+            phases = [((speed - lspd)/dec, speed, -dec)]
+        self._pos = pos
+        self._setProfile(MoveProfile(t, pos, direction, phases))
+
+    def motorStatus(self):
+        with self._lock:
+            t = self.clock()
+            self.position(t)
+            if self._profile is None:
+                return 0
+            return self._profile.motorStatus(t)
+
+    # usb interface
+
+    def _command(self, cmdStr):
+        # return the controller's reply to cmdStr
+        with self._lock:
+            cmdStr = cmdStr.strip().upper()
+            if cmdStr == "PX":
+                return "%i"%round(self.position() + self._pxOffset)
+            if cmdStr == "EX":
+                return "%i"%round(self.position() + self._exOffset)
+            if cmdStr == "MST":
+                return "%i"%self.motorStatus()
+            if cmdStr == "ID":
+                return "ACE-SDE"
+            if cmdStr == "DN":
+                return "ACE00"
+            if cmdStr in ("STOP", "ABORT"):
+                self.nStops += 1
+                if cmdStr == "STOP":
+                    self._stopMove()
+                else:
+                    # stop dead
+                    self._pos = self.position()
+                    self._setProfile(MoveProfile(self.clock(), self._pos, 1, []))
+                return "OK"
+            if cmdStr in ("RR", "RW"):
+                # settings read from or written to non volatile memory
+                self.params["R2" if cmdStr == "RR" else "R4"] = self.nvmResult
+                self._commsBackAt = self.clock() + NVM_COMMS_GAP
+                return "OK"
+            if cmdStr.startswith("X"):
+                try:
+                    target = int(cmdStr[1:])
+                except ValueError:
+                    return "?Invalid"
+                if not self.params["EO"]:
+                    return "?Motor Off"
+                if self.motorStatus():
+                    return "?Moving"
+                # in StepNLoop (SL=1) targets are encoder positions
+                offset = self._exOffset if self.params["SL"] else self._pxOffset
+                self._startMove(target - offset)
+                self.nMoves += 1
+                return "OK"
+            if "=" in cmdStr:
+                name, value = cmdStr.split("=", 1)
+                try:
+                    value = int(value)
+                except ValueError:
+                    return "?Invalid"
+                if name == "PX":
+                    self._pxOffset = value - self.position()
+                elif name == "EX":
+                    self._exOffset = value - self.position()
+                else:
+                    self.params[name] = value
+                return "OK"
+            if cmdStr in self.params:
+                return "%i"%self.params[cmdStr]
+            return "OK"
+
+    def connect(self):
+        return 1
+
+    def disconnect(self):
+        self.hallWatchCancel()
+        return 1
+
+    def commFlush(self):
+        return 1
+
+    def sendCmd(self, cmdStr):
+        if self._commsBackAt is not None and self.clock() < self._commsBackAt:
+            return -1 # no answer
+        self.reply = self._command(cmdStr)
+        return 1
+
+    def getUSBReply(self):
+        return self.reply
+
+    def queryMotorState(self, state, retries):
+        return sendMotorStateQueries(self, state, retries)
+
+    # gpio interface
+
+    def wheelAngle(self, t=None):
+        """Wheel position in steps past the home hall center at time t (now by default)
         """
-        return self.stopMove()
+        return (self.position(t) + self.angleOffset)%self.stepsPerRev
 
-    def moveToPosition(self, pos):
+    def hallAt(self, angle=None):
+        """Index of the hall sensed at angle (the current angle by default), or None
         """
-        move to a specific filter wheel position
-        arguments:
-            int pos - filter position between 1 and 6
-        status:
-            0 - fail
-            1 - succeed
-            -1 - unknown
+        if angle is None:
+            angle = self.wheelAngle()
+        for ind, (center, width) in enumerate(zip(self.hallCenters, self.hallWidths)):
+            dist = abs(angle - center)%self.stepsPerRev
+            if min(dist, self.stepsPerRev - dist) <= width/2.:
+                return ind
+        return None
+
+    def hallOffset(self, angle=None):
+        """Index of the nearest hall center and the signed steps from it to angle
+
+        angle defaults to the current angle
         """
-        StatusDict["position"] = int(pos)
-        # StatusDict["motor"] = 1
-        StatusDict["motor"] = 3
-        self.moveTimer.start(MoveTime, self.stopMove)
-        return self.status()
+        if angle is None:
+            angle = self.wheelAngle()
+        offsets = []
+        for center in self.hallCenters:
+            dist = (angle - center)%self.stepsPerRev
+            if dist > self.stepsPerRev/2.:
+                dist -= self.stepsPerRev
+            offsets.append(dist)
+        ind = min(range(len(offsets)), key=lambda ii: abs(offsets[ii]))
+        return ind, offsets[ind]
 
-    def _setDiffuPos(self, val):
-        StatusDict["diffuInBeam"] = val
+    def _diffuserState(self, t):
+        # return (in, out, atSpeed) of the diffuser at time t
+        diffu, diffuTime = self._outputs[DIFFU]
+        rot, rotTime = self._outputs[DIFFUROT]
+        moved = t - diffuTime >= DIFFU_MOVE_TIME
+        isIn = bool(diffu) and moved
+        isOut = not diffu and moved
+        if rot:
+            atSpeed = t - rotTime >= DIFFU_SPINUP_TIME
+        else:
+            atSpeed = self._atSpeed and t - rotTime < DIFFU_SPINDOWN_TIME
+        return isIn, isOut, atSpeed
 
-    def startDiffuRot(self):
-        StatusDict["diffuRotating"] = 1
+    def evgpioinit(self):
+        pass
 
-    def stopDiffuRot(self):
-        StatusDict["diffuRotating"] = 0
+    def evsetddr(self, dio, value):
+        pass
 
-    def diffuIn(self):
-        Timer(0.2, self._setDiffuPos, 1)# set on a timer to emulate move time
+    def evsetmask(self, dio, value):
+        pass
 
-    def diffuOut(self):
-        Timer(0.2, self._setDiffuPos, 0)# set on a timer to emulate move time
+    def evclrwatch(self):
+        pass
 
-    def status(self):
-        """
-        return current status of filter wheel
-        """
-        return StatusDict
+    def evsetdata(self, dio, value):
+        with self._lock:
+            t = self.clock()
+            if dio == DIFFUROT:
+                self._atSpeed = self._diffuserState(t)[2]
+            if dio in self._outputs and self._outputs[dio][0] != value:
+                self._outputs[dio] = (value, t)
+
+    def setGPIO(self, dio, value):
+        self.evsetdata(dio, value)
+
+    def _input(self, dio, hall, diffuState):
+        # value of input dio with the wheel on hall (or None)
+        # and the diffuser in diffuState
+        if dio == HALL_POS:
+            # goes low when a hall is sensed
+            return 0 if hall is not None else 1
+        if dio in (ID_1, ID_2, ID_4):
+            # id bits read low when set, only at home
+            if hall != 0:
+                return 1
+            bit = {ID_1: 1, ID_2: 2, ID_4: 4}[dio]
+            return 0 if self.wheelID & bit else 1
+        if dio in self._outputs:
+            return self._outputs[dio][0]
+        isIn, isOut, atSpeed = diffuState
+        if dio == DIFFUPOS_IN:
+            return 0 if isIn else 1
+        if dio == DIFFUPOS_OUT:
+            return 0 if isOut else 1
+        if dio == DIFFRPM_ISRUN:
+            return 1 if atSpeed else 0
+        if dio == DIFFU_COVERSTATE:
+            return 1 if self.coverOff else 0
+        return 1
+
+    def evgetin(self, dio):
+        return self.evgetinmulti([dio], 1)
+
+    def evgetinmulti(self, dios, ndio):
+        # all bits are read at a single instant
+        with self._lock:
+            t = self.clock()
+            hall = self.hallAt()
+            diffuState = self._diffuserState(t)
+            bits = 0
+            for ind in range(ndio):
+                if self._input(dios[ind], hall, diffuState):
+                    bits |= 1 << ind
+            return bits
+
+    def getGPIO(self, dios, ndio):
+        return self.evgetinmulti(dios, ndio)
+
+    # hall watch, emulated with a thread
+
+    def hallWatchStart(self, hallDio, nHalls, pollUsec):
+        if not self.nativeHallWatch or self._watchThread is not None:
+            return -1
+        if self._watchPipe is None:
+            self._watchPipe = os.pipe()
+        self._watchCount = 0
+        self._watchAbort = False
+        self._watchStopFailed = False
+        self._watchThread = threading.Thread(target=self._hallWatchLoop, args=(hallDio, nHalls, pollUsec/1e6))
+        self._watchThread.daemon = True
+        self._watchThread.start()
+        return 1
+
+    def _hallWatchLoop(self, hallDio, nHalls, pollTime):
+        gotLow = False
+        while not self._watchAbort:
+            inPos = self.evgetin(hallDio) == 0
+            if not gotLow and not inPos:
+                gotLow = True
+            elif gotLow and inPos:
+                self._watchCount += 1
+                if self._watchCount < nHalls:
+                    gotLow = False
+                else:
+                    self._command("STOP")
+                    tStop = self.clock()
+                    while not self._watchAbort and self.motorStatus():
+                        if self.clock() - tStop > STOP_TIMEOUT:
+                            self._watchStopFailed = True
+                            break
+                        time.sleep(pollTime)
+                    break
+            elif not self.motorStatus():
+                break
+            time.sleep(pollTime)
+        os.write(self._watchPipe[1], "x")
+
+    def hallWatchFd(self):
+        return self._watchPipe[0] if self._watchPipe is not None else -1
+
+    def hallWatchResult(self):
+        if self._watchThread is None:
+            return -1
+        os.read(self._watchPipe[0], 1)
+        self._watchThread.join()
+        self._watchThread = None
+        if self._watchStopFailed:
+            return HALL_WATCH_STOP_FAILED
+        return self._watchCount
 
+    def hallWatchCancel(self):
+        if self._watchThread is not None:
+            self._watchAbort = True
+            self.hallWatchResult()
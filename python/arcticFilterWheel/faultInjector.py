@@ -0,0 +1,162 @@
+"""Inject usb and gpio faults between device.py and its device
+
+FaultInjector wraps a device (normally a fakeFilterWheel.FakeDevice) and
+passes every call through, adding:
+- usb latency drawn from a distribution; replies slower than the
+  controller timeout fail with -1, as from device.so
+- dropped commands (never reach the controller) and dropped replies
+  (the command is carried out but sendCmd fails)
+- stuck gpio bits and bouncing gpio bits (read inverted at random)
+- hall edges seen late, by reading the hall at an earlier wheel position
+- a wedged usb link, failing every command until it is reconnected
+
+Use it with device.setDevice(FaultInjector(FakeDevice(), ...)) to see
+how move times and success rates degrade.  While gpio faults are set the
+native hall watch reports itself unavailable, so hall polling goes
+through the injector.
+"""
+from __future__ import division, absolute_import
+
+import random
+import time
+
+from .device import HALL_POS
+from .fakeFilterWheel import sendMotorStateQueries
+
+__all__ = ["FaultInjector"]
+
+USB_TIMEOUT = 0.5 # seconds, the read/write timeout set by device.so connect()
+
+class FaultInjector(object):
+    def __init__(self, device, seed=None,
+        usbLatency=None,
+        dropCmd=0,
+        dropReply=0,
+        stuckBits=None,
+        bounceBits=None,
+        hallDelay=0,
+        wedge=0,
+        timeoutExecutes=0.5,
+        sleep=time.sleep,
+        clock=time.time,
+    ):
+        """!Construct a FaultInjector
+
+        @param[in] device  the device to wrap
+        @param[in] seed  random seed for the faults
+        @param[in] usbLatency  function (random.Random) returning the seconds a usb command takes, or None for no added latency
+        @param[in] dropCmd  probability a usb command never reaches the controller
+        @param[in] dropReply  probability the controller's reply is lost
+        @param[in] stuckBits  dict of dio: value for gpio bits stuck at value
+        @param[in] bounceBits  dict of dio: probability a read of dio is inverted
+        @param[in] hallDelay  seconds late the hall bit follows the wheel (needs a FakeDevice)
+        @param[in] wedge  probability a usb command wedges the link, failing all commands until connect() is called
+        @param[in] timeoutExecutes  probability a usb command that times out on latency still reaches the controller
+        @param[in] sleep  function used to let time pass for usb latency
+        @param[in] clock  function returning the current time in seconds
+        """
+        self.device = device
+        self.rand = random.Random(seed)
+        self.usbLatency = usbLatency
+        self.dropCmd = dropCmd
+        self.dropReply = dropReply
+        self.stuckBits = stuckBits or {}
+        self.bounceBits = bounceBits or {}
+        self.hallDelay = hallDelay
+        self.wedge = wedge
+        self.wedged = False
+        self.timeoutExecutes = timeoutExecutes
+        self.sleep = sleep
+        self.clock = clock
+        self.reply = ""
+        # fault counts
+        self.nCmds = 0
+        self.nTimeouts = 0
+        self.nDroppedCmds = 0
+        self.nDroppedReplies = 0
+        self.nBounces = 0
+        self.nWedges = 0
+
+    def __getattr__(self, name):
+        # everything not faulted goes straight to the device
+        return getattr(self.device, name)
+
+    @property
+    def gpioFaults(self):
+        return bool(self.stuckBits or self.bounceBits or self.hallDelay)
+
+    # usb
+
+    def connect(self):
+        self.wedged = False
+        return self.device.connect()
+
+    def sendCmd(self, cmdStr):
+        self.nCmds += 1
+        if not self.wedged and self.rand.random() < self.wedge:
+            self.wedged = True
+            self.nWedges += 1
+        if self.wedged:
+            self.sleep(USB_TIMEOUT)
+            return -1
+        latency = 0 if self.usbLatency is None else max(self.usbLatency(self.rand), 0)
+        if latency > USB_TIMEOUT:
+            # timed out, the controller may or may not have acted on it
+            self.sleep(USB_TIMEOUT)
+            self.nTimeouts += 1
+            if self.rand.random() < self.timeoutExecutes:
+                self.device.sendCmd(cmdStr)
+            return -1
+        if latency:
+            self.sleep(latency)
+        if self.rand.random() < self.dropCmd:
+            self.sleep(USB_TIMEOUT)
+            self.nDroppedCmds += 1
+            return -1
+        success = self.device.sendCmd(cmdStr)
+        if success != 1:
+            return success
+        if self.rand.random() < self.dropReply:
+            self.sleep(USB_TIMEOUT)
+            self.nDroppedReplies += 1
+            return -1
+        self.reply = self.device.getUSBReply()
+        return 1
+
+    def getUSBReply(self):
+        return self.reply
+
+    def queryMotorState(self, state, retries):
+        # each query is faulted
+        return sendMotorStateQueries(self, state, retries)
+
+    # gpio
+
+    def _faultBit(self, dio, value):
+        if dio in self.stuckBits:
+            return self.stuckBits[dio]
+        if dio == HALL_POS and self.hallDelay:
+            t = self.clock() - self.hallDelay
+            value = 0 if self.device.hallAt(self.device.wheelAngle(t)) is not None else 1
+        if self.rand.random() < self.bounceBits.get(dio, 0):
+            self.nBounces += 1
+            value = 1 - value
+        return value
+
+    def evgetin(self, dio):
+        return self._faultBit(dio, self.device.evgetin(dio))
+
+    def evgetinmulti(self, dios, ndio):
+        bits = self.device.evgetinmulti(dios, ndio)
+        for ind in range(ndio):
+            value = self._faultBit(dios[ind], (bits >> ind) & 1)
+            bits = (bits & ~(1 << ind)) | (value << ind)
+        return bits
+
+    def getGPIO(self, dios, ndio):
+        return self.evgetinmulti(dios, ndio)
+
+    def hallWatchStart(self, hallDio, nHalls, pollUsec):
+        if self.gpioFaults:
+            return -1
+        return self.device.hallWatchStart(hallDio, nHalls, pollUsec)
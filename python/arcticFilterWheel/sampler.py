@@ -0,0 +1,111 @@
+"""High rate gpio sampler run in its own process
+
+The sampler owns the gpio hot reads: it reads a gpio snapshot at a fixed
+cadence at elevated priority and publishes timestamped samples into a
+ring buffer in shared memory, so sampling keeps its cadence while the
+actor is busy.  The actor reads samples in place from the ring.
+
+Only gpio is sampled here.  The Arcus usb handle cannot be shared
+between processes, so PX, EX and MST stay with the actor.
+"""
+from __future__ import division, absolute_import
+
+import os
+import time
+import Queue
+import multiprocessing
+from multiprocessing.sharedctypes import RawArray, RawValue
+from ctypes import Structure, c_double, c_uint, c_long
+
+__all__ = ["Sample", "HallSampler"]
+
+RING_SIZE = 4096 # samples, ~4 seconds at the default period
+SAMPLE_PERIOD = 0.001 # seconds
+SAMPLER_NICE = -20
+
+class Sample(Structure):
+    _fields_ = [
+        ("seq", c_long), # sample number
+        ("time", c_double),
+        ("gpio", c_uint), # snapshot from device.readGPIO
+    ]
+
+class HallSampler(object):
+    def __init__(self, readGPIO, setGPIO, ringSize=RING_SIZE, period=SAMPLE_PERIOD):
+        """!Construct a HallSampler
+
+        @param[in] readGPIO  function returning a gpio snapshot, called in the sampler process
+        @param[in] setGPIO  function (dio, value) setting a gpio output, called in the sampler process
+        @param[in] ringSize  number of samples held in the ring buffer
+        @param[in] period  seconds between samples
+        """
+        self.readGPIO = readGPIO
+        self.setGPIO = setGPIO
+        self.ringSize = ringSize
+        self.period = period
+        self.ring = RawArray(Sample, ringSize)
+        self.count = RawValue(c_long, 0) # number of samples written
+        # gpio writes are handed to the sampler, so only
+        # one process ever touches the gpio registers
+        self.writeQueue = multiprocessing.Queue()
+        self.process = None
+
+    @property
+    def isRunning(self):
+        return self.process is not None and self.process.is_alive()
+
+    def start(self):
+        self.process = multiprocessing.Process(target=self._run, name="HallSampler")
+        self.process.daemon = True
+        self.process.start()
+
+    def stop(self):
+        if self.process is not None:
+            self.process.terminate()
+            self.process.join()
+            self.process = None
+
+    def _run(self):
+        try:
+            os.nice(SAMPLER_NICE)
+        except OSError:
+            pass # not allowed to raise priority
+        while True:
+            while True:
+                try:
+                    dio, value = self.writeQueue.get_nowait()
+                except Queue.Empty:
+                    break
+                self.setGPIO(dio, value)
+            seq = self.count.value
+            sample = self.ring[seq % self.ringSize]
+            sample.seq = seq
+            sample.time = time.time()
+            sample.gpio = self.readGPIO()
+            # publish only once the slot is filled
+            self.count.value = seq + 1
+            time.sleep(self.period)
+
+    def write(self, dio, value):
+        """Set a gpio output from the sampler process
+        """
+        self.writeQueue.put((dio, value))
+
+    def latest(self):
+        """Return the most recent Sample (shared, not a copy), or None
+        """
+        count = self.count.value
+        if count == 0:
+            return None
+        return self.ring[(count - 1) % self.ringSize]
+
+    def samplesSince(self, seq):
+        """Return samples numbered seq and later, and the next seq to ask for
+
+        Samples are returned in place, not copied.  If the reader has
+        fallen more than a ring behind, the oldest samples still held are
+        returned.
+        """
+        count = self.count.value
+        seq = max(seq, count - self.ringSize + 1)
+        return [self.ring[ii % self.ringSize] for ii in range(seq, count)], count
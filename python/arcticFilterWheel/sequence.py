@@ -0,0 +1,117 @@
+"""Parse and plan filter wheel and diffuser sequences
+
+A sequence is a string of steps separated by ";", each one of:
+- move N: move the filter wheel to filter N
+- diffuIn, diffuOut, startDiffuRot, stopDiffuRot: as the actor commands
+- wait SEC: dwell for SEC seconds
+- trigger: wait for the trigger command
+
+planSequence groups the steps into stages run one after another.  A
+filter move and a diffuser change with no wait or trigger between them
+run together in one stage, and of several moves with no wait or trigger
+between them only the last is made.
+"""
+from __future__ import division, absolute_import
+
+__all__ = ["SequenceStep", "parseSequence", "planSequence"]
+
+MOVE_RANGE = range(1, 7)
+DIFFU_VERBS = ["diffuIn", "diffuOut", "startDiffuRot", "stopDiffuRot"]
+
+class SequenceStep(object):
+    Move = "move"
+    Diffuser = "diffuser"
+    Wait = "wait"
+    Trigger = "trigger"
+    def __init__(self, index, kind, cmdStr, value=None):
+        """!Construct a SequenceStep
+
+        @param[in] index  step number, from 1
+        @param[in] kind  one of Move, Diffuser, Wait or Trigger
+        @param[in] cmdStr  the step as written, eg "move 3"
+        @param[in] value  filter ID of a move, seconds of a wait
+        """
+        self.index = index
+        self.kind = kind
+        self.cmdStr = cmdStr
+        self.value = value
+        self.skipped = False # made redundant by a later step
+        self.time = None # seconds taken, once done
+
+    def __repr__(self):
+        return "SequenceStep(%i, %r)"%(self.index, self.cmdStr)
+
+def parseSequence(seqStr):
+    """Parse a sequence string into a list of SequenceSteps
+
+    @param[in] seqStr  steps separated by ";"
+    @return a list of SequenceSteps
+    @throw ValueError if a step can't be parsed
+    """
+    steps = []
+    for stepStr in seqStr.split(";"):
+        words = stepStr.split()
+        if not words:
+            continue
+        index = len(steps) + 1
+        cmdStr = " ".join(words)
+        verb = words[0]
+        nArgs = 1 if verb in ("move", "wait") else 0
+        if len(words) != 1 + nArgs:
+            raise ValueError("step %i %r: %s takes %i argument(s)"%(index, cmdStr, verb, nArgs))
+        if verb == "move":
+            try:
+                filterID = int(words[1])
+            except ValueError:
+                filterID = None
+            if filterID not in MOVE_RANGE:
+                raise ValueError("step %i %r: filter must be one of %s"%(index, cmdStr, MOVE_RANGE))
+            steps.append(SequenceStep(index, SequenceStep.Move, cmdStr, filterID))
+        elif verb == "wait":
+            try:
+                waitTime = float(words[1])
+            except ValueError:
+                waitTime = -1
+            if not waitTime >= 0:
+                raise ValueError("step %i %r: wait time must be seconds >= 0"%(index, cmdStr))
+            steps.append(SequenceStep(index, SequenceStep.Wait, cmdStr, waitTime))
+        elif verb == "trigger":
+            steps.append(SequenceStep(index, SequenceStep.Trigger, cmdStr))
+        elif verb in DIFFU_VERBS:
+            steps.append(SequenceStep(index, SequenceStep.Diffuser, cmdStr))
+        else:
+            raise ValueError("step %i %r: unknown step %r"%(index, cmdStr, verb))
+    if not steps:
+        raise ValueError("no steps")
+    return steps
+
+def planSequence(steps):
+    """Group steps into stages run one after another
+
+    Marks moves made redundant by a later move as skipped.
+
+    @param[in] steps  a list of SequenceSteps
+    @return a list of stages, each a list of the SequenceSteps run together
+    """
+    stages = []
+    stage = []
+    for step in steps:
+        if step.kind in (SequenceStep.Wait, SequenceStep.Trigger):
+            if stage:
+                stages.append(stage)
+            stages.append([step])
+            stage = []
+            continue
+        if step.kind == SequenceStep.Move:
+            # a move with nothing to see before the next is pointless
+            for prevStep in [prevStep for prevStep in stage if prevStep.kind == SequenceStep.Move]:
+                prevStep.skipped = True
+                stage.remove(prevStep)
+        elif any(prevStep.kind == SequenceStep.Diffuser for prevStep in stage):
+            # diffuser changes are made one at a time
+            stages.append(stage)
+            stage = []
+        stage.append(step)
+    if stage:
+        stages.append(stage)
+    return stages
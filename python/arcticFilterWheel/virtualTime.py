@@ -0,0 +1,122 @@
+"""Run the actor against a simulated wheel in virtual time
+
+VirtualTimeHarness replaces the reactor as device.py's clock with a
+twisted.internet.task.Clock and the device with a FakeDevice driven by
+the same clock, builds an ArcticFWActor and dispatches commands to it
+with parseAndDispatchCmd.  Time only passes when the harness advances
+the clock, jumping straight to the next scheduled call, so a full home or
+hundreds of moves take milliseconds.  device.py makes its usb calls
+straight away, rather than in its usb thread, when the clock isn't the
+reactor.
+"""
+from __future__ import division, absolute_import
+
+from twisted.internet import reactor, task
+from twistedActor import UserCmd
+
+from . import device
+from .arcticFWActor import ArcticFWActor
+from .fakeFilterWheel import FakeDevice
+
+__all__ = ["VirtualFakeDevice", "VirtualTimeHarness"]
+
+USB_CMD_TIME = 0.001 # seconds of virtual time taken by each usb command
+RUN_TIMEOUT = 600 # default seconds of virtual time to wait for a command
+
+class VirtualFakeDevice(FakeDevice):
+    def __init__(self, clock, cmdTime=USB_CMD_TIME, **kwargs):
+        """!Construct a VirtualFakeDevice
+
+        @param[in] clock  twisted.internet.task.Clock giving the virtual time
+        @param[in] cmdTime  seconds of virtual time taken by each usb command
+        @param[in] kwargs  passed to FakeDevice; the native hall watch is
+            off by default, as its thread runs in real time
+        """
+        kwargs.setdefault("nativeHallWatch", False)
+        FakeDevice.__init__(self, clock=clock.seconds, **kwargs)
+        self.virtualClock = clock
+        self.cmdTime = cmdTime
+
+    def sendCmd(self, cmdStr):
+        # time passes for each usb command, without running scheduled
+        # calls, so busy waits on the controller (eg device.sendStop) finish
+        self.virtualClock.rightNow += self.cmdTime
+        return FakeDevice.sendCmd(self, cmdStr)
+
+class VirtualTimeHarness(object):
+    def __init__(self, name="arcticFW", userPort=0, **kwargs):
+        """!Construct a VirtualTimeHarness and wait for the actor to initialize
+
+        @param[in] name  actor name
+        @param[in] userPort  port for the actor, 0 for any free port
+        @param[in] kwargs  passed to VirtualFakeDevice, eg seed and wheelID
+        """
+        self.clock = task.Clock()
+        self.fake = VirtualFakeDevice(self.clock, **kwargs)
+        device.setClock(self.clock)
+        device.setDevice(self.fake)
+        device.status.reset()
+        self.actor = ArcticFWActor(name=name, userPort=userPort)
+        self.runUntil(lambda: device.status.initState != device.status.Initializing)
+
+    @property
+    def status(self):
+        return device.status
+
+    def seconds(self):
+        return self.clock.seconds()
+
+    def advance(self):
+        """Advance the clock to the next scheduled call, and run it
+        """
+        calls = self.clock.getDelayedCalls()
+        if not calls:
+            raise RuntimeError("nothing scheduled in virtual time")
+        nextTime = min(call.getTime() for call in calls)
+        self.clock.advance(max(nextTime - self.clock.seconds(), 0))
+
+    def runUntil(self, condition, timeout=RUN_TIMEOUT):
+        """Advance virtual time until condition() is true
+
+        @param[in] condition  function returning True when done
+        @param[in] timeout  seconds of virtual time, after which a RuntimeError is raised
+        """
+        tEnd = self.clock.seconds() + timeout
+        while not condition():
+            if self.clock.seconds() > tEnd:
+                raise RuntimeError("condition not met within %.1f seconds of virtual time"%(timeout,))
+            self.advance()
+
+    def runFor(self, duration):
+        """Advance virtual time by duration seconds
+        """
+        tEnd = self.clock.seconds() + duration
+        self.runUntil(lambda: self.clock.seconds() >= tEnd, timeout=duration + 1)
+
+    def startCommand(self, cmdStr, userID=0):
+        """Dispatch cmdStr to the actor without advancing virtual time
+
+        @param[in] cmdStr  the command
+        @param[in] userID  ID of the client sending it
+        @return the UserCmd
+        """
+        cmd = UserCmd(userID=userID, cmdStr=cmdStr)
+        self.actor.parseAndDispatchCmd(cmd)
+        return cmd
+
+    def command(self, cmdStr, timeout=RUN_TIMEOUT, userID=0):
+        """Dispatch cmdStr to the actor and advance virtual time until it is done
+
+        @return the UserCmd
+        """
+        cmd = self.startCommand(cmdStr, userID=userID)
+        self.runUntil(lambda: cmd.isDone, timeout)
+        return cmd
+
+    def close(self):
+        """Close the actor and give the reactor back to device.py
+
+        @return a deferred fired when the actor is closed
+        """
+        device.setClock(reactor)
+        return self.actor.close()
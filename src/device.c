@@ -3,6 +3,8 @@
 #include <string.h>
 #include <stdlib.h>
 #include <unistd.h>
+#include <pthread.h>
+#include <sys/time.h>
 #include "ArcusPerformaxDriver.h"
 #include "evgpio.h"
 
@@ -12,6 +14,38 @@ int             retVal;
 char            usbCmd[64];
 char            usbResponse[64];
 
+// usb and gpio access may come from the hall watch thread
+// as well as the caller, these serialize it
+pthread_mutex_t usbLock = PTHREAD_MUTEX_INITIALIZER;
+pthread_mutex_t gpioLock = PTHREAD_MUTEX_INITIALIZER;
+
+// hall watch thread state
+pthread_t       watchThread;
+int             watchPipe[2] = {-1, -1};
+volatile int    watchRunning = 0;
+volatile int    watchAbort = 0;
+int             watchHallDio;
+int             watchNHalls;
+int             watchPollUsec;
+int             watchHallCount;
+volatile int    watchStopFailed = 0;
+
+// number of hall polls between checks that the motor is still moving
+#define WATCH_MST_EVERY 20
+// longest wait for the motor to stop after the STOP, as STOP_TIMEOUT in device.py
+#define WATCH_STOP_TIMEOUT_USEC 2000000
+
+// motor state read by queryMotorState(), each ok
+// flag is 0 if its value couldn't be read
+typedef struct {
+    int mst;
+    int px;
+    int ex;
+    int mstOk;
+    int pxOk;
+    int exOk;
+} MotorState;
+
 // function signatures
 int commFlush();
 int sendCmd(char *cmdStr);
@@ -19,6 +53,26 @@ int disconnect();
 char* getUSBReply();
 void evgpioinit();
 
+// Query MST, PX and EX back to back, resending each up to
+// retries times on usb failure, and parse the replies into
+// state.  Returns -1 if the usb link failed, else 1
+int queryMotorState(MotorState *state, int retries);
+
+// Locked versions of evgetinmulti and evsetdata, use these
+// while a hall watch may be running
+unsigned int getGPIO(int *dios, int ndio);
+void setGPIO(int dio, int value);
+
+// Drive through nHalls halls (sensed low to high on hallDio) and
+// send STOP at the last one, polling every pollUsec in a thread.
+// The fd returned by hallWatchFd() becomes readable when done.
+// hallWatchResult() returns the number of halls seen, or -2 if
+// the motor wasn't seen to stop after the STOP
+int hallWatchStart(int hallDio, int nHalls, int pollUsec);
+int hallWatchFd();
+int hallWatchResult();
+void hallWatchCancel();
+
 // Set data output value, 1 high, 0 low
 void evsetdata(int dio, int value);
 
@@ -31,6 +85,10 @@ void evsetmask(int dio, int value);
 // Returns the input value for a dio
 int evgetin(int dio);
 
+// Returns the input values for ndio dios packed into a bitmask,
+// bit n holds the value of dios[n]
+uint32_t evgetinmulti(int *dios, int ndio);
+
 // Clears all pending events
 void evclrwatch();
 
@@ -40,6 +98,31 @@ char* getUSBReply(){
     return usbResponse;
 }
 
+static int usbSendRecv(char *cmdStr, char *reply){
+    char cmd[64];
+    int success;
+    strncpy(cmd, cmdStr, 63);
+    cmd[63] = '\0';
+    pthread_mutex_lock(&usbLock);
+    success = fnPerformaxComSendRecv(Handle, cmd, 64, 64, reply);
+    pthread_mutex_unlock(&usbLock);
+    return success;
+}
+
+unsigned int getGPIO(int *dios, int ndio){
+    unsigned int bits;
+    pthread_mutex_lock(&gpioLock);
+    bits = evgetinmulti(dios, ndio);
+    pthread_mutex_unlock(&gpioLock);
+    return bits;
+}
+
+void setGPIO(int dio, int value){
+    pthread_mutex_lock(&gpioLock);
+    evsetdata(dio, value);
+    pthread_mutex_unlock(&gpioLock);
+}
+
 int commFlush(){
     if (!fnPerformaxComFlush(Handle)){
         printf("Error flushing comms\n");
@@ -53,7 +136,7 @@ int commFlush(){
 
 int sendCmd(char *cmdStr){
     strcpy(usbCmd, cmdStr);
-    if(!fnPerformaxComSendRecv(Handle, usbCmd, 64,64, usbResponse)){
+    if(!usbSendRecv(usbCmd, usbResponse)){
         printf("Command %s failed\n", cmdStr);
         return -1;
     }
@@ -61,7 +144,162 @@ int sendCmd(char *cmdStr){
     return 1;
 }
 
+static int queryInt(char *cmdStr, int retries, int *value){
+    // send a query, parsing the integer reply into value.
+    // Returns 1 if read, 0 for an error (or unparsable)
+    // reply, -1 if the usb link failed on every try
+    char reply[64];
+    char *end;
+    long parsed;
+    int ii;
+    for(ii = 0; ii <= retries; ii++){
+        if(usbSendRecv(cmdStr, reply)){
+            // errors begin with ?
+            if(reply[0] == '?'){
+                return 0;
+            }
+            parsed = strtol(reply, &end, 10);
+            if(end == reply){
+                return 0;
+            }
+            *value = (int)parsed;
+            return 1;
+        }
+    }
+    return -1;
+}
+
+int queryMotorState(MotorState *state, int retries){
+    // the replies go to local buffers, so usbResponse
+    // (and getUSBReply) are left alone
+    int mstRead = queryInt("MST", retries, &state->mst);
+    int pxRead = queryInt("PX", retries, &state->px);
+    int exRead = queryInt("EX", retries, &state->ex);
+    state->mstOk = mstRead == 1;
+    state->pxOk = pxRead == 1;
+    state->exOk = exRead == 1;
+    if(mstRead == -1 || pxRead == -1 || exRead == -1){
+        return -1;
+    }
+    return 1;
+}
+
+static int motorStopped(){
+    char reply[64];
+    if(!usbSendRecv("MST", reply)){
+        return 0;
+    }
+    return atoi(reply) == 0;
+}
+
+static long usecSince(struct timeval *start){
+    struct timeval now;
+    gettimeofday(&now, NULL);
+    return (now.tv_sec - start->tv_sec)*1000000L + (now.tv_usec - start->tv_usec);
+}
+
+static void *hallWatchLoop(void *arg){
+    int gotLow = 0;
+    int inPos;
+    int polls = 0;
+    char reply[64];
+    struct timeval stopTime;
+
+    while(!watchAbort){
+        // hall reads low when sensed
+        pthread_mutex_lock(&gpioLock);
+        inPos = evgetin(watchHallDio) == 0;
+        pthread_mutex_unlock(&gpioLock);
+        if(!gotLow && !inPos){
+            gotLow = 1;
+        }
+        else if(gotLow && inPos){
+            watchHallCount++;
+            if(watchHallCount < watchNHalls){
+                // passing an intermediate hall, keep going
+                gotLow = 0;
+            }
+            else{
+                usbSendRecv("STOP", reply);
+                gettimeofday(&stopTime, NULL);
+                while(!watchAbort && !motorStopped()){
+                    if(usecSince(&stopTime) > WATCH_STOP_TIMEOUT_USEC){
+                        // eg the link dropped, let the caller know
+                        watchStopFailed = 1;
+                        break;
+                    }
+                    usleep(watchPollUsec);
+                }
+                break;
+            }
+        }
+        else if(++polls % WATCH_MST_EVERY == 0 && motorStopped()){
+            // motor stopped without reaching the last hall
+            break;
+        }
+        usleep(watchPollUsec);
+    }
+    if(write(watchPipe[1], "x", 1) != 1){
+        printf("Error signalling hall watch done\n");
+    }
+    return NULL;
+}
+
+int hallWatchStart(int hallDio, int nHalls, int pollUsec){
+    if(watchRunning){
+        printf("Hall watch already running\n");
+        return -1;
+    }
+    if(watchPipe[0] == -1 && pipe(watchPipe) == -1){
+        printf("Error creating hall watch pipe\n");
+        return -1;
+    }
+    watchHallDio = hallDio;
+    watchNHalls = nHalls;
+    watchPollUsec = pollUsec;
+    watchHallCount = 0;
+    watchStopFailed = 0;
+    watchAbort = 0;
+    if(pthread_create(&watchThread, NULL, hallWatchLoop, NULL)){
+        printf("Error starting hall watch thread\n");
+        return -1;
+    }
+    watchRunning = 1;
+    return 1;
+}
+
+int hallWatchFd(){
+    return watchPipe[0];
+}
+
+int hallWatchResult(){
+    // call once hallWatchFd() is readable
+    // returns the number of halls seen, or -2
+    // if the motor wasn't seen to stop
+    char buf;
+    if(!watchRunning){
+        return -1;
+    }
+    if(read(watchPipe[0], &buf, 1) != 1){
+        printf("Error reading hall watch pipe\n");
+    }
+    pthread_join(watchThread, NULL);
+    watchRunning = 0;
+    if(watchStopFailed){
+        return -2;
+    }
+    return watchHallCount;
+}
+
+void hallWatchCancel(){
+    if(watchRunning){
+        watchAbort = 1;
+        hallWatchResult();
+    }
+}
+
 int disconnect(){
+    hallWatchCancel();
     if(!fnPerformaxComClose(Handle)){
         printf( "Error disconnecting device\n");
         return -1;
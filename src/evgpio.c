@@ -106,6 +106,57 @@ int evgetin(int dio)
 	return value ? 1 : 0;
 }
 
+// Returns the input values of ndio dios packed into a bitmask, bit n holds
+// the value of dios[n].  Each bank is masked, flushed and unmasked once so
+// every value comes from the same pass over the event fifo.
+uint32_t evgetinmulti(int *dios, int ndio)
+{
+	uint32_t bits = 0;
+	int bank, n, offset, inbank;
+	int datareg, maskreg;
+	uint16_t x;
+
+	for(bank = 0; bank < 2; bank++) {
+		if(model == 0x7700) {
+			if(bank) break;
+			datareg = 0x10/2;
+			maskreg = 0x14/2;
+			offset = 0;
+		} else if(bank == 0) {
+			datareg = 0x36/2;
+			maskreg = 0x38/2;
+			offset = 0;
+		} else {
+			datareg = 0x3a/2;
+			maskreg = 0x3c/2;
+			offset = 64;
+		}
+
+		inbank = 0;
+		for(n = 0; n < ndio; n++) {
+			if(model != 0x7700 && (dios[n] >= 64) != bank) continue;
+			syscon[maskreg] = (dios[n] - offset) | 0x80; // maskpoke
+			inbank++;
+		}
+		if(!inbank) continue;
+
+		while (syscon[datareg] & 0x100); // flush events
+		for(n = 0; n < ndio; n++) {
+			if(model != 0x7700 && (dios[n] >= 64) != bank) continue;
+			syscon[maskreg] = (dios[n] - offset) & ~0x80; // maskpoke
+		}
+		while ((x = syscon[datareg]) & 0x100) {
+			for(n = 0; n < ndio; n++) {
+				if(model != 0x7700 && (dios[n] >= 64) != bank) continue;
+				if((x & 0x7f) != (dios[n] - offset)) continue;
+				if(x & 0x80) bits |= (1 << n);
+				else bits &= ~(1 << n);
+			}
+		}
+	}
+	return bits;
+}
+
 void evclrwatch()
 {
 	uint16_t data;
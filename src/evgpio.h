@@ -24,6 +24,10 @@ void evsetmask(int dio, int value);
 // Returns the input value for a dio
 int evgetin(int dio);
 
+// Returns the input values for ndio dios packed into a bitmask,
+// bit n holds the value of dios[n]
+uint32_t evgetinmulti(int *dios, int ndio);
+
 // Clears all pending events
 void evclrwatch();
 
@@ -0,0 +1,127 @@
+#!/usr/bin/env python2
+from __future__ import division, absolute_import
+
+import unittest
+
+from arcticFilterWheel.device import HALL_POS, ID_1, ID_2, ID_4, DIFFU, DIFFUROT, DIFFUPOS_IN, DIFFUPOS_OUT, DIFFRPM_ISRUN, MotorState
+from arcticFilterWheel.fakeFilterWheel import FakeDevice, DIFFU_MOVE_TIME, DIFFU_SPINUP_TIME
+from arcticFilterWheel.faultInjector import FaultInjector, USB_TIMEOUT
+
+class ManualClock(object):
+    def __init__(self):
+        self.t = 0.
+
+    def __call__(self):
+        return self.t
+
+    def advance(self, dt):
+        self.t += dt
+
+class TestFakeFilterWheel(unittest.TestCase):
+    def setUp(self):
+        self.clock = ManualClock()
+        self.dev = FakeDevice(seed=1, clock=self.clock, nativeHallWatch=False)
+        for cmdStr in ["EO=1", "SL=1", "PX=0", "EX=0"]:
+            self.dev.sendCmd(cmdStr)
+
+    def query(self, cmdStr):
+        self.assertEqual(self.dev.sendCmd(cmdStr), 1)
+        return self.dev.getUSBReply()
+
+    def runMotor(self, dt=0.01):
+        while int(self.query("MST")) != 0:
+            self.clock.advance(dt)
+
+    def testMoveReachesTarget(self):
+        self.assertEqual(self.query("X1500"), "OK")
+        self.assertNotEqual(int(self.query("MST")), 0)
+        self.assertEqual(self.query("X0"), "?Moving")
+        self.runMotor()
+        self.assertEqual(int(self.query("EX")), 1500)
+        self.assertEqual(int(self.query("PX")), 1500)
+        # 1500 steps mostly at HSPD
+        self.assertAlmostEqual(self.clock(), 1500/250., delta=0.2)
+
+    def testMotorOff(self):
+        self.query("EO=0")
+        self.assertTrue(self.query("X1500").startswith("?"))
+
+    def testStopDecelerates(self):
+        self.query("X10000")
+        self.clock.advance(2)
+        stopPos = int(self.query("EX"))
+        self.query("STOP")
+        self.runMotor(0.001)
+        endPos = int(self.query("EX"))
+        self.assertTrue(0 <= endPos - stopPos <= 10)
+
+    def testQueryMotorState(self):
+        self.query("X1500")
+        self.clock.advance(2)
+        state = MotorState()
+        self.assertEqual(self.dev.queryMotorState(state, 0), 1)
+        self.assertTrue(state.mstOk and state.pxOk and state.exOk)
+        self.assertEqual((state.mst, state.px, state.ex), tuple(int(self.query(cmdStr)) for cmdStr in ("MST", "PX", "EX")))
+        # a lost command is resent, the link failing every time fails the query
+        injector = FaultInjector(self.dev, seed=1, dropCmd=1, sleep=self.clock.advance, clock=self.clock)
+        self.assertEqual(injector.queryMotorState(state, 2), -1)
+        self.assertEqual(injector.nDroppedCmds, 9)
+        self.assertFalse(state.mstOk or state.pxOk or state.exOk)
+
+    def testHallsAndWheelID(self):
+        for ind, center in enumerate(self.dev.hallCenters):
+            self.assertEqual(self.dev.hallAt(center), ind)
+            self.assertEqual(self.dev.hallAt(center + 30), None)
+        # drive to the home hall center
+        target = round(self.dev.stepsPerRev - self.dev.angleOffset)
+        self.query("X%i"%target)
+        self.runMotor()
+        self.assertEqual(self.dev.evgetin(HALL_POS), 0)
+        wheelID = int("%i%i%i"%tuple(1 - self.dev.evgetin(dio) for dio in (ID_4, ID_2, ID_1)), 2)
+        self.assertEqual(wheelID, self.dev.wheelID)
+        dios = [HALL_POS, ID_1, ID_2, ID_4]
+        self.assertEqual(self.dev.getGPIO(dios, len(dios)), sum(self.dev.evgetin(dio) << ind for ind, dio in enumerate(dios)))
+
+    def testDiffuser(self):
+        self.assertEqual(self.dev.evgetin(DIFFUPOS_OUT), 0)
+        self.dev.setGPIO(DIFFU, 1)
+        self.assertEqual(self.dev.evgetin(DIFFUPOS_OUT), 1)
+        self.assertEqual(self.dev.evgetin(DIFFUPOS_IN), 1)
+        self.clock.advance(DIFFU_MOVE_TIME)
+        self.assertEqual(self.dev.evgetin(DIFFUPOS_IN), 0)
+        self.dev.setGPIO(DIFFUROT, 1)
+        self.assertEqual(self.dev.evgetin(DIFFRPM_ISRUN), 0)
+        self.clock.advance(DIFFU_SPINUP_TIME)
+        self.assertEqual(self.dev.evgetin(DIFFRPM_ISRUN), 1)
+
+    def testUsbFaults(self):
+        injector = FaultInjector(self.dev, seed=1, dropReply=1, sleep=self.clock.advance, clock=self.clock)
+        # the move is made but the reply lost
+        self.assertEqual(injector.sendCmd("X1500"), -1)
+        self.assertEqual(self.clock(), USB_TIMEOUT)
+        self.assertNotEqual(int(self.query("MST")), 0)
+        injector = FaultInjector(self.dev, seed=1, dropCmd=1, sleep=self.clock.advance, clock=self.clock)
+        self.assertEqual(injector.sendCmd("STOP"), -1)
+        self.assertEqual(self.dev.nStops, 0)
+        injector = FaultInjector(self.dev, seed=1, usbLatency=lambda rand: 0.01, sleep=self.clock.advance, clock=self.clock)
+        self.assertEqual(injector.sendCmd("PX"), 1)
+        self.assertEqual(injector.getUSBReply(), self.query("PX"))
+
+    def testGPIOFaults(self):
+        injector = FaultInjector(self.dev, stuckBits={HALL_POS: 0}, hallDelay=1, clock=self.clock)
+        self.assertEqual(injector.evgetin(HALL_POS), 0)
+        self.assertEqual(injector.getGPIO([ID_1, HALL_POS], 2) & 2, 0)
+        # the native hall watch can't see injected faults
+        self.assertEqual(injector.hallWatchStart(HALL_POS, 1, 500), -1)
+        # the hall is seen where the wheel was a second ago
+        injector = FaultInjector(self.dev, hallDelay=1, clock=self.clock)
+        self.query("X-%i"%round(self.dev.angleOffset))
+        self.runMotor(0.001)
+        self.assertEqual(self.dev.evgetin(HALL_POS), 0)
+        self.assertEqual(injector.evgetin(HALL_POS), 1)
+        self.clock.advance(1)
+        self.assertEqual(injector.evgetin(HALL_POS), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
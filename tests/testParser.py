@@ -4,6 +4,7 @@ from __future__ import division, absolute_import
 import unittest
 
 from arcticFilterWheel.commandSet import arcticFWCommandSet
+from arcticFilterWheel.sequence import parseSequence
 
 commandList = [
     "stop",
@@ -12,7 +13,12 @@ commandList = [
     "home",
     "ping",
     "init",
+    "init force",
     "status",
+    "subscribe",
+    "subscribe keywords=state,filterID interval=0.5",
+    "sequence move 3; diffuIn; wait 10; trigger; move 5",
+    "trigger",
 ]
 
 
@@ -25,6 +31,22 @@ class TestParser(unittest.TestCase):
             print "cmdStr: ", cmdStr
             parsedCommand = arcticFWCommandSet.parse(cmdStr)
 
+    def testSequence(self):
+        # the steps reach the actor as one string
+        parsedCommand = arcticFWCommandSet.parse("sequence move 3; diffuIn; wait 10; trigger; move 5")
+        steps = parseSequence(parsedCommand.parsedPositionalArgs[0])
+        self.assertEqual([step.cmdStr for step in steps], ["move 3", "diffuIn", "wait 10", "trigger", "move 5"])
+        # bad steps get there too, and are rejected by the actor
+        parsedCommand = arcticFWCommandSet.parse("sequence move 9; spin")
+        self.assertRaises(ValueError, parseSequence, parsedCommand.parsedPositionalArgs[0])
+
+    def testEmptySequence(self):
+        # parsed, then rejected by the actor as an empty string
+        parsedCommand = arcticFWCommandSet.parse("sequence")
+        self.assertFalse(parsedCommand.parsedPositionalArgs and parsedCommand.parsedPositionalArgs[0].strip())
+        self.assertRaises(ValueError, parseSequence, "")
+        self.assertRaises(ValueError, parseSequence, " ; ")
+
 
 if __name__ == '__main__':
     unittest.main()
\ No newline at end of file
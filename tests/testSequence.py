@@ -0,0 +1,29 @@
+#!/usr/bin/env python2
+from __future__ import division, absolute_import
+
+import unittest
+
+from arcticFilterWheel.sequence import SequenceStep, parseSequence, planSequence
+
+class TestSequence(unittest.TestCase):
+    def testParse(self):
+        steps = parseSequence("move 3; wait 10.5;diffuIn ; trigger; ")
+        self.assertEqual([step.kind for step in steps], [SequenceStep.Move, SequenceStep.Wait, SequenceStep.Diffuser, SequenceStep.Trigger])
+        self.assertEqual([step.index for step in steps], [1, 2, 3, 4])
+        self.assertEqual(steps[0].value, 3)
+        self.assertEqual(steps[1].value, 10.5)
+        self.assertEqual(steps[2].cmdStr, "diffuIn")
+
+    def testParseErrors(self):
+        for seqStr in ["", "move", "move 7", "move two", "wait -1", "wait", "trigger 1", "diffuIn now", "spin"]:
+            self.assertRaises(ValueError, parseSequence, seqStr)
+
+    def testPlan(self):
+        steps = parseSequence("move 3; diffuIn; wait 10; move 5; move 2; startDiffuRot; stopDiffuRot; trigger; diffuOut")
+        stages = planSequence(steps)
+        self.assertEqual([[step.index for step in stage] for stage in stages], [[1, 2], [3], [5, 6], [7], [8], [9]])
+        self.assertEqual([step.index for step in steps if step.skipped], [4])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,103 @@
+#!/usr/bin/env python2
+from __future__ import division, absolute_import
+
+import time
+
+from twisted.internet import defer, task
+from twisted.trial.unittest import TestCase
+
+from arcticFilterWheel import device
+from arcticFilterWheel.arcticFWActor import ArcticFWStatus
+from arcticFilterWheel.fakeFilterWheel import FakeDevice
+from arcticFilterWheel.faultInjector import FaultInjector
+
+USB_DELAY = 0.05 # seconds taken by each usb command
+HEARTBEAT = 0.005 # seconds between reactor heartbeats
+
+class TestUsbThread(TestCase):
+    """Blocking usb calls are made in the usb thread, one at a time
+    """
+    def setUp(self):
+        self.device = device.device
+        self.stateFile = device.STATE_FILE
+        self.fake = FakeDevice(seed=1, nativeHallWatch=False)
+        for cmdStr in ["EO=1", "SL=1", "PX=0", "EX=0"]:
+            self.fake.sendCmd(cmdStr)
+        device.setDevice(FaultInjector(self.fake, usbLatency=lambda rand: USB_DELAY))
+        device.startUSBThread()
+
+    def tearDown(self):
+        device.stopUSBThread()
+        device.setDevice(self.device, self.stateFile)
+
+    def testUpdateDoesNotBlock(self):
+        beats = []
+        loop = task.LoopingCall(lambda: beats.append(time.time()))
+        loop.start(HEARTBEAT)
+        tStart = time.time()
+        d = device.status.update()
+        # returns before the first reply
+        self.assertTrue(time.time() - tStart < USB_DELAY)
+        def check(status):
+            loop.stop()
+            self.assertEqual(status.encPos, 0)
+            self.assertFalse(status.motorMoving)
+            # the reactor kept running for the three queries
+            self.assertTrue(len(beats) > USB_DELAY/HEARTBEAT)
+        return d.addCallback(check)
+
+    def testCallsInOrder(self):
+        # set without waiting, the update is made after it
+        device.setPos(500)
+        def check(status):
+            self.assertEqual(status.encPos, 500)
+            self.assertEqual(status.motorPos, 500)
+        return device.status.update().addCallback(check)
+
+    def testMoveAndStop(self):
+        d = device.move(2000)
+        def moving(started):
+            self.assertTrue(started)
+            return device.stop()
+        def stopped(success):
+            self.assertTrue(success)
+            self.assertEqual(self.fake.nStops, 1)
+            return device.status.update()
+        def check(status):
+            self.assertFalse(status.motorMoving)
+            self.assertTrue(0 < status.encPos < 2000)
+        d.addCallback(moving)
+        d.addCallback(stopped)
+        d.addCallback(check)
+        return d
+
+    def testStopGoesFirst(self):
+        done = []
+        def record(result, name):
+            done.append(name)
+        dList = [device.status.update().addCallback(record, "update%i"%ii) for ii in range(3)]
+        dList.append(device.stop(first=True).addCallback(record, "stop"))
+        def check(dummy):
+            # only the update already running is made before the stop
+            self.assertEqual(done, ["update0", "stop", "update1", "update2"])
+        return defer.gatherResults(dList).addCallback(check)
+
+    def testFollowUpRead(self):
+        reads = []
+        injector = device.device
+        queryMotorState = injector.queryMotorState
+        def countedQuery(*args):
+            reads.append(time.time())
+            return queryMotorState(*args)
+        injector.queryMotorState = countedQuery
+        fwStatus = ArcticFWStatus()
+        dList = [fwStatus.update(maxAge=0) for ii in range(5)]
+        def check(dummy):
+            # the read in progress, then one more for the rest
+            self.assertEqual(len(reads), 2)
+        return defer.gatherResults(dList).addCallback(check)
+
+
+if __name__ == '__main__':
+    from unittest import main
+    main()
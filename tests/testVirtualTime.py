@@ -0,0 +1,452 @@
+#!/usr/bin/env python2
+from __future__ import division, absolute_import
+
+import random
+
+from twisted.trial.unittest import TestCase
+
+from twistedActor import testUtils
+
+testUtils.init(__file__)
+
+import RO.Comm.Generic
+RO.Comm.Generic.setFramework("twisted")
+
+from arcticFilterWheel import device
+from arcticFilterWheel.virtualTime import VirtualTimeHarness
+from arcticFilterWheel.faultInjector import FaultInjector
+
+NUM_SEQUENCES = 10
+SEQUENCE_LENGTH = 20
+
+class TestVirtualTime(TestCase):
+    """Complete home and move sequences against a simulated wheel in virtual time
+    """
+    def setUp(self):
+        self.continuousHome = device.CONTINUOUS_HOME
+        self.directMove = device.DIRECT_MOVE
+        self.harness = None
+
+    def tearDown(self):
+        device.CONTINUOUS_HOME = self.continuousHome
+        device.DIRECT_MOVE = self.directMove
+        if self.harness is not None:
+            return self.harness.close()
+
+    def startHarness(self, seed):
+        if self.harness is not None:
+            self.harness.close()
+        self.harness = VirtualTimeHarness(seed=seed)
+        self.assertEqual(self.harness.status.initState, self.harness.status.Ready)
+        return self.harness
+
+    def checkAtFilter(self, filterID):
+        # the simulated wheel is on the hall of filterID
+        harness = self.harness
+        hallInd, offset = harness.fake.hallOffset()
+        self.assertEqual(harness.status.filterID, filterID)
+        self.assertEqual(hallInd + 1, filterID)
+        self.assertTrue(abs(offset) <= harness.fake.hallWidths[hallInd]/2.)
+
+    def home(self):
+        cmd = self.harness.command("home")
+        self.assertTrue(cmd.isDone and not cmd.didFail)
+        self.assertEqual(self.harness.status.wheelID, self.harness.fake.wheelID)
+        self.checkAtFilter(1)
+
+    def testSweepHome(self):
+        self.startHarness(seed=1)
+        device.CONTINUOUS_HOME = True
+        nStops = self.harness.fake.nStops
+        self.home()
+        self.assertTrue(self.harness.status.hallPositionsKnown)
+        # a single sweep and return, without stopping on the way
+        self.assertEqual(self.harness.fake.nStops, nStops)
+
+    def testStepHome(self):
+        self.startHarness(seed=2)
+        device.CONTINUOUS_HOME = False
+        nStops = self.harness.fake.nStops
+        self.home()
+        self.assertTrue(self.harness.status.hallPositionsKnown)
+        # stops at each hall to find home, then at each hall once around
+        self.assertTrue(7 <= self.harness.fake.nStops - nStops <= 13)
+        # the learned positions are the hall centers
+        for filterID, center in zip(range(1, 7), self.harness.fake.hallCenters):
+            self.assertTrue(abs(self.harness.status.hallPositions[filterID] - center) < 5)
+        self.assertTrue(abs(self.harness.status.stepsPerRev - self.harness.fake.stepsPerRev) < 5)
+
+    def testMoveBeforeHome(self):
+        self.startHarness(seed=3)
+        cmd = self.harness.command("move 3")
+        self.assertTrue(cmd.didFail)
+
+    def testMoveRefused(self):
+        harness = self.startHarness(seed=13)
+        self.home()
+        # the wheel is knocked off the filter after the last status
+        harness.fake.angleOffset += harness.fake.stepsPerRev/12.
+        cmd = harness.command("move 3")
+        self.assertTrue(cmd.didFail)
+        self.assertEqual(cmd.textMsg, "filter wheel is not at a filter")
+
+    def testInitRetry(self):
+        self.startHarness(seed=3)
+        # RW confirmed only once the comms gap is over
+        self.assertTrue(self.harness.status.initTime > 2*device.NVM_COMMS_GAP)
+        self.harness.fake.nvmResult = 0
+        cmd = self.harness.command("init force")
+        self.assertTrue(cmd.didFail)
+        self.assertEqual(self.harness.status.initState, self.harness.status.InitFailed)
+        cmd = self.harness.command("home")
+        self.assertTrue(cmd.didFail)
+        # a failed init is run again
+        self.harness.fake.nvmResult = 1
+        cmd = self.harness.command("init")
+        self.assertTrue(cmd.isDone and not cmd.didFail)
+        self.assertEqual(self.harness.status.initState, self.harness.status.Ready)
+        self.home()
+
+    def testRetryUntilRaises(self):
+        self.startHarness(seed=3)
+        def raises():
+            raise RuntimeError("no reply")
+        results = []
+        device.retryUntil(raises, 1, "Never succeeded").addErrback(results.append)
+        self.harness.runUntil(lambda: results)
+        self.assertTrue(results[0].check(RuntimeError))
+        self.assertTrue("Never succeeded" in results[0].getErrorMessage())
+
+    def testAllMoves(self):
+        for directMove in (True, False):
+            device.DIRECT_MOVE = directMove
+            self.startHarness(seed=4)
+            self.home()
+            for fromFilter in range(1, 7):
+                for toFilter in range(1, 7):
+                    for filterID in (fromFilter, toFilter):
+                        cmd = self.harness.command("move %i"%filterID)
+                        self.assertTrue(cmd.isDone and not cmd.didFail)
+                        self.checkAtFilter(filterID)
+
+    def slipDuringMove(self, filterID, slip):
+        # the wheel slips by slip steps part way through a move
+        cmd = self.harness.startCommand("move %i"%filterID)
+        self.harness.runFor(1)
+        self.harness.fake.angleOffset += slip
+        self.harness.runUntil(lambda: cmd.isDone)
+        return cmd
+
+    def testHallSearch(self):
+        device.DIRECT_MOVE = True
+        self.startHarness(seed=5)
+        self.home()
+        for filterID, slip in [(3, 150), (5, -250), (1, 200)]:
+            cmd = self.slipDuringMove(filterID, slip)
+            self.assertTrue(cmd.isDone and not cmd.didFail)
+            self.checkAtFilter(filterID)
+        # too far from any hall to find it, a home is needed
+        cmd = self.slipDuringMove(4, self.harness.fake.stepsPerRev/12)
+        self.assertTrue(cmd.didFail)
+        self.assertFalse(self.harness.status.isHomed)
+        self.home()
+
+    def testUsbReconnect(self):
+        self.startHarness(seed=7)
+        harness = self.harness
+        # usb timeouts let virtual time pass without running scheduled calls
+        def sleep(dt):
+            harness.clock.rightNow += dt
+        injector = FaultInjector(harness.fake, sleep=sleep, clock=harness.seconds)
+        device.setDevice(injector)
+        self.home()
+        # wedged while idle, homed state kept
+        harness.fake.params["R2"] = harness.fake.params["R4"] = 0
+        injector.wedged = True
+        harness.runUntil(lambda: harness.status.usbReconnects == 1 and not device.RECONNECTING, timeout=60)
+        self.assertFalse(injector.wedged)
+        self.assertTrue(harness.status.isHomed)
+        # settings kept, non volatile memory not read or written
+        self.assertEqual(harness.fake.params["R2"], 0)
+        self.assertEqual(harness.fake.params["R4"], 0)
+        # controller lost its settings too
+        harness.fake.params["EO"] = 0
+        harness.fake.params["HSPD"] = 1000
+        harness.fake.params["R2"] = harness.fake.params["R4"] = 0
+        injector.wedged = True
+        harness.runUntil(lambda: harness.status.usbReconnects == 2 and not device.RECONNECTING, timeout=60)
+        self.assertEqual(harness.fake.params["EO"], 1)
+        self.assertEqual(harness.fake.params["HSPD"], 250)
+        # settings read from and written to non volatile memory again
+        self.assertEqual(harness.fake.params["R2"], 1)
+        self.assertEqual(harness.fake.params["R4"], 1)
+        self.assertEqual(harness.fake.params["DRVRC"], 1500)
+        self.assertTrue(harness.status.isHomed)
+        # wedged mid move
+        cmd = harness.startCommand("move 4")
+        harness.runFor(1)
+        injector.wedged = True
+        harness.runUntil(lambda: cmd.isDone)
+        self.assertFalse(cmd.didFail)
+        self.assertEqual(harness.status.usbReconnects, 3)
+        self.checkAtFilter(4)
+
+    def testLinkLostAtStop(self):
+        self.startHarness(seed=7)
+        harness = self.harness
+        self.home()
+        device.DIRECT_MOVE = False
+        def sleep(dt):
+            harness.clock.rightNow += dt
+        injector = FaultInjector(harness.fake, sleep=sleep, clock=harness.seconds)
+        # the link wedges as the stop at the hall is sent
+        sendCmd = injector.sendCmd
+        def wedgeAtStop(cmdStr):
+            success = sendCmd(cmdStr)
+            if cmdStr == "STOP" and harness.status.isMoving:
+                injector.wedged = True
+            return success
+        injector.sendCmd = wedgeAtStop
+        device.setDevice(injector)
+        # the move fails rather than hanging or claiming the filter
+        harness.actor.queueMoves = True
+        cmd = harness.startCommand("move 3")
+        queuedCmd = harness.startCommand("move 6")
+        self.assertFalse(queuedCmd.isDone)
+        harness.runUntil(lambda: cmd.isDone)
+        self.assertTrue(cmd.didFail)
+        self.assertFalse(harness.status.isHomed)
+        self.assertEqual(harness.status.filterID, None)
+        # as does the move queued behind it
+        self.assertTrue(queuedCmd.didFail)
+        self.assertEqual(queuedCmd.textMsg, "queued move cancelled: cannot command move, home filter wheel first.")
+        # and the watchdog reconnects
+        harness.runUntil(lambda: harness.status.usbReconnects == 1 and not device.RECONNECTING, timeout=60)
+
+    def testStatusPollRate(self):
+        harness = self.startHarness(seed=8)
+        self.home()
+        # backs off at rest
+        harness.runFor(60)
+        self.assertEqual(device.STATUS_POLL, device.STATUS_POLL_IDLE)
+        # quick while moving
+        cmd = harness.startCommand("move 4")
+        harness.runFor(1)
+        self.assertEqual(device.STATUS_POLL, device.STATUS_POLL_ACTIVE)
+        harness.runUntil(lambda: cmd.isDone)
+        self.checkAtFilter(4)
+
+    def testChangedOnlyStatus(self):
+        harness = self.startHarness(seed=9)
+        self.home()
+        msgs = []
+        def writeToUsers(msgCode, msgStr, *args, **kwargs):
+            if msgCode == "i":
+                msgs.append(msgStr)
+        harness.actor.writeToUsers = writeToUsers
+        # by default everything is output
+        harness.command("move 3")
+        self.assertTrue("state=Done" in msgs[-1])
+        self.assertTrue("wheelID=" in msgs[-1])
+        # opted in
+        harness.actor.changedOnly = True
+        msgs[:] = []
+        harness.command("move 2")
+        self.assertTrue("state=Moving" in msgs[0])
+        # only what the move changed
+        self.assertTrue("state=Done" in msgs[-1])
+        self.assertTrue("filterID=2" in msgs[-1])
+        self.assertFalse("wheelID=" in msgs[-1])
+        # the status command outputs everything
+        harness.command("status")
+        self.assertTrue("wheelID=" in msgs[-1])
+        self.assertTrue("filterID=2" in msgs[-1])
+
+    def testStatusCache(self):
+        harness = self.startHarness(seed=10)
+        self.home()
+        reads = []
+        queryMotorState = harness.fake.queryMotorState
+        def countedQuery(*args):
+            reads.append(harness.seconds())
+            return queryMotorState(*args)
+        harness.fake.queryMotorState = countedQuery
+        # at most one hardware read for many status requests at once
+        for ii in range(10):
+            cmd = harness.startCommand("status")
+            self.assertTrue(cmd.isDone and not cmd.didFail)
+        self.assertTrue(len(reads) <= 1)
+        nReads = len(reads)
+        harness.actor.getStatus(maxAge=0)
+        self.assertEqual(len(reads), nReads + 1)
+        # too old to reuse
+        harness.clock.rightNow += harness.actor.status.maxAge + 0.1
+        harness.startCommand("status")
+        self.assertEqual(len(reads), nReads + 2)
+
+    def testDiffuserGuards(self):
+        harness = self.startHarness(seed=9)
+        harness.command("status")
+        # the cover goes on just after a status, the guard reads it
+        harness.fake.coverOff = False
+        cmd = harness.command("diffuIn")
+        self.assertTrue(cmd.didFail)
+        harness.fake.coverOff = True
+        cmd = harness.command("diffuIn")
+        self.assertTrue(cmd.isDone and not cmd.didFail)
+        self.assertEqual(harness.status.diffuserIn, 1)
+
+    def testStopDuringSpinUp(self):
+        harness = self.startHarness(seed=10)
+        cmd = harness.command("diffuIn")
+        self.assertTrue(cmd.isDone and not cmd.didFail)
+        spinCmd = harness.startCommand("startDiffuRot")
+        harness.runUntil(lambda: device.DIFFU_WAITS == 1)
+        cmd = harness.command("stopDiffuRot")
+        self.assertTrue(cmd.isDone and not cmd.didFail)
+        self.assertTrue(spinCmd.didFail)
+        # the superseded spin-up wait has ended too
+        self.assertEqual(device.DIFFU_WAITS, 0)
+        msgs = []
+        harness.actor.writeToUsers = lambda *args, **kwargs: msgs.append(args)
+        harness.runFor(30)
+        self.assertEqual(msgs, [])
+
+    def testSubscriptions(self):
+        harness = self.startHarness(seed=11)
+        self.home()
+        actor = harness.actor
+        # three clients connected
+        msgs = dict((userID, []) for userID in (1, 2, 3))
+        def writeToOneUser(msgCode, msgStr, cmd=None, userID=None, cmdID=None):
+            if cmd is not None:
+                userID = cmd.userID
+            if msgCode == "i":
+                msgs[userID].append((harness.seconds(), msgStr))
+        actor.userDict = dict((userID, None) for userID in msgs)
+        actor.writeToOneUser = writeToOneUser
+        cmd = harness.command("subscribe keywords=filterID,state", userID=1)
+        self.assertTrue(cmd.isDone and not cmd.didFail)
+        self.assertEqual(msgs[1][-1][1], "filterID=1; state=Done")
+        harness.command("subscribe interval=5", userID=2)
+        cmd = harness.command("subscribe keywords=filterID,speed", userID=3)
+        self.assertTrue(cmd.didFail)
+        cmd = harness.command("move 3", userID=3)
+        self.assertTrue(cmd.isDone and not cmd.didFail)
+        harness.runFor(5)
+        # only the keywords subscribed to
+        self.assertTrue(any("state=Moving" in msgStr for t, msgStr in msgs[1]))
+        self.assertTrue("filterID=3" in msgs[1][-1][1])
+        for t, msgStr in msgs[1]:
+            self.assertFalse("encoderPos=" in msgStr)
+        # no more often than asked, ending with the latest values
+        times = [t for t, msgStr in msgs[2]]
+        for t0, t1 in zip(times[:-1], times[1:]):
+            self.assertTrue(t1 - t0 >= 5)
+        self.assertTrue(any("filterID=3" in msgStr for t, msgStr in msgs[2][1:]))
+        # not subscribed, everything
+        self.assertTrue(any("encoderPos=" in msgStr for t, msgStr in msgs[3]))
+        self.assertTrue("wheelID=" in msgs[3][-1][1])
+        # the status command outputs the whole subscription to its client,
+        # nothing to the other subscriber and everything to the client
+        # not subscribed, as to every client before any subscribed
+        nMsgs = dict((userID, len(msgs[userID])) for userID in msgs)
+        harness.command("status", userID=1)
+        self.assertEqual(msgs[1][-1][1], "filterID=3; state=Done")
+        self.assertEqual(len(msgs[2]), nMsgs[2])
+        self.assertEqual(len(msgs[3]), nMsgs[3] + 1)
+        self.assertTrue("wheelID=" in msgs[3][-1][1])
+        # a client disconnects
+        del actor.userDict[2]
+        harness.command("status", userID=3)
+        self.assertFalse(2 in actor.subscriptions)
+
+    def testQueuedMoves(self):
+        device.DIRECT_MOVE = True
+        harness = self.startHarness(seed=12)
+        self.home()
+        harness.actor.queueMoves = True
+        # 1 to 4 goes through 6 and 5, retargeted to end at 5
+        nMoves = harness.fake.nMoves
+        cmd4 = harness.startCommand("move 4")
+        harness.runFor(1)
+        cmd5 = harness.startCommand("move 5")
+        self.assertTrue(cmd4.didFail)
+        harness.runUntil(lambda: cmd5.isDone)
+        self.assertFalse(cmd5.didFail)
+        self.checkAtFilter(5)
+        self.assertEqual(harness.fake.nMoves - nMoves, 2)
+        # 5 to 2 goes through 6 and 1, the latest move off
+        # that path waits for it
+        cmd2 = harness.startCommand("move 2")
+        harness.runFor(1)
+        cmd3 = harness.startCommand("move 3")
+        cmd4 = harness.startCommand("move 4")
+        self.assertTrue(cmd3.didFail)
+        self.assertFalse(cmd4.isDone)
+        harness.runUntil(lambda: cmd4.isDone)
+        self.assertTrue(cmd2.isDone and not cmd2.didFail)
+        self.assertFalse(cmd4.didFail)
+        self.checkAtFilter(4)
+
+    def testSequenceCommand(self):
+        harness = self.startHarness(seed=13)
+        self.home()
+        msgs = []
+        def writeToUsers(msgCode, msgStr, *args, **kwargs):
+            if msgCode == "i":
+                msgs.append(msgStr)
+        harness.actor.writeToUsers = writeToUsers
+        cmd = harness.startCommand("sequence move 3; diffuIn; wait 10; trigger; move 5; move 2; startDiffuRot; stopDiffuRot; diffuOut")
+        self.assertTrue("seqSkippedSteps=5" in msgs)
+        harness.runUntil(lambda: harness.actor.seqTrigger is not None)
+        self.checkAtFilter(3)
+        self.assertEqual(harness.status.diffuserIn, 1)
+        self.assertFalse(cmd.isDone)
+        trigger = harness.command("trigger")
+        self.assertTrue(trigger.isDone and not trigger.didFail)
+        harness.runUntil(lambda: cmd.isDone)
+        self.assertFalse(cmd.didFail)
+        self.checkAtFilter(2)
+        self.assertEqual(harness.status.diffuserOut, 1)
+        # the wheel moved while the diffuser went in
+        stepTimes = [msgStr for msgStr in msgs if msgStr.startswith("seqStepTimes=")][0]
+        stepTimes = stepTimes.split(";")[0].split("=")[1].split(",")
+        self.assertEqual(len(stepTimes), 9)
+        self.assertEqual(stepTimes[4], "NaN")
+        self.assertTrue(abs(float(stepTimes[2]) - 10) < 0.1)
+        # nothing to trigger
+        self.assertTrue(harness.command("trigger").didFail)
+        # malformed
+        self.assertTrue(harness.command("sequence move 9; spin").didFail)
+        # stopped
+        cmd = harness.startCommand("sequence wait 100; move 4")
+        harness.runFor(1)
+        harness.command("stopWheel")
+        self.assertTrue(cmd.didFail)
+        harness.runFor(200)
+        self.checkAtFilter(2)
+
+    def testRandomSequences(self):
+        rand = random.Random(0)
+        for ii in range(NUM_SEQUENCES):
+            device.CONTINUOUS_HOME = rand.random() < 0.5
+            device.DIRECT_MOVE = rand.random() < 0.5
+            self.startHarness(seed=rand.randint(0, 1000000))
+            self.home()
+            for jj in range(SEQUENCE_LENGTH):
+                # restart from a random angle now and then
+                if rand.random() < 0.1:
+                    self.harness.fake.angleOffset = rand.uniform(0, self.harness.fake.stepsPerRev)
+                    self.home()
+                    continue
+                filterID = rand.randint(1, 6)
+                cmd = self.harness.command("move %i"%filterID)
+                self.assertTrue(cmd.isDone and not cmd.didFail)
+                self.checkAtFilter(filterID)
+                self.harness.runFor(rand.uniform(0, 2))
+
+
+if __name__ == '__main__':
+    from unittest import main
+    main()